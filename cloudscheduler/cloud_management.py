@@ -9,15 +9,17 @@ import json
 import time
 import copy
 import shlex
+import socket
 import string
 import logging
 import tempfile
+import itertools
 import threading
-import subprocess
 import ConfigParser
 
 from decimal import Decimal
 from collections import defaultdict
+from collections import namedtuple
 
 try:
     import cPickle as pickle
@@ -25,6 +27,8 @@ except:
     import pickle
 
 from cloudscheduler import cluster_tools
+from cloudscheduler import command_runner
+from cloudscheduler import condor_bindings
 from cloudscheduler import ec2cluster
 try:
     from cloudscheduler import stratuslabcluster
@@ -57,6 +61,7 @@ from cloudscheduler import cloudconfig
 from cloudscheduler.utilities import get_or_none
 from cloudscheduler.utilities import ErrTrackQueue
 from cloudscheduler.utilities import splitnstrip
+from cloudscheduler.utilities import json_classad_stream
 import cloudscheduler.utilities as utilities
 
 
@@ -65,6 +70,14 @@ log = None
 log = logging.getLogger("cloudscheduler")
 config_val = config.config_options
 
+# Machine and master classad attributes read into VMMachine objects.
+# With condor_attribute_projection enabled these are the only attributes
+# requested from condor_status.
+MACHINE_QUERY_ATTRIBUTES = ("Name", "Machine", "JobId", "GlobalJobId", "MyAddress", "State",
+                            "Activity", "VMType", "MyCurrentTime", "EnteredCurrentState",
+                            "Start", "RemoteOwner", "SlotType", "TotalSlots")
+MASTER_QUERY_ATTRIBUTES = ("Machine", "MasterIpAddr")
+
 """Verify if stratuslab dependencies are available"""
 try:
     from stratuslab.Image import Image
@@ -73,23 +86,244 @@ except ImportError:
     stratuslab_support = False
     log.warning("Stratuslab dependencies are not available")
 
+# NumPy is optional, without it ClusterFitter checks the clusters one by one
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 ##
 ## CLASSES
 ##
 
 
+class MachineSlots(object):
+    """
+    The slot ads of a machine list grouped by machine name, keyed the way
+    match_host_with_condor_host compares a host name with a condor name: by
+    the name without slot@, and unless it is an IP address, by the first
+    part of the name. Entries are (position in the list, machine) pairs.
+    """
+    __slots__ = ('by_name', 'by_short_name')
+
+    def __init__(self, vm_machines):
+        by_name = defaultdict(list)
+        by_short_name = defaultdict(list)
+        for i, machine in enumerate(vm_machines):
+            if machine.machine_name is None:
+                continue
+            name_parts = machine.machine_name.split("@")
+            name = name_parts[1] if len(name_parts) > 1 else name_parts[0]
+            by_name[name].append((i, machine))
+            if not _is_ip_address(machine.machine_name):
+                by_short_name[name.split(".")[0]].append((i, machine))
+        self.by_name = dict(by_name)
+        self.by_short_name = dict(by_short_name)
+
+    def slots_of(self, hostname):
+        """The slots of the machine called hostname, in the order of the machine list."""
+        if hostname is None:
+            return []
+        exact = self.by_name.get(hostname, ())
+        short = self.by_short_name.get(hostname.split(".")[0], ())
+        if not short:
+            return [machine for _, machine in exact]
+        if not exact:
+            return [machine for _, machine in short]
+        merged = dict(exact)
+        merged.update(short)
+        return [merged[i] for i in sorted(merged)]
+
+
+class MachineIndex(object):
+    """
+    The machines of a machine list grouped by the values of the attributes
+    find_in_where is asked about, so a query returns a prepared list instead
+    of checking every machine. Groupings for the common queries are built
+    up front, others the first time they are asked for.
+    """
+    __slots__ = ('vm_machines', 'groupings')
+
+    PREBUILT = (('activity', 'state', 'vmtype'), ('activity', 'vmtype'), ('vmtype',))
+
+    def __init__(self, vm_machines):
+        self.vm_machines = vm_machines
+        self.groupings = {}
+        for attributes in self.PREBUILT:
+            self.grouping(attributes)
+
+    def grouping(self, attributes):
+        """Return {tuple of values of attributes: machines with those values}."""
+        grouping = self.groupings.get(attributes)
+        if grouping is None:
+            grouping = defaultdict(list)
+            for machine in self.vm_machines:
+                grouping[tuple(getattr(machine, name, None) for name in attributes)].append(machine)
+            grouping = dict(grouping)
+            self.groupings[attributes] = grouping
+        return grouping
+
+    def find(self, criteria):
+        """The machines find_in_where would return for criteria, as a new list."""
+        attributes = tuple(sorted(criteria))
+        return list(self.grouping(attributes).get(tuple(criteria[name] for name in attributes), ()))
+
+
+class MachineSnapshot(namedtuple('MachineSnapshot', ['vm_machines', 'prev_vm_machines', 'time',
+                                                     'machine_slots', 'machine_index'])):
+    """
+    The machines registered with condor as seen by one MachinePoller cycle,
+    and by the cycle before it, with the slots of the current cycle grouped
+    by machine and by attribute values. Published as a whole so other
+    threads never see a half updated machine list.
+    """
+    __slots__ = ()
+
+
+def _is_ip_address(name):
+    """True if name is an IPv4 address."""
+    try:
+        socket.inet_aton(name)
+        return True
+    except:
+        return False
+
+
+class VMIndex(object):
+    """
+    Index of the VMs of a ResourcePool by host name and condor address.
+
+    Rebuilt on the first lookup after a VM was added to or removed from a
+    cluster or had one of its names changed (see cluster_tools.vm_generation),
+    so the cleanup passes looking up every machine in condor_status don't each
+    scan every VM. Entries are (vm, cluster, retired) tuples in the order the
+    clusters and their VMs are listed, resources before retired_resources.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.signature = None
+        self.by_name = {}
+        self.by_short_name = {}
+        self.by_addr = {}
+
+    @staticmethod
+    def _signature(resources, retired_resources):
+        return (cluster_tools.vm_generation, len(resources),
+                tuple((id(cluster), id(cluster.vms), len(cluster.vms))
+                      for cluster in itertools.chain(resources, retired_resources)))
+
+    def refresh(self, resources, retired_resources):
+        """Rebuild the index if the VMs changed since it was built."""
+        signature = self._signature(resources, retired_resources)
+        if signature == self.signature:
+            return
+        with self.lock:
+            by_name = defaultdict(list)
+            by_short_name = defaultdict(list)
+            by_addr = defaultdict(list)
+            for retired, clusters in ((False, resources), (True, retired_resources)):
+                for cluster in clusters:
+                    for vm in list(cluster.vms):
+                        entry = (vm, cluster, retired)
+                        names = set([vm.hostname, vm.alt_hostname, vm.condormasteraddr,
+                                     vm.condorname])
+                        names.discard(None)
+                        names.discard("")
+                        for name in names:
+                            by_name[name].append(entry)
+                        for short_name in set(name.split(".")[0] for name in names):
+                            by_short_name[short_name].append(entry)
+                        if vm.condoraddr:
+                            by_addr[vm.condoraddr].append(entry)
+            self.by_name = dict(by_name)
+            self.by_short_name = dict(by_short_name)
+            self.by_addr = dict(by_addr)
+            self.signature = signature
+
+    def name_candidates(self, condor_name):
+        """Entries that could match condor_name (without slot@) in
+        match_host_with_condor_host: the same name if it is an IP address,
+        otherwise the same first part of the name.
+        """
+        if _is_ip_address(condor_name):
+            return self.by_name.get(condor_name, ())
+        return self.by_short_name.get(condor_name.split(".")[0], ())
+
+
+class ClusterFitter(object):
+    """
+    Finds the clusters a VM fits on. The capacity of the clusters (free
+    slots, memory, max_vm_mem, cores, storage, enabled) is kept in arrays,
+    NumPy ones when NumPy is available, and checked against the VM's
+    requirements for all clusters at once. The clusters found are remembered
+    per requirements, targets and blocked clouds until the capacity of a
+    cluster changes (cluster_tools.resource_generation) or images get banned.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = None
+        self.clusters = []
+        self.class_names = []
+        self.capacity = None
+        self.fits = {}
+
+    def refresh(self, clusters, ban_generation):
+        """Rebuild the arrays and forget the fits if the clusters changed."""
+        state = (cluster_tools.resource_generation, ban_generation, id(clusters), len(clusters))
+        if state == self.state:
+            return
+        self.state = state
+        self.clusters = list(clusters)
+        self.class_names = [cluster.__class__.__name__ for cluster in self.clusters]
+        self.fits = {}
+        columns = [[cluster.vm_slots for cluster in self.clusters],
+                   [cluster.memory for cluster in self.clusters],
+                   [cluster.max_vm_mem for cluster in self.clusters],
+                   [cluster.cpu_cores for cluster in self.clusters],
+                   [cluster.storageGB for cluster in self.clusters],
+                   [bool(cluster.enabled) for cluster in self.clusters]]
+        self.capacity = columns
+        if numpy is not None:
+            try:
+                self.capacity = [numpy.array(column, dtype=float) for column in columns[:5]] + \
+                                [numpy.array(columns[5], dtype=bool)]
+            except (TypeError, ValueError):
+                log.debug("Cluster capacity isn't numeric, fitting clusters one by one")
+
+    def fitting_capacity(self, memory, cpucores, storage):
+        """Return the set of ids of the clusters with room for the VM."""
+        slots, free_memory, max_vm_mem, cores, free_storage, enabled = self.capacity
+        if numpy is not None and isinstance(slots, numpy.ndarray):
+            fits = enabled & (slots > 0) & ((max_vm_mem == -1) | (max_vm_mem >= memory)) & \
+                   (free_memory >= memory) & (cores >= cpucores) & (free_storage >= storage)
+            return set(id(self.clusters[i]) for i in numpy.flatnonzero(fits))
+        return set(id(cluster) for cluster, cluster_slots, cluster_memory, cluster_max_vm_mem,
+                   cluster_cores, cluster_storage, cluster_enabled
+                   in itertools.izip(self.clusters, slots, free_memory, max_vm_mem, cores,
+                                     free_storage, enabled)
+                   if cluster_enabled and cluster_slots > 0 and
+                   (cluster_max_vm_mem == -1 or memory <= cluster_max_vm_mem) and
+                   memory <= cluster_memory and cpucores <= cluster_cores and
+                   storage <= cluster_storage)
+
+
 class ResourcePool(object):
 
     """Stores and organises a list of Cluster resources."""
     ## Instance variables
     resources = []
-    machine_list = []
-    prev_machine_list = []
-    vm_machine_list = []
-    prev_vm_machine_list = []
-    master_list = []
+    machine_snapshot = MachineSnapshot([], [], None, MachineSlots([]), MachineIndex([]))
     retired_resources = []
+    # resources by cluster name, see _index_clusters
+    clusters_by_name = {}
+    # Bumped when banned_job_resource changes, see ClusterFitter
+    ban_generation = 0
     config_file = ""
+    # Seconds invalidated classads are not sent again, the collector can
+    # keep listing them until the next update from the daemon is due.
+    INVALIDATED_AD_MEMORY = 900
 
     ## Instance methods
 
@@ -115,15 +349,27 @@ class ResourcePool(object):
         self.setup_queued = False
         self.non_cs_condor_machines = set()
         self.missing_vm_condor_machines = set()
+        self.invalidated_ads = {}
+        self.vm_index = VMIndex()
+        self.cluster_fitter = ClusterFitter()
+        self.ban_generation = 0
 
         if not condor_query_type:
             condor_query_type = config_val.get('global', 'condor_retrieval_method')
 
         if condor_query_type.lower() == "local":
             self.resource_query = self.resource_query_local
+            self.master_resource_query = self.master_resource_query_local
+            self.do_condor_off = self.do_condor_off_local
+        elif condor_query_type.lower() == "bindings" and condor_bindings.available():
+            self.resource_query = self.resource_query_bindings
+            self.master_resource_query = self.master_resource_query_bindings
+            self.do_condor_off = self.do_condor_off_bindings
         else:
             log.error("Can't use '%s' retrieval method. Using local method.", condor_query_type)
             self.resource_query = self.resource_query_local
+            self.master_resource_query = self.master_resource_query_local
+            self.do_condor_off = self.do_condor_off_local
 
         if config_val.get('global', 'scheduling_metric').lower() == "slot":
             self.vmtype_distribution = self.vmtype_slot_distribution
@@ -204,6 +450,7 @@ class ResourcePool(object):
                 cluster.memory = []
             old_resources.append(cluster)
             self.resources.remove(cluster)
+        self.clusters_by_name = {}
 
         # Update resources
         # Do this by replacing each updated cluster object with the
@@ -217,8 +464,8 @@ class ResourcePool(object):
                         for new_cluster in new_resources:
                             if new_cluster.name == updated_name:
 
-                                new_cluster.vms = sorted(old_cluster.vms, key=lambda vm: vm.id)
-                                new_cluster.vms = sorted(new_cluster.vms, key=lambda vm: vm.status)
+                                new_cluster.vms = cluster_tools.VMList(sorted(old_cluster.vms, key=lambda vm: vm.id))
+                                new_cluster.vms = cluster_tools.VMList(sorted(new_cluster.vms, key=lambda vm: vm.status))
                                 while 1:
                                     if new_cluster.vms[0].status == "Error":
                                         new_cluster.vms.append(new_cluster.vms.pop(0))
@@ -256,6 +503,7 @@ class ResourcePool(object):
                                            reason="%s has been removed from system" % cluster.name)
                     old_resources.remove(cluster)
 
+        self._index_clusters()
         self.setup_lock.release()
         if self.setup_queued:
             self.setup_queued = False
@@ -495,6 +743,14 @@ class ResourcePool(object):
     def add_resource(self, cluster):
         """Add a cluster resource to the pool's resource list."""
         self.resources.append(cluster)
+        self._index_clusters()
+
+    def _index_clusters(self):
+        """Rebuild the map get_cluster looks clusters up in, after resources changed."""
+        clusters_by_name = {}
+        for cluster in self.resources:
+            clusters_by_name.setdefault(cluster.name, cluster)
+        self.clusters_by_name = clusters_by_name
 
     def log_list(self, clusters):
         """Log a list of clusters.
@@ -594,61 +850,43 @@ class ResourcePool(object):
             log.debug("Pool is empty... Cannot return list of fitting resources")
             return []
 
+        key = self._fitting_key(memory, cpucores, storage, ami, imageloc, targets, blocked)
+        fitter = self.cluster_fitter
+        with fitter.lock:
+            fitter.refresh(self.resources, self.ban_generation)
+            if key in fitter.fits:
+                return list(fitter.fits[key][0])
+            fitting_ids = fitter.fitting_capacity(memory, cpucores, storage)
+            class_names = dict(itertools.izip(map(id, fitter.clusters), fitter.class_names))
+
         fitting_clusters = []
         if targets:
             clusters = self.filter_resources_by_names(targets)
         else:
             clusters = self.resources
         for cluster in clusters:
-            log.verbose("Trying with cluster %s (Name: %s)", str(cluster), cluster.name)
-            if not cluster.enabled:
-                log.verbose("get_fitting_resources - %s is disabled - skipping", cluster.name)
+            if id(cluster) not in fitting_ids or cluster.name in blocked:
                 continue
-            if cluster.name in blocked:
-                log.verbose("get_fitting_resources - %s is blocked.", cluster.name)
-                continue
-            if cluster.__class__.__name__ == "EC2Cluster":
+            class_name = class_names.get(id(cluster))
+            if class_name == "EC2Cluster":
                 # If no valid ami to boot from
                 if ami == "":
                     continue
                 # If ami banned from cluster
-                if ami in self.banned_job_resource.keys():
-                    if cluster.name in self.banned_job_resource[ami]:
-                        log.verbose("get_fitting_resources - %s ami banned on %s", \
-                                    ami, cluster.name)
-                        continue
+                if cluster.name in self.banned_job_resource.get(ami, ()):
+                    log.verbose("get_fitting_resources - %s ami banned on %s", \
+                                ami, cluster.name)
+                    continue
 
-            elif cluster.__class__.__name__ == "StratusLabCluster" and stratuslab_support:
+            elif class_name == "StratusLabCluster" and stratuslab_support:
                 # If not valid image file
                 if imageloc == "":
                     continue
-                if imageloc in self.banned_job_resource.keys():
-                    if cluster.name in self.banned_job_resource[imageloc]:
-                        continue
+                if cluster.name in self.banned_job_resource.get(imageloc, ()):
+                    continue
                 if (not Image.isDiskId(imageloc)) and (not Image.isImageId(imageloc)):
                     continue
 
-            # If the cluster has no open VM slots
-            if cluster.vm_slots <= 0:
-                log.verbose("get_fitting_resources - No free slots in %s", cluster.name)
-                continue
-            # If request exceeds the max vm memory on cluster
-            if memory > cluster.max_vm_mem and cluster.max_vm_mem != -1:
-                log.verbose("get_fitting_resources - memory request \
-                            exceeds max_vm_mem on %s", cluster.name)
-                continue
-            # If the cluster has no sufficient memory entries for the VM
-            if memory > cluster.memory:
-                log.verbose("get_fitting_resources - Not enough Memory  in %s", cluster.name)
-                continue
-            # If the cluster does not have sufficient CPU cores
-            if cpucores > cluster.cpu_cores:
-                log.verbose("get_fitting_resources - Not enough CPU Cores in %s", cluster.name)
-                continue
-            # If the cluster does not have sufficient storage capacity
-            if storage > cluster.storageGB:
-                log.verbose("get_fitting_resources - Not enough storage in %s", cluster.name)
-                continue
             # Add cluster to the list to be returned (meets all job reqs)
             fitting_clusters.append(cluster)
 
@@ -656,9 +894,25 @@ class ResourcePool(object):
         if fitting_clusters:
             log.verbose("List of fitting clusters: ")
             self.log_list(fitting_clusters)
-        return fitting_clusters
+        else:
+            log.verbose("get_fitting_resources - no cluster fits memory %s, cores %s, storage %s",
+                        memory, cpucores, storage)
+        with fitter.lock:
+            if fitter.state[:2] == (cluster_tools.resource_generation, self.ban_generation):
+                fitter.fits[key] = (fitting_clusters, None)
+        return list(fitting_clusters)
 
 
+    def _fitting_key(self, memory, cpucores, storage, ami, imageloc, targets, blocked):
+        """Return the key the clusters fitting these requirements are remembered under.
+
+        Targets are resolved so a change to the cloud aliases isn't answered
+        from the clusters found for the old ones.
+        """
+        if targets:
+            targets = self.resolve_target_cloud_alias(targets)
+        return (memory, cpucores, storage, ami, imageloc, tuple(targets or ()), tuple(blocked or ()))
+
     def get_resourceBF(self, network, memory, cpucores, storage, ami, imageloc,
                        targets=[], blocked=[]):
         """
@@ -690,6 +944,14 @@ class ResourcePool(object):
                 If no fitting clusters are found, (None, None) is returned.
 
         """
+        # The balanced order is remembered along with the fitting clusters
+        key = self._fitting_key(memory, cpucores, storage, ami, imageloc, targets, blocked)
+        fitter = self.cluster_fitter
+        with fitter.lock:
+            fitter.refresh(self.resources, self.ban_generation)
+            if key in fitter.fits and fitter.fits[key][1] is not None:
+                return list(fitter.fits[key][1])
+
         # Get a list of fitting clusters
         fitting_clusters = self.get_fitting_resources(network, memory, cpucores, storage, ami,
                                                       imageloc, targets, blocked)
@@ -707,7 +969,10 @@ class ResourcePool(object):
         # sort them based on how full and return the list
         fitting_clusters.sort(key=lambda cluster: cluster.slot_fill_ratio())
         fitting_clusters.sort(key=lambda cluster: cluster.priority)
-        return fitting_clusters
+        with fitter.lock:
+            if key in fitter.fits:
+                fitter.fits[key] = (fitter.fits[key][0], fitting_clusters)
+        return list(fitting_clusters)
 
     def resourcePF(self, network, memory=0, disk=0):
         """
@@ -792,22 +1057,19 @@ class ResourcePool(object):
 
     def get_cluster(self, cluster_name, retired=False):
         """Return cluster that matches cluster_name."""
-        if retired:
-            res_list = self.retired_resources
-        else:
-            res_list = self.resources
-        for cluster in res_list:
+        if not retired:
+            return self.clusters_by_name.get(cluster_name)
+        for cluster in self.retired_resources:
             if cluster.name == cluster_name:
                 return cluster
         return None
 
     def get_cluster_with_vm(self, vm):
-        """Find cluster that contains vm."""
-        cluster = None
-        for clust in self.resources:
-            if vm in clust.vms:
-                cluster = clust
-        return cluster
+        """Find cluster in resources that contains vm."""
+        cluster = vm.cluster
+        if cluster is not None and self.clusters_by_name.get(cluster.name) is cluster:
+            return cluster
+        return None
 
     def convert_classad_dict(self, ad):
         """Convert the Condor class ad struct into a python dict.
@@ -833,82 +1095,208 @@ class ResourcePool(object):
         """
         resource_query_local -- does a Query to the condor collector
 
-        Returns a list of dictionaries with information about the machines
-        registered with condor.
+        Returns a list of VMMachine objects for the machines registered with
+        condor. Their address_master is filled in by set_master_addresses.
         """
         log.verbose("Querying Condor Collector with %s",
                     config_val.get('global', 'condor_status_command'))
         condor_status = condor_out = condor_err = ""
+        json_classads = config_val.get('global', 'condor_classad_format') == "json"
         try:
             condor_status = shlex.split(config_val.get('global', 'condor_status_command'))
-            sp = subprocess.Popen(condor_status, shell=False,
-                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            (condor_out, condor_err) = sp.communicate(input=None)
-        except OSError:
-            log.error("OSError occured while doing condor_status - will try again next cycle.")
+            if json_classads:
+                condor_status.append('-json')
+            if config_val.getboolean('global', 'condor_attribute_projection'):
+                condor_status.extend(['-attributes', ','.join(MACHINE_QUERY_ATTRIBUTES)])
+            result = command_runner.run_command(condor_status,
+                                                config_val.getint('global', 'condor_q_timeout'))
+            (condor_out, condor_err) = (result.stdout, result.stderr)
+        except command_runner.CommandError, e:
+            log.error("%s - will try again next cycle.", e)
             return []
         except:
             log.exception("Problem running %s, unexpected error: %s", \
                           string.join(condor_status, " "), condor_err)
             return []
 
-        return self._condor_status_to_machine_list(condor_out)
+        if json_classads:
+            return self._condor_status_json_to_vmmachine_list(condor_out)
+        return self._condor_status_to_vmmachine_list(condor_out)
 
     def master_resource_query_local(self):
         """
         master_resource_query_local -- does a Query to the condor collector about master daemons
 
-        Returns a list of dictionaries with information about the machines masters
-        registered with condor.
+        Returns a dictionary mapping the Machine of the master daemons registered
+        with condor to their MasterIpAddr.
         """
         log.verbose("Querying Condor Collector with %s",
                     config_val.get('global', 'condor_status_master_command'))
         condor_status = condor_out = condor_err = ""
+        json_classads = config_val.get('global', 'condor_classad_format') == "json"
         try:
             condor_status = shlex.split(config_val.get('global', 'condor_status_master_command'))
-            sub_p = subprocess.Popen(condor_status, shell=False,
-                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            (condor_out, condor_err) = sub_p.communicate(input=None)
-        except OSError:
-            log.error("OSError occured while doing condor_status -master - \
-                      will try again next cycle.")
-            return []
+            if json_classads:
+                condor_status.append('-json')
+            if config_val.getboolean('global', 'condor_attribute_projection'):
+                condor_status.extend(['-attributes', ','.join(MASTER_QUERY_ATTRIBUTES)])
+            result = command_runner.run_command(condor_status,
+                                                config_val.getint('global', 'condor_q_timeout'))
+            (condor_out, condor_err) = (result.stdout, result.stderr)
+        except command_runner.CommandError, e:
+            log.error("%s - will try again next cycle.", e)
+            return {}
         except:
             log.exception("Problem running %s, unexpected error: %s", \
                           string.join(condor_status, " "), condor_err)
+            return {}
+
+        if json_classads:
+            return self._condor_status_json_to_master_addresses(condor_out)
+        return self._condor_status_to_master_addresses(condor_out)
+
+    def resource_query_bindings(self):
+        """
+        resource_query_bindings -- query the condor collector for startd ads
+        through the htcondor bindings
+
+        Returns a list of VMMachine objects like resource_query_local.
+        """
+        log.verbose("Querying Condor Collector for startd ads through the htcondor bindings")
+        try:
+            classads = condor_bindings.query_startds(MACHINE_QUERY_ATTRIBUTES)
+        except:
+            log.exception("Problem querying the collector for startd ads")
             return []
+        vm_machines = []
+        for classad in classads:
+            machine = VMMachine.from_classad(classad)
+            if machine.machine_name:
+                vm_machines.append(machine)
+            else:
+                log.warning("Skipping machine ad without Machine: %s", machine.name)
+        return vm_machines
 
-        return self._condor_status_to_machine_list(condor_out)
+    def master_resource_query_bindings(self):
+        """
+        master_resource_query_bindings -- query the condor collector for master
+        ads through the htcondor bindings
+
+        Returns a dictionary mapping Machine to MasterIpAddr like
+        master_resource_query_local.
+        """
+        log.verbose("Querying Condor Collector for master ads through the htcondor bindings")
+        try:
+            classads = condor_bindings.query_masters(MASTER_QUERY_ATTRIBUTES)
+        except:
+            log.exception("Problem querying the collector for master ads")
+            return {}
+        return dict((classad["Machine"], classad["MasterIpAddr"]) for classad in classads
+                    if "Machine" in classad and "MasterIpAddr" in classad)
 
     @staticmethod
-    def _condor_status_to_machine_list(condor_status_output):
+    def _condor_status_to_vmmachine_list(condor_status_output):
         """
-        _condor_status_to_machine_list - Converts the output of
-               condor_status -l to a list of dictionaries with the attributes
-               from the Condor machine ad.
+        _condor_status_to_vmmachine_list - Converts the output of
+               condor_status -l to a list of VMMachine objects, setting the
+               attributes of each machine as its classad lines are read.
 
                returns [] is there are no machines
         """
+        vm_machines = []
+        machine = None
+        # An extra blank line finishes the last classad
+        for classad_line in itertools.chain(condor_status_output.splitlines(), [""]):
+            classad_line = classad_line.strip()
+            # Each classad is seperated by a blank line
+            if not classad_line:
+                if machine:
+                    if machine.machine_name:
+                        vm_machines.append(machine)
+                    else:
+                        log.warning("Skipping machine ad without Machine: %s", machine.name)
+                    machine = None
+                continue
+            try:
+                (classad_key, classad_value) = classad_line.split(" = ", 1)
+            except ValueError:
+                # Blank or header lines, projected queries can leave
+                # these between ads
+                continue
+            attribute = VMMachine.CLASSAD_ATTRIBUTES.get(classad_key)
+            if not attribute:
+                continue
+            if machine is None:
+                machine = VMMachine(current_time=-1, entered_state_time=-1)
+            classad_value = classad_value.strip('"')
+            if attribute in VMMachine.INTERNED_ATTRIBUTES:
+                classad_value = intern(classad_value)
+            setattr(machine, attribute, classad_value)
 
-        machines = []
+        return vm_machines
 
-        # Each classad is seperated by '\n\n'
-        raw_machine_classads = condor_status_output.split("\n\n")
-        # Empty condor pools give us an empty string or stray \n in our list
-        raw_machine_classads = filter(lambda x: x != "" and x != "\n", raw_machine_classads)
+    @staticmethod
+    def _condor_status_json_to_vmmachine_list(condor_status_output):
+        """
+        _condor_status_json_to_vmmachine_list - Converts the output of
+               condor_status -json to a list of VMMachine objects with the
+               typed attributes from the Condor machine ad.
 
-        for raw_classad in raw_machine_classads:
-            classad = {}
-            classad_lines = raw_classad.splitlines()
-            for classad_line in classad_lines:
-                classad_line = classad_line.strip()
-                (classad_key, classad_value) = classad_line.split(" = ", 1)
-                classad_value = classad_value.strip('"')
-                classad[classad_key] = classad_value
+               returns [] is there are no machines
+        """
+        vm_machines = []
+        try:
+            for classad in json_classad_stream(condor_status_output.splitlines(True)):
+                machine = VMMachine.from_classad(classad)
+                if machine.machine_name:
+                    vm_machines.append(machine)
+                else:
+                    log.warning("Skipping machine ad without Machine: %s", machine.name)
+        except ValueError:
+            log.exception("Problem decoding condor_status -json output")
+            return []
+        return vm_machines
 
-            machines.append(classad)
+    @staticmethod
+    def _condor_status_to_master_addresses(condor_status_output):
+        """
+        _condor_status_to_master_addresses - Converts the output of
+               condor_status -master -l to a dictionary mapping Machine to
+               MasterIpAddr.
+        """
+        addresses = {}
+        machine = address = None
+        for classad_line in itertools.chain(condor_status_output.splitlines(), [""]):
+            classad_line = classad_line.strip()
+            if not classad_line:
+                if machine and address:
+                    addresses[machine] = address
+                machine = address = None
+                continue
+            try:
+                (classad_key, classad_value) = classad_line.split(" = ", 1)
+            except ValueError:
+                continue
+            if classad_key == "Machine":
+                machine = classad_value.strip('"')
+            elif classad_key == "MasterIpAddr":
+                address = classad_value.strip('"')
+        return addresses
 
-        return machines
+    @staticmethod
+    def _condor_status_json_to_master_addresses(condor_status_output):
+        """
+        _condor_status_json_to_master_addresses - Converts the output of
+               condor_status -master -json to a dictionary mapping Machine to
+               MasterIpAddr.
+        """
+        try:
+            return dict((classad["Machine"], classad["MasterIpAddr"])
+                        for classad in json_classad_stream(condor_status_output.splitlines(True))
+                        if "Machine" in classad and "MasterIpAddr" in classad)
+        except ValueError:
+            log.exception("Problem decoding condor_status -master -json output")
+            return {}
 
     def get_vmtypes_count(self, machine_list):
         """Get a Dictionary of required VM Types with how many of that type running.
@@ -928,7 +1316,7 @@ class ResourcePool(object):
         """
         count = defaultdict(int)
         for vm in machine_list:
-            if vm.slot_type == "Partitionable" and vm.total_slots != "1":
+            if vm.slot_type == "Partitionable" and str(vm.total_slots) != "1":
                 continue
             if vm.remote_owner:
                 try:
@@ -938,7 +1326,7 @@ class ResourcePool(object):
                 except:
                     log.error("Failed to parse out remote owner on %s", vm.machine_name)
             elif vm.start_req:
-                userexp = re.search(r'(?<=Owner == ")\w+', vm.start_req)
+                userexp = re.search(r'(?<=Owner == ")\w+', str(vm.start_req))
                 if userexp:
                     user = userexp.group(0)
                     vmusertype = ':'.join([user, vm.vmtype])
@@ -962,19 +1350,36 @@ class ResourcePool(object):
         return count
 
     def match_criteria(self, base, criteria):
-        """Determines if the key value pairs in in criteria are in the dictionary."""
-        return criteria == dict(set(base.items()).intersection(set(criteria.items())))
+        """Determines if the attributes named in criteria have the given values on base."""
+        for attribute, value in criteria.iteritems():
+            if getattr(base, attribute, None) != value:
+                return False
+        return True
 
     def find_in_where(self, machine_list, criteria):
-        """Find all the matching entries for given criteria."""
+        """Find all the matching entries for given criteria.
+
+        Answered from the index of the machine snapshot when machine_list is
+        its vm_machines.
+        """
+        snapshot = self.machine_snapshot
+        if machine_list is snapshot.vm_machines:
+            return snapshot.machine_index.find(criteria)
         matches = []
         for machine in machine_list:
-            if self.match_criteria(machine.__dict__, criteria):
+            if self.match_criteria(machine, criteria):
                 matches.append(machine)
         return matches
 
     def find_in_where_fuzzy_hosts(self, machine_list, criteria):
-        """Use the utilities hostname matching"""
+        """Use the utilities hostname matching
+
+        Looks the machine up in the slot grouping of the machine snapshot
+        when machine_list is its vm_machines, instead of checking every slot.
+        """
+        snapshot = self.machine_snapshot
+        if machine_list is snapshot.vm_machines:
+            return snapshot.machine_slots.slots_of(criteria['machine_name'])
         matches = []
         for machine in machine_list:
             if utilities.match_host_with_condor_host(criteria['machine_name'],
@@ -995,32 +1400,58 @@ class ResourcePool(object):
         #return types
 
 
-    def get_vmtypes_count_internal(self):
-        """Get a dictionary of uservmtypes of VMs the scheduler is currently tracking."""
-        types = defaultdict(int)
+    def cluster_vm_totals(self):
+        """The running VM totals (cluster_tools.VMTotals) of the clusters in resources.
+
+        With check_vm_totals set they are compared with a count of the VMs first.
+        """
+        if config_val.getboolean('global', 'check_vm_totals'):
+            self.check_vm_totals()
+        return [cluster.vm_totals for cluster in self.resources]
+
+    def check_vm_totals(self):
+        """Compare the running VM totals of each cluster with a count of its VMs.
+
+        Logs an error and replaces the totals with the count if they differ.
+        Returns True if all the totals were right.
+        """
+        correct = True
         for cluster in self.resources:
-            for vm in cluster.vms:
-                types[vm.uservmtype] += 1
+            with cluster.vms_lock:
+                counted = cluster_tools.VMTotals()
+                for vm in cluster.vms:
+                    counted.add(vm)
+                if counted.summary() != cluster.vm_totals.summary():
+                    log.error("VM totals of %s are off, %s were counted but %s were kept",
+                              cluster.name, counted.summary()[:2], cluster.vm_totals.summary()[:2])
+                    cluster.vm_totals = counted
+                    correct = False
+        return correct
+
+    def _uservmtype_totals(self, index):
+        """{uservmtype: item index of the uservmtype totals, summed over clusters}."""
+        types = defaultdict(int)
+        for totals in self.cluster_vm_totals():
+            with totals.lock:
+                for uservmtype, counts in totals.uservmtypes.iteritems():
+                    types[uservmtype] += counts[index]
         return types
 
+    def get_vmtypes_count_internal(self):
+        """Get a dictionary of uservmtypes of VMs the scheduler is currently tracking."""
+        return self._uservmtype_totals(0)
+
     def get_vmtypes_count_cpu_slots(self):
         """Get a dictionary of uservmtypes of VMs the scheduler is currently tracking."""
-        types = defaultdict(int)
-        for cluster in self.resources:
-            for vm in cluster.vms:
-                if vm.job_per_core:
-                    types[vm.uservmtype] += vm.cpucores
-                else:
-                    types[vm.uservmtype] += 1
-        return types
+        return self._uservmtype_totals(4)
 
     def get_vm_count_user(self, user):
         """Get a count of the number of VMs for specified user."""
         count = 0
-        for cluster in self.resources:
-            for vm in cluster.vms:
-                if vm.user == user:
-                    count += 1
+        for totals in self.cluster_vm_totals():
+            counts = totals.users.get(user)
+            if counts:
+                count += counts[0]
         return count
 
     def vm_count(self):
@@ -1118,13 +1549,13 @@ class ResourcePool(object):
         Counts up how much/many of each resource (RAM, Cores, Storage)
         are being used by each type of VM
         """
-        types = defaultdict(list)
-        for cluster in self.resources:
-            for vm in cluster.vms:
-                types[vm.uservmtype].append([vm.memory, vm.cpucores, vm.storage])
         results = {}
-        for vmtype in types.keys():
-            results[vmtype] = [sum(values) for values in zip(*types[vmtype])]
+        for totals in self.cluster_vm_totals():
+            with totals.lock:
+                for vmtype, counts in totals.uservmtypes.iteritems():
+                    usage = results.setdefault(vmtype, [0, 0, 0])
+                    for i in range(3):
+                        usage[i] += counts[i + 1]
         return results
 
     def vmtype_resource_usage_sim(self, vmcount):
@@ -1251,7 +1682,7 @@ class ResourcePool(object):
         self.retired_resources = old_retired_resources
 
         empty_vm = cluster_tools.VM()
-        empty_vm_key_set = set(empty_vm.__dict__)
+        empty_vm_key_set = set(empty_vm.__getstate__())
 
         for old_cluster in old_resources:
             old_cluster.setup_logging()
@@ -1268,10 +1699,10 @@ class ResourcePool(object):
                         new_cluster.resource_checkout(vm)
                         try:
                             # Add any new attributes to VM object loaded from pickle
-                            vm_key_set = set(vm.__dict__)
+                            vm_key_set = set(vm.__getstate__())
                             key_diff = empty_vm_key_set - vm_key_set
                             while len(key_diff) > 0:
-                                vm.__dict__[key_diff.pop()] = None
+                                setattr(vm, key_diff.pop(), None)
                         except Exception as e:
                             log.exception("Exception appending new keys %s", e)
                         new_cluster.vms.append(vm)
@@ -1280,11 +1711,11 @@ class ResourcePool(object):
                         if config_val.getboolean('global', 'retire_reallocate'):
                             if old_cluster not in self.retired_resources:
                                 old_cluster_copy = copy.deepcopy(old_cluster)
-                                old_cluster_copy.vms = []
+                                old_cluster_copy.vms = cluster_tools.VMList()
                                 old_cluster_copy.vms.append(vm)
                                 self.retired_resources.append(old_cluster_copy)
                             else:
-                                old_copy = self.retired_resources.get_cluster(old_cluster.name)
+                                old_copy = self.get_cluster(old_cluster.name, True)
                                 old_copy.vms.append(vm)
                             vm.return_resources = False
                             self.force_retire_vm(vm)
@@ -1355,6 +1786,7 @@ class ResourcePool(object):
                             self.banned_job_resource[img].append(entry.name)
                             banned_changed = True
             if banned_changed:
+                self.ban_generation += 1
                 self.save_banned_job_resource()
                 log.verbose("Updating Banned job file")
 
@@ -1422,6 +1854,7 @@ class ResourcePool(object):
                                 if foundit:
                                     break
             self.banned_job_resource = updated_ban
+            self.ban_generation += 1
 
     def load_user_limits(self, path=None):
         limit_file = None
@@ -1465,7 +1898,7 @@ class ResourcePool(object):
             return {}
         return cloud_alias
 
-    def do_condor_off(self, machine_name, machine_addr, master_addr):
+    def do_condor_off_local(self, machine_name, machine_addr, master_addr):
         """Perform a condor_off on an execute node.
 
         Executes multiple commands to condor in order to peacefully stop the start deamon
@@ -1477,7 +1910,7 @@ class ResourcePool(object):
         Return:
             a 3 tuple of the returncodes from the 2 commands used and a return code
         """
-        log.debug("cloud_management.py::do_condor_off: %s, addr: %s, master_addr: %s",
+        log.debug("cloud_management.py::do_condor_off_local: %s, addr: %s, master_addr: %s",
                   machine_name, machine_addr, master_addr)
         cmd2 = '%s -peaceful -addr "%s" -subsystem startd' %\
                (config_val.get('global', 'condor_off_command'), machine_addr)
@@ -1540,10 +1973,8 @@ class ResourcePool(object):
         # Send condor_off to startd first
         try:
             log.debug(" ".join(args2))
-            sp1 = subprocess.Popen(args2, shell=False,
-                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if not utilities.check_popen_timeout(sp1):
-                (out, err) = sp1.communicate(input=None)
+            sp1 = command_runner.run_command(args2)
+            (out, err) = (sp1.stdout, sp1.stderr)
             ret1 = -1
             if out.startswith("Sent"):
                 ret1 = 0
@@ -1552,8 +1983,8 @@ class ResourcePool(object):
             else:
                 log.debug("Failed to send condor_off startd to %s: Reason: %s. Err: %s",
                           machine_name, out, err)
-        except OSError, e:
-            log.error("Problem running %s, got errno %d \"%s\"", ' '.join(args2), e.errno, e.strerror)
+        except command_runner.CommandError, e:
+            log.error("%s", e)
             return (-1, -1, -1, -1)
         except:
             log.error("Problem running %s, unexpected error", ' '.join(args2))
@@ -1561,10 +1992,8 @@ class ResourcePool(object):
         # Now send the master off
         try:
             log.debug(" ".join(args3))
-            sp2 = subprocess.Popen(args3, shell=False,
-                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if not utilities.check_popen_timeout(sp2):
-                (out, err) = sp2.communicate(input=None)
+            sp2 = command_runner.run_command(args3)
+            (out, err) = (sp2.stdout, sp2.stderr)
             ret2 = -1
             if out.startswith("Sent"):
                 ret2 = 0
@@ -1573,14 +2002,59 @@ class ResourcePool(object):
             else:
                 log.debug("Failed to send condor_off master to %s : Reason: %s : Error: %s",
                           machine_name, out, err)
-        except OSError, e:
-            log.error("Problem running %s, got errno %d \"%s\"", ' '.join(args3), e.errno, e.strerror)
+        except command_runner.CommandError, e:
+            log.error("%s", e)
             return (-1, -1, -1, -1)
         except:
             log.error("Problem running %s, unexpected error", ' '.join(args3))
             return (-1, -1, -1, -1)
         return (sp1.returncode, ret1, sp2.returncode, ret2)
 
+    def do_condor_off_bindings(self, machine_name, machine_addr, master_addr):
+        """Perform a peaceful condor_off of the startd and master of an execute
+        node through the htcondor bindings.
+
+        Keywords:
+            machine_name - the condor machine name to condor_off
+            machine_addr - the condor machine addr to condor_off
+        Return:
+            a 4 tuple like do_condor_off_local, 0 for each step that succeeded
+        """
+        log.debug("cloud_management.py::do_condor_off_bindings: %s, addr: %s, master_addr: %s",
+                  machine_name, machine_addr, master_addr)
+        if machine_addr is None or master_addr is None:
+            log.debug("Start or Master Addr is None for Machine: %s cannot do condor_off.",
+                      machine_name)
+            return (-1, -1, -1, -1)
+        ret1 = 0 if condor_bindings.condor_off(machine_addr, "STARTD") else -1
+        ret2 = 0 if condor_bindings.condor_off(master_addr, "MASTER") else -1
+        return (ret1, ret1, ret2, ret2)
+
+    def retire_machines(self, addresses):
+        """Peacefully condor_off the startd and master of several execute nodes.
+
+        The machines are handed out to condor_off_workers threads, each
+        running do_condor_off for one machine at a time.
+
+        Keywords:
+            addresses - list of (machine name, startd address, master address)
+                        triples, the name is only used in log messages
+        Return:
+            a list of booleans in the order of addresses, True for the
+            machines where both condor_offs succeeded
+        """
+        def retire(machine):
+            (machine_name, startd_addr, master_addr) = machine
+            (_, ret2, _, ret22) = self.do_condor_off(machine_name, startd_addr, master_addr)
+            return ret2 == 0 and ret22 == 0
+
+        results = [bool(retired) for retired in
+                   utilities.threaded_map(retire, addresses,
+                                          config_val.getint('global', 'condor_off_workers'),
+                                          name="CondorOff")]
+        log.verbose("Retired %d of %d machines", results.count(True), len(addresses))
+        return results
+
     def do_condor_advertise_master(self, target_file):
         """Perform a condor_advertise INVALIDATE_MASTER_ADS on condor pool.
 
@@ -1594,7 +2068,7 @@ class ResourcePool(object):
         """
         log.debug("cloud_management.py::do_advertise_master - target_file: %s", target_file)
 
-        cmd = '%s INVALIDATE_MASTER_ADS "%s"' %\
+        cmd = '%s -multiple INVALIDATE_MASTER_ADS "%s"' %\
               (config_val.get('global', 'condor_advertise_command'), target_file)
         args = []
 
@@ -1611,14 +2085,13 @@ class ResourcePool(object):
             args.append(cmd)
         else:
             args.append(config_val.get('global', 'condor_advertise_command'))
+            args.append('-multiple')
             args.append('INVALIDATE_MASTER_ADS')
             args.append(target_file)
         try:
             log.debug(" ".join(args))
-            sp1 = subprocess.Popen(args, shell=False,
-                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if not utilities.check_popen_timeout(sp1):
-                (out, err) = sp1.communicate(input=None)
+            sp1 = command_runner.run_command(args)
+            (out, err) = (sp1.stdout, sp1.stderr)
             ret1 = -1
             if out.startswith("Sent"):
                 ret1 = 0
@@ -1627,8 +2100,8 @@ class ResourcePool(object):
             else:
                 log.debug("Failed to send condor_advertise invalidate_master_ads %s: Reason: %s. Err: %s",
                           target_file, out, err)
-        except OSError, e:
-            log.error("Problem running %s, got errno %d \"%s\"", ' '.join(args), e.errno, e.strerror)
+        except command_runner.CommandError, e:
+            log.error("%s", e)
             return (-1, -1)
         except:
             log.error("Problem running %s, unexpected error", ' '.join(args))
@@ -1649,7 +2122,7 @@ class ResourcePool(object):
         """
         log.debug("cloud_management.py::do_advertise_startd - target_file: %s", target_file)
 
-        cmd = '%s INVALIDATE_STARTD_ADS "%s"' % \
+        cmd = '%s -multiple INVALIDATE_STARTD_ADS "%s"' % \
               (config_val.get('global', 'condor_advertise_command'), target_file)
         args = []
 
@@ -1666,14 +2139,13 @@ class ResourcePool(object):
             args.append(cmd)
         else:
             args.append(config_val.get('global', 'condor_advertise_command'))
+            args.append('-multiple')
             args.append('INVALIDATE_STARTD_ADS')
             args.append(target_file)
         try:
             log.debug(" ".join(args))
-            sp1 = subprocess.Popen(args, shell=False,
-                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if not utilities.check_popen_timeout(sp1):
-                (out, err) = sp1.communicate(input=None)
+            sp1 = command_runner.run_command(args)
+            (out, err) = (sp1.stdout, sp1.stderr)
             ret1 = -1
             if out.startswith("Sent"):
                 ret1 = 0
@@ -1682,8 +2154,8 @@ class ResourcePool(object):
             else:
                 log.debug("Failed to send condor_advertise invalidate_startd_ads %s: Reason: %s. Err: %s",
                           target_file, out, err)
-        except OSError, e:
-            log.error("Problem running %s, got errno %d \"%s\"", ' '.join(args), e.errno, e.strerror)
+        except command_runner.CommandError, e:
+            log.error("%s", e)
             return (-1, -1)
         except:
             log.error("Problem running %s, unexpected error", ' '.join(args))
@@ -1691,6 +2163,46 @@ class ResourcePool(object):
 
         return (sp1.returncode, ret1)
 
+    def invalidate_machine_ads(self, machines):
+        """Remove the startd and master ads of machines from the condor pool.
+
+        All the ads are invalidated with one condor_advertise for the masters
+        and one for the startds. Ads invalidated in the last
+        INVALIDATED_AD_MEMORY seconds are left out, the collector may still
+        be listing them.
+
+        Keywords:
+            machines - VMMachine objects whose ads should be removed
+        """
+        now = time.time()
+        for key, when in self.invalidated_ads.items():
+            if now - when > self.INVALIDATED_AD_MEMORY:
+                del self.invalidated_ads[key]
+
+        masters = set()
+        startds = set()
+        for machine in machines:
+            if ("MASTER", machine.machine_name) not in self.invalidated_ads:
+                masters.add(machine.machine_name)
+            if ("STARTD", machine.name) not in self.invalidated_ads:
+                startds.add(machine.name)
+
+        for subsystem, names, advertise in (("MASTER", masters, self.do_condor_advertise_master),
+                                            ("STARTD", startds, self.do_condor_advertise_startd)):
+            if not names:
+                continue
+            target_file = self.create_condor_advertise_target_file(sorted(names))
+            try:
+                (ret1, ret2) = advertise(target_file)
+            finally:
+                os.remove(target_file)
+            if ret1 != 0 or ret2 != 0:
+                log.error("Problem sending condor_advertise for %d %s ads: %i %i",
+                          len(names), subsystem.lower(), ret1, ret2)
+                continue
+            for name in names:
+                self.invalidated_ads[(subsystem, name)] = now
+
     def create_condor_advertise_target_file(self, names=[]):
         """Creates a file with the correct format for condor_advertise to remove classads
         File will contain:
@@ -1717,74 +2229,35 @@ class ResourcePool(object):
 
     def find_vm_with_name(self, condor_name):
         """Find a VM in cloudscheduler with the given condor machine name(hostname)."""
-        found_it = False
-        vm_match = None
         if len(condor_name.split('@')) > 1:
             condor_name = condor_name.split('@')[1]
-        for cluster in self.resources:
-            for vm in cluster.vms:
-                if utilities.match_host_with_condor_host(vm.hostname, condor_name) or \
-                  utilities.match_host_with_condor_host(vm.alt_hostname, condor_name) or \
-                  utilities.match_host_with_condor_host(vm.condormasteraddr, condor_name) or \
-                  utilities.match_host_with_condor_host(vm.condorname, condor_name):
-                    found_it = True
-                    vm_match = vm
-                    break
-            if found_it:
-                break
-        if not found_it:
-            log.verbose("Could not find a VM with name: %s, checking retired_resources.", condor_name)
-            for cluster in self.retired_resources:
-                for vm in cluster.vms:
-                    if utilities.match_host_with_condor_host(vm.condorname, condor_name) or \
-                      utilities.match_host_with_condor_host(vm.hostname, condor_name) or \
-                      utilities.match_host_with_condor_host(vm.condormasteraddr, condor_name) or \
-                      utilities.match_host_with_condor_host(vm.alt_hostname, condor_name):
-                        found_it = True
-                        vm_match = vm
-                        break
-                if found_it:
-                    break
-        return vm_match
+        self.vm_index.refresh(self.resources, self.retired_resources)
+        for vm, _, retired in self.vm_index.name_candidates(condor_name):
+            if utilities.match_host_with_condor_host(vm.hostname, condor_name) or \
+              utilities.match_host_with_condor_host(vm.alt_hostname, condor_name) or \
+              utilities.match_host_with_condor_host(vm.condormasteraddr, condor_name) or \
+              utilities.match_host_with_condor_host(vm.condorname, condor_name):
+                if retired:
+                    log.verbose("Found VM with name: %s in retired_resources.", condor_name)
+                return vm
+        log.verbose("Could not find a VM with name: %s", condor_name)
+        return None
 
     def find_cluster_with_vm(self, condor_name):
         """Find which cluster holds a VM with the given condor machine name(hostname)."""
-        found_it = False
-        cluster_match = None
-        vm_match = None
-        for cluster in self.resources:
-            for vm in cluster.vms:
-                if vm.condorname == condor_name:
-                    found_it = True
-                    cluster_match = cluster
-                    vm_match = vm
-                    break
-            if found_it:
-                break
-        return (cluster_match, vm_match)
+        self.vm_index.refresh(self.resources, self.retired_resources)
+        for vm, cluster, retired in self.vm_index.by_name.get(condor_name, ()):
+            if not retired and vm.condorname == condor_name:
+                return (cluster, vm)
+        return (None, None)
 
     def find_vm_with_addr(self, condor_addr):
         """Find a VM with the given condor address."""
-        found_it = False
-        vm_match = None
-        for cluster in self.resources:
-            for vm in cluster.vms:
-                if vm.condoraddr == condor_addr:
-                    found_it = True
-                    vm_match = vm
-                    break
-            if found_it:
-                break
-        if not found_it:
-            for cluster in self.retired_resources:
-                for vm in cluster.vms:
-                    if vm.condoraddr == condor_addr:
-                        found_it = True
-                        vm_match = vm
-                        break
-                if found_it:
-                    break
-        return vm_match
+        self.vm_index.refresh(self.resources, self.retired_resources)
+        for vm, _, _ in self.vm_index.by_addr.get(condor_addr, ()):
+            if vm.condoraddr == condor_addr:
+                return vm
+        return None
 
     def retiring_vms_of_type(self, vmtype):
         """Get a list of the VMs in the Retiring state of the given type."""
@@ -1799,11 +2272,8 @@ class ResourcePool(object):
     def retiring_vms_of_usertype(self, vmtype):
         """Get a list of the VMs in the Retiring state of the given usertype."""
         retiring = []
-        for cluster in self.resources:
-            for vm in cluster.vms:
-                if vm.uservmtype == vmtype:
-                    if vm.override_status == 'Retiring':
-                        retiring.append(vm)
+        for totals in self.cluster_vm_totals():
+            retiring.extend(totals.in_state(vmtype, "Retiring"))
         return retiring
 
     def get_starting_of_type(self, vmtype):
@@ -1830,21 +2300,15 @@ class ResourcePool(object):
     def get_starting_of_usertype(self, vmtype):
         """Get a list of the VMs in the Starting state of the given usertype."""
         starting = []
-        for cluster in self.resources:
-            for vm in cluster.vms:
-                if vm.uservmtype == vmtype:
-                    if vm.status == "Starting" or vm.status == "Unpropagated":
-                        starting.append(vm)
+        for totals in self.cluster_vm_totals():
+            starting.extend(totals.in_state(vmtype, "Starting"))
         return starting
 
     def get_error_of_usertype(self, vmtype):
         """Get a list of the VMs in the Error state of the given usertype."""
         error = []
-        for cluster in self.resources:
-            for vm in cluster.vms:
-                if vm.uservmtype == vmtype:
-                    if vm.status == "Error":
-                        error.append(vm)
+        for totals in self.cluster_vm_totals():
+            error.extend(totals.in_state(vmtype, "Error"))
         return error
 
     def get_all_vms(self):
@@ -2168,61 +2632,53 @@ class ResourcePool(object):
             at_limit = True
         return at_limit
 
-    def machinelist_to_vmmachinelist(self, machinelist, master_machinelist):
-        vm_machine_list = []
-        master_machine_ips = {}
-        for master in master_machinelist:
-            try:
-                master_machine_ips[master['Machine']] = master['MasterIpAddr']
-            except:
-                log.warning('could not read master ip addr')
-        for machine in machinelist:
+    def machine_query(self):
+        """
+        machine_query -- query the condor collector for startd and master ads
+
+        Runs master_resource_query_local in a second thread while
+        resource_query runs, so a cycle takes as long as the slower of the
+        two queries.
+
+        Returns the list of VMMachine objects with address_master set.
+        """
+        master_addresses = {}
+
+        def query_masters():
             try:
-                name = machine_name = job_id = global_job_id = address_startd = \
-                     address_master = state = activity = vmtype = start_req = \
-                     remote_owner = slot_type = total_slots = ""
-                current_time = entered_state_time = -1
-                if machine.has_key('Name'):
-                    name = machine['Name']
-                if machine.has_key('Machine'):
-                    machine_name = machine['Machine']
-                if machine.has_key('JobId'):
-                    job_id = machine['JobId']
-                if machine.has_key('GlobalJobId'):
-                    global_job_id = machine['GlobalJobId']
-                if machine.has_key('MyAddress'):
-                    address_startd = machine['MyAddress']
-                if machine.has_key('State'):
-                    state = machine['State']
-                if machine.has_key('Activity'):
-                    activity = machine['Activity']
-                if machine.has_key('VMType'):
-                    vmtype = machine['VMType']
-                if machine.has_key('MyCurrentTime'):
-                    current_time = machine['MyCurrentTime']
-                if machine.has_key('EnteredCurrentState'):
-                    entered_state_time = machine['EnteredCurrentState']
-                if machine.has_key('Start'):
-                    start_req = machine['Start']
-                if machine.has_key('RemoteOwner'):
-                    remote_owner = machine['RemoteOwner']
-                if master_machine_ips.has_key(machine['Machine']):
-                    address_master = master_machine_ips[machine['Machine']]
-                if machine.has_key('SlotType'):
-                    slot_type = machine['SlotType']
-                if machine.has_key('TotalSlots'):
-                    total_slots = machine['TotalSlots']
-                vmmachine = VMMachine(name=name, machine_name=machine_name, job_id=job_id,
-                                      global_job_id=global_job_id, address_startd=address_startd,
-                                      address_master=address_master, state=state, activity=activity,
-                                      vmtype=vmtype, current_time=current_time,
-                                      entered_state_time=entered_state_time, start_req=start_req,
-                                      remote_owner=remote_owner, slot_type=slot_type,
-                                      total_slots=total_slots)
-                vm_machine_list.append(vmmachine)
+                master_addresses.update(self.master_resource_query())
             except:
-                log.warning("Failed to create VMMachine Obj")
-        return vm_machine_list
+                log.exception("Problem querying condor master daemons")
+
+        master_query = threading.Thread(target=query_masters, name="MasterQuery")
+        master_query.daemon = True
+        master_query.start()
+        vm_machines = self.resource_query()
+        master_query.join()
+        self.set_master_addresses(vm_machines, master_addresses)
+        return vm_machines
+
+    def publish_machines(self, vm_machines):
+        """Replace the machine snapshot, the current machines become the previous ones."""
+        self.machine_snapshot = MachineSnapshot(vm_machines, self.machine_snapshot.vm_machines,
+                                                time.time(), MachineSlots(vm_machines),
+                                                MachineIndex(vm_machines))
+
+    @property
+    def vm_machine_list(self):
+        """The machines of the current machine snapshot."""
+        return self.machine_snapshot.vm_machines
+
+    @property
+    def prev_vm_machine_list(self):
+        """The machines of the previous machine snapshot."""
+        return self.machine_snapshot.prev_vm_machines
+
+    @staticmethod
+    def set_master_addresses(vm_machines, master_addresses):
+        """Fill in the address_master of VMMachines from a master_resource_query_local result."""
+        for machine in vm_machines:
+            machine.address_master = master_addresses.get(machine.machine_name, "")
 
     def resolve_target_cloud_alias(self, targets):
         expanded_targets = []
@@ -2292,7 +2748,7 @@ class ResourcePool(object):
                                 break
                             if cluster not in self.retired_resources:
                                 cluster_copy = copy.deepcopy(cluster)
-                                cluster_copy.vms = []
+                                cluster_copy.vms = cluster_tools.VMList()
                                 cluster_copy.vms.append(vm)
                                 self.retired_resources.append(cluster_copy)
                             else:
@@ -2393,8 +2849,26 @@ class VMMachine(object):
     entered_state_time - time that machine entered the current state/activity
     start_req - the Start expression of the machine in condor
     remote_owner - the user running jobs on the machine
+    slot_type - the SlotType of the machine, Static, Partitionable or Dynamic
+    total_slots - number of slots on the machine
     """
 
+    __slots__ = ('name', 'machine_name', 'job_id', 'global_job_id', 'address_startd',
+                 'address_master', 'state', 'activity', 'vmtype', 'current_time',
+                 'entered_state_time', 'start_req', 'remote_owner', 'slot_type', 'total_slots')
+
+    # Machine classad attribute -> VMMachine attribute
+    CLASSAD_ATTRIBUTES = {'Name': 'name', 'Machine': 'machine_name', 'JobId': 'job_id',
+                          'GlobalJobId': 'global_job_id', 'MyAddress': 'address_startd',
+                          'State': 'state', 'Activity': 'activity', 'VMType': 'vmtype',
+                          'MyCurrentTime': 'current_time',
+                          'EnteredCurrentState': 'entered_state_time', 'Start': 'start_req',
+                          'RemoteOwner': 'remote_owner', 'SlotType': 'slot_type',
+                          'TotalSlots': 'total_slots'}
+    # Attributes taking the same few values on every machine, they are
+    # interned so all machines share one copy of each value.
+    INTERNED_ATTRIBUTES = frozenset(('state', 'activity', 'vmtype', 'slot_type'))
+
     def __init__(self, name="", machine_name="", job_id="", global_job_id="",
                  address_startd="", address_master="", state="", activity="",
                  vmtype="", current_time=0, entered_state_time=0, start_req="",
@@ -2416,6 +2890,18 @@ class VMMachine(object):
         self.total_slots = total_slots
 
 
+    @classmethod
+    def from_classad(cls, classad):
+        """Create a VMMachine from a dictionary of machine classad attributes."""
+        machine = cls(current_time=-1, entered_state_time=-1)
+        for classad_key, attribute in cls.CLASSAD_ATTRIBUTES.iteritems():
+            if classad_key in classad:
+                value = classad[classad_key]
+                if attribute in cls.INTERNED_ATTRIBUTES and isinstance(value, str):
+                    value = intern(value)
+                setattr(machine, attribute, value)
+        return machine
+
     def get_uservmtype(self):
         return ''.join([self.remote_owner, self.vmtype])
 
@@ -15,9 +15,11 @@ import time
 import uuid
 import string
 import logging
+import weakref
 import datetime
 import threading
 import requests
+from collections import OrderedDict
 
 from cloudscheduler import config
 import cloudscheduler.utilities as utilities
@@ -26,6 +28,226 @@ from cloudscheduler.utilities import get_cert_expiry_time
 log = utilities.get_cloudscheduler_logger()
 config_val = config.setup()
 
+# Bumped whenever a VM is added to or removed from a cluster's vms, or one of
+# the names VMs are looked up by changes. Indexes over the VMs (see
+# cloud_management.VMIndex) compare it to tell when they are out of date.
+vm_generation = 0
+
+
+def vms_changed():
+    """Note a change to the VMs of the clusters, see vm_generation."""
+    global vm_generation
+    vm_generation += 1
+
+# Bumped whenever one of the attributes of a cluster that decide which VMs
+# fit on it changes (ICluster.CAPACITY_NAMES), as resources are checked out
+# and returned for instance. cloud_management.ClusterFitter compares it to
+# tell when the clusters it found for a VM are out of date.
+resource_generation = 0
+
+
+def resources_changed():
+    """Note a change to the capacity of the clusters, see resource_generation."""
+    global resource_generation
+    resource_generation += 1
+
+
+class VMTotals(object):
+    """
+    Running totals of the VMs of a cluster, kept up to date by VMList as VMs
+    join and leave the cluster and by VM as their counted attributes change.
+
+    users       - {user: [count, memory, cores, storage]}
+    uservmtypes - {uservmtype: [count, memory, cores, storage, slots]}
+    states      - {(uservmtype, state): OrderedDict of the VMs in state}, for
+                  the states 'Starting' (including Unpropagated), 'Error'
+                  and 'Retiring' (override_status)
+    """
+    __slots__ = ('lock', 'users', 'uservmtypes', 'states')
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.users = {}
+        self.uservmtypes = {}
+        self.states = {}
+
+    @staticmethod
+    def vm_states(vm):
+        """The states of vm counted in states."""
+        states = []
+        if vm.status == "Starting" or vm.status == "Unpropagated":
+            states.append("Starting")
+        elif vm.status == "Error":
+            states.append("Error")
+        if vm.override_status == "Retiring":
+            states.append("Retiring")
+        return states
+
+    @staticmethod
+    def _count(totals, key, values):
+        counts = totals.get(key)
+        if counts is None:
+            counts = totals[key] = [0] * len(values)
+        for i, value in enumerate(values):
+            counts[i] += value
+        if counts[0] == 0:
+            del totals[key]
+
+    def _apply(self, vm, sign):
+        memory, cores, storage = vm.memory or 0, vm.cpucores or 0, vm.storage or 0
+        slots = cores if vm.job_per_core else 1
+        self._count(self.users, vm.user, (sign, sign * memory, sign * cores, sign * storage))
+        self._count(self.uservmtypes, vm.uservmtype,
+                    (sign, sign * memory, sign * cores, sign * storage, sign * slots))
+        for state in self.vm_states(vm):
+            key = (vm.uservmtype, state)
+            if sign > 0:
+                self.states.setdefault(key, OrderedDict())[vm] = None
+            else:
+                vms = self.states.get(key)
+                if vms is not None:
+                    vms.pop(vm, None)
+                    if not vms:
+                        del self.states[key]
+
+    def add(self, vm):
+        """Count vm."""
+        with self.lock:
+            self._apply(vm, 1)
+
+    def remove(self, vm):
+        """Stop counting vm."""
+        with self.lock:
+            self._apply(vm, -1)
+
+    def update(self, vm, name, value):
+        """Set attribute name of counted vm to value, adjusting the totals."""
+        with self.lock:
+            self._apply(vm, -1)
+            object.__setattr__(vm, name, value)
+            self._apply(vm, 1)
+
+    def in_state(self, uservmtype, state):
+        """The VMs of uservmtype in state, in the order they entered it."""
+        with self.lock:
+            return list(self.states.get((uservmtype, state), ()))
+
+    def summary(self):
+        """The totals as plain values, to compare two VMTotals."""
+        with self.lock:
+            return (dict((user, list(counts)) for user, counts in self.users.iteritems()),
+                    dict((uvt, list(counts)) for uvt, counts in self.uservmtypes.iteritems()),
+                    dict((key, set(vms)) for key, vms in self.states.iteritems()))
+
+
+class VMList(list):
+    """
+    The vms list of a cluster. Points the cluster back reference of the VMs
+    put in it (VM.cluster) at the cluster owning the list, counts them in its
+    vm_totals, and notes every change with vms_changed().
+    """
+
+    def __init__(self, vms=(), owner=None):
+        list.__init__(self, vms)
+        self.owner = None
+        if owner is not None:
+            self.set_owner(owner)
+
+    def __reduce__(self):
+        # The owner isn't pickled, the cluster unpickling the list sets it
+        return (VMList, (list(self),))
+
+    def set_owner(self, owner):
+        """Make owner (a cluster, or None) the cluster the VMs in the list belong to."""
+        self._release(self)
+        self.owner = weakref.ref(owner) if owner is not None else None
+        self._adopt(self)
+
+    def _adopt(self, vms):
+        owner = self.owner() if self.owner is not None else None
+        if owner is None:
+            return
+        for vm in vms:
+            if vm._cluster is self.owner:
+                continue
+            previous = vm.cluster
+            if previous is not None:
+                previous.vm_totals.remove(vm)
+            vm._cluster = self.owner
+            owner.vm_totals.add(vm)
+
+    def _release(self, vms):
+        # Only if the VM wasn't added to another cluster in the meantime
+        owner = self.owner() if self.owner is not None else None
+        if owner is None:
+            return
+        for vm in vms:
+            if vm._cluster is self.owner:
+                vm._cluster = None
+                owner.vm_totals.remove(vm)
+
+    def append(self, vm):
+        list.append(self, vm)
+        self._adopt((vm,))
+        vms_changed()
+
+    def extend(self, vms):
+        vms = list(vms)
+        list.extend(self, vms)
+        self._adopt(vms)
+        vms_changed()
+
+    def insert(self, index, vm):
+        list.insert(self, index, vm)
+        self._adopt((vm,))
+        vms_changed()
+
+    def remove(self, vm):
+        list.remove(self, vm)
+        self._release((vm,))
+        vms_changed()
+
+    def pop(self, *index):
+        vm = list.pop(self, *index)
+        self._release((vm,))
+        vms_changed()
+        return vm
+
+    def __setitem__(self, index, vm):
+        if isinstance(index, slice):
+            old, new = list.__getitem__(self, index), list(vm)
+            list.__setitem__(self, index, new)
+        else:
+            old, new = [list.__getitem__(self, index)], [vm]
+            list.__setitem__(self, index, vm)
+        self._release(old)
+        self._adopt(new)
+        vms_changed()
+
+    def __delitem__(self, index):
+        old = list.__getitem__(self, index)
+        list.__delitem__(self, index)
+        self._release(old if isinstance(index, slice) else (old,))
+        vms_changed()
+
+    def __setslice__(self, i, j, vms):
+        old, new = list.__getslice__(self, i, j), list(vms)
+        list.__setslice__(self, i, j, new)
+        self._release(old)
+        self._adopt(new)
+        vms_changed()
+
+    def __delslice__(self, i, j):
+        old = list.__getslice__(self, i, j)
+        list.__delslice__(self, i, j)
+        self._release(old)
+        vms_changed()
+
+    def __iadd__(self, vms):
+        self.extend(vms)
+        return self
+
+
 class VM(object):
     """
     A class for storing created VM information. Used to populate Cluster classes
@@ -42,6 +264,26 @@ class VM(object):
     maps specific cloud software state to these global states.
     """
 
+    # VMs use __slots__ instead of a per-instance __dict__. New attributes
+    # must be added here as well as in __init__.
+    __slots__ = ('name', 'id', 'vmtype', 'user', 'uservmtype', 'hostname', 'alt_hostname',
+                 'ipaddress', 'condorname', 'condoraddr', 'condormasteraddr', 'clusteraddr',
+                 'clusterport', 'cloudtype', 'network', 'image', 'memory', 'flavor', 'cpucores',
+                 'storage', 'errorcount', 'errorconnect', 'lastpoll', 'last_state_change',
+                 'initialize_time', 'startup_time', 'keep_alive', 'idle_start', 'spot_id',
+                 'proxy_file', 'myproxy_creds_name', 'myproxy_server', 'myproxy_server_port',
+                 'myproxy_renew_time', 'override_status', 'job_per_core', 'force_retire',
+                 'return_resources', 'failed_retire', 'job_run_times',
+                 'x509userproxy_expiry_time', 'ssh_port', 'status', '_cluster')
+
+    # Names VMs are looked up by, changing one calls vms_changed()
+    INDEXED_NAMES = frozenset(['hostname', 'alt_hostname', 'condorname', 'condoraddr',
+                               'condormasteraddr'])
+    # Attributes counted in the VMTotals of the VM's cluster
+    TOTALED_NAMES = frozenset(['user', 'uservmtype', 'memory', 'cpucores', 'storage',
+                               'job_per_core', 'status', 'override_status'])
+    WATCHED_NAMES = INDEXED_NAMES | TOTALED_NAMES
+
     def __init__(self, name="", id="", vmtype="", user="",
                  hostname="", ipaddress="", clusteraddr="", clusterport="",
                  cloudtype="", network="public",
@@ -80,6 +322,8 @@ class VM(object):
                                   this VM should be returned to cluster
         ssh_port - (int) the ssh port of the VM
         """
+        # Weak reference to the cluster the VM is in, kept by VMList
+        self._cluster = None
         self.name = name
         self.id = id
         self.vmtype = vmtype
@@ -132,6 +376,41 @@ class VM(object):
                     id, clusteraddr, image, memory)
         log.info("Created VM cloud: %s id: %s", clusteraddr, self.id)
 
+    def __setattr__(self, name, value):
+        if name in VM.WATCHED_NAMES and getattr(self, name, None) != value:
+            if name in VM.INDEXED_NAMES:
+                vms_changed()
+            else:
+                cluster = self.cluster
+                if cluster is not None:
+                    cluster.vm_totals.update(self, name, value)
+                    return
+        object.__setattr__(self, name, value)
+
+    @property
+    def cluster(self):
+        """The cluster whose vms the VM is in, None if it isn't in one."""
+        return self._cluster() if self._cluster is not None else None
+
+    def __getstate__(self):
+        """Override to work with pickle module."""
+        state = {}
+        for name in self.__slots__:
+            if name != '_cluster' and hasattr(self, name):
+                state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        """Override to work with pickle module.
+        Also loads VMs pickled before VM used __slots__, dropping
+        any attributes VM no longer has. The cluster reference is
+        set again when the VM is put back in a cluster's vms.
+        """
+        self._cluster = None
+        for name, value in state.iteritems():
+            if name in self.__slots__:
+                setattr(self, name, value)
+
     def log(self):
         """Log the VM to the info level."""
         log.info("VM Name: %s, ID: %s, Type: %s, User: %s, Status: %s on %s", self.name, self.id,
@@ -314,7 +593,8 @@ class ICluster(object):
         self.cpu_cores = cpu_cores
         self.storageGB = storage
         self.max_storageGB = storage
-        self.vms = [] # List of running VMs
+        self.vm_totals = VMTotals()
+        self.vms = VMList() # List of running VMs
         self.vms_lock = threading.RLock()
         self.res_lock = threading.RLock()
         self.enabled = enabled
@@ -330,17 +610,34 @@ class ICluster(object):
         self.setup_logging()
         log.debug("New cluster %s created", self.name)
 
+    # Attributes deciding which VMs fit on the cluster and in which order
+    # clusters are picked, changing one calls resources_changed()
+    CAPACITY_NAMES = frozenset(['name', 'enabled', 'priority', 'vm_slots', 'max_slots', 'memory',
+                                'max_vm_mem', 'cpu_cores', 'storageGB'])
+
+    def __setattr__(self, name, value):
+        if name in ICluster.CAPACITY_NAMES and self.__dict__.get(name) != value:
+            resources_changed()
+        object.__setattr__(self, name, value)
+
     def __getstate__(self):
         """Override to work with pickle module."""
         state = self.__dict__.copy()
         del state['vms_lock']
         del state['res_lock']
         del state['failed_image_set']
+        del state['vm_totals']
+        state['vms'] = state.pop('_vms')
         return state
 
     def __setstate__(self, state):
         """Override to work with pickle module."""
+        state = state.copy()
+        vms = state.pop('vms')
         self.__dict__ = state
+        resources_changed()
+        self.vm_totals = VMTotals()
+        self.vms = vms
         self.vms_lock = threading.RLock()
         self.res_lock = threading.RLock()
         self.failed_image_set = set()
@@ -348,6 +645,22 @@ class ICluster(object):
     def __repr__(self):
         return self.name
 
+    @property
+    def vms(self):
+        """The VMs running on the cluster, a VMList owned by the cluster."""
+        return self._vms
+
+    @vms.setter
+    def vms(self, vms):
+        # A VMList is taken over as it is, anything else is copied into one
+        if not isinstance(vms, VMList):
+            vms = VMList(vms)
+        old_vms = self.__dict__.get('_vms')
+        if old_vms is not None and old_vms is not vms:
+            old_vms.set_owner(None)
+        vms.set_owner(self)
+        self._vms = vms
+
     def setup_logging(self):
         """Fetch the global log object."""
         global log
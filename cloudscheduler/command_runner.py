@@ -0,0 +1,248 @@
+"""
+command_runner.py - run the external commands cloud scheduler depends on
+
+All condor and openssl commands are forked through here. run_command waits on
+the child's output pipes with poll() rather than sleeping and checking on it,
+so a command is done with as soon as it exits, stdout and stderr are drained
+together so neither can fill up and block the child, and a command still
+running at its deadline is terminated, then killed if it ignores that.
+stream_command is for long outputs (condor_q) that are parsed as they arrive.
+
+The number of runs, failures, timeouts and the time spent in each command are
+kept and can be read with command_stats().
+"""
+import os
+import time
+import errno
+import select
+import signal
+import logging
+import tempfile
+import threading
+import subprocess
+from collections import namedtuple
+
+log = logging.getLogger("cloudscheduler")
+
+# Seconds a command may run if the caller doesn't say otherwise
+DEFAULT_TIMEOUT = 180
+# Seconds a command gets to exit after SIGTERM before it is sent SIGKILL
+KILL_GRACE = 5
+READ_SIZE = 65536
+
+
+class CommandError(Exception):
+    """A command could not be started, or a streamed command failed."""
+    pass
+
+
+class CommandResult(namedtuple('CommandResult',
+                               ['args', 'returncode', 'stdout', 'stderr', 'elapsed', 'timed_out'])):
+    """The outcome of run_command, returncode is negative if it was killed."""
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        """True if the command finished in time with a zero return code."""
+        return self.returncode == 0 and not self.timed_out
+
+
+class CommandStats(object):
+    """Counts and timings of the runs of one command."""
+    __slots__ = ['runs', 'failures', 'timeouts', 'total_time', 'max_time']
+
+    def __init__(self):
+        self.runs = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, elapsed, failed, timed_out):
+        self.runs += 1
+        self.failures += bool(failed)
+        self.timeouts += bool(timed_out)
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+    def as_dict(self):
+        return {'runs': self.runs, 'failures': self.failures, 'timeouts': self.timeouts,
+                'total_time': self.total_time, 'max_time': self.max_time,
+                'mean_time': self.total_time / self.runs if self.runs else 0.0}
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _record(args, elapsed, failed, timed_out):
+    name = os.path.basename(args[0]) if args else ""
+    with _stats_lock:
+        if name not in _stats:
+            _stats[name] = CommandStats()
+        _stats[name].record(elapsed, failed, timed_out)
+
+
+def command_stats():
+    """Return {command name: dict of runs, failures, timeouts and times}."""
+    with _stats_lock:
+        return dict((name, stats.as_dict()) for name, stats in _stats.iteritems())
+
+
+def reset_command_stats():
+    """Forget the statistics gathered so far."""
+    with _stats_lock:
+        _stats.clear()
+
+
+def _wait(process, deadline):
+    """Wait for process to exit until deadline, returns False if it is still running.
+
+    Only used once its output pipes are closed, at which point it is exiting,
+    so the waits between checks start very short.
+    """
+    delay = 0.001
+    while process.poll() is None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.1)
+    return True
+
+
+def _stop(process):
+    """Terminate process, then kill it if it is still around after KILL_GRACE.
+
+    Commands run in their own process group and the whole group is signalled,
+    so children of a wrapper (ssh, sh -c) holding its output open go as well.
+    """
+    if process.poll() is not None:
+        return
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        if not _wait(process, time.time() + KILL_GRACE):
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+    except OSError:
+        # Already gone
+        pass
+
+
+def _start(args, stdout, stderr, env):
+    try:
+        return subprocess.Popen(args, shell=False, stdout=stdout, stderr=stderr,
+                                env=env, close_fds=True, preexec_fn=os.setpgrp)
+    except OSError, e:
+        _record(args, 0.0, True, False)
+        raise CommandError("Could not run %s: errno %d \"%s\"" % (" ".join(args), e.errno, e.strerror))
+
+
+def run_command(args, timeout=DEFAULT_TIMEOUT, env=None):
+    """Run args and return a CommandResult once it exits or timeout seconds pass.
+
+    Raises CommandError if the command could not be started at all.
+    """
+    start = time.time()
+    deadline = start + timeout
+    process = _start(args, subprocess.PIPE, subprocess.PIPE, env)
+
+    out_fd, err_fd = process.stdout.fileno(), process.stderr.fileno()
+    output = {out_fd: [], err_fd: []}
+    poller = select.poll()
+    for fd in output:
+        poller.register(fd, select.POLLIN | select.POLLPRI)
+    open_fds = len(output)
+    timed_out = False
+    try:
+        while open_fds:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                timed_out = True
+                break
+            try:
+                ready = poller.poll(remaining * 1000)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, _ in ready:
+                data = os.read(fd, READ_SIZE)
+                if data:
+                    output[fd].append(data)
+                else:
+                    poller.unregister(fd)
+                    open_fds -= 1
+        if not timed_out:
+            timed_out = not _wait(process, deadline)
+    finally:
+        if process.poll() is None:
+            _stop(process)
+        process.stdout.close()
+        process.stderr.close()
+
+    elapsed = time.time() - start
+    if timed_out:
+        log.error("%s did not finish within %s seconds, it was stopped", " ".join(args), timeout)
+    else:
+        log.debug("%s returned %s after %.3f s", args[0], process.returncode, elapsed)
+    _record(args, elapsed, process.returncode != 0, timed_out)
+    return CommandResult(args, process.returncode, "".join(output[out_fd]),
+                         "".join(output[err_fd]), elapsed, timed_out)
+
+
+def stream_command(args, timeout=DEFAULT_TIMEOUT, env=None):
+    """Start args and return a generator over its stdout lines.
+
+    The command is stopped if it runs past timeout, or if the generator is
+    closed before the output ends. CommandError is raised by the call if the
+    command can't be started, and by the generator after the last line if
+    the command failed or timed out.
+    """
+    # stderr goes to a temporary file so a chatty command can't fill the
+    # pipe and block while stdout is still being read.
+    err = tempfile.TemporaryFile()
+    start = time.time()
+    try:
+        process = _start(args, subprocess.PIPE, err, env)
+    except CommandError:
+        err.close()
+        raise
+    # Ending the command ends its output, the generator finds out from there
+    timed_out = threading.Event()
+    def stop():
+        if process.poll() is None:
+            timed_out.set()
+            _stop(process)
+    timer = threading.Timer(timeout, stop)
+    timer.daemon = True
+    timer.start()
+    return _stream_lines(args, process, err, timer, timed_out, start, timeout)
+
+
+def _stream_lines(args, process, err, timer, timed_out, start, timeout):
+    finished = False
+    try:
+        for line in iter(process.stdout.readline, ""):
+            yield line
+        returncode = process.wait()
+        finished = True
+        elapsed = time.time() - start
+        _record(args, elapsed, returncode != 0, timed_out.is_set())
+        if timed_out.is_set():
+            raise CommandError("%s did not finish within %s seconds, it was stopped" %
+                               (" ".join(args), timeout))
+        if returncode != 0:
+            err.seek(0)
+            raise CommandError("%s returned %s. stderr was: %s" %
+                               (" ".join(args), returncode, err.read()))
+        log.debug("%s returned %s after %.3f s", args[0], returncode, elapsed)
+    finally:
+        timer.cancel()
+        if not finished:
+            # Consumer stopped early or something went wrong, don't leave
+            # the command running behind us.
+            _stop(process)
+            process.wait()
+        process.stdout.close()
+        err.close()
@@ -0,0 +1,136 @@
+"""
+condor_bindings.py - query and control condor through the htcondor Python bindings
+
+Used by the JobPool and ResourcePool when condor_retrieval_method is
+'bindings'. Nothing is forked and no text is parsed: ads come back from the
+schedd and collector as dictionaries with typed values, expressions are
+turned into their string form like the -l and -json parsers do.
+"""
+import time
+from urlparse import urlparse
+from collections import defaultdict
+
+import cloudscheduler.config as config
+import cloudscheduler.utilities as utilities
+
+log = utilities.get_cloudscheduler_logger()
+config_val = config.config_options
+
+try:
+    import htcondor
+    import classad
+except ImportError:
+    htcondor = None
+    classad = None
+
+
+def available():
+    """Return True if the htcondor and classad modules could be imported."""
+    return htcondor is not None and classad is not None
+
+
+def ad_to_dict(ad):
+    """Convert a ClassAd to a dictionary, expressions become strings."""
+    result = {}
+    for key in ad.keys():
+        value = ad[key]
+        if isinstance(value, classad.ExprTree):
+            value = str(value)
+        result[key] = value
+    return result
+
+
+def collector():
+    """Return a Collector for the condor_collector_url host and port."""
+    return htcondor.Collector(urlparse(config_val.get('global', 'condor_collector_url'))[1])
+
+
+def schedd(name=None):
+    """Return the Schedd called name, or the local schedd if name is empty."""
+    if not name:
+        return htcondor.Schedd()
+    return htcondor.Schedd(collector().locate(htcondor.DaemonTypes.Schedd, name))
+
+
+def query_jobs(schedd_name, constraint="true", projection=()):
+    """Generator of the job ads matching constraint in a schedd.
+
+    The schedd doesn't add the ServerTime condor_q puts in its ads, the time
+    the query was started is used instead.
+    """
+    servertime = int(time.time())
+    for ad in schedd(schedd_name).xquery(requirements=constraint, projection=list(projection)):
+        job = ad_to_dict(ad)
+        job.setdefault("ServerTime", servertime)
+        yield job
+
+
+def query_startds(projection=()):
+    """Return the startd ads in the collector as a list of dictionaries."""
+    return [ad_to_dict(ad) for ad in
+            collector().query(htcondor.AdTypes.Startd, "true", list(projection))]
+
+
+def query_masters(projection=()):
+    """Return the master ads in the collector as a list of dictionaries."""
+    return [ad_to_dict(ad) for ad in
+            collector().query(htcondor.AdTypes.Master, "true", list(projection))]
+
+
+# Per job results in the ad returned by Schedd.act
+_ACTION_SUCCESS = 1
+_ACTION_ALREADY_DONE = 4
+
+
+def _act_on_jobs(action, jobs, reason=None):
+    """Apply a JobAction to jobs, one call per schedd the jobs came from.
+
+    Returns the list of jobs the action failed for.
+    """
+    schedd_jobs = defaultdict(list)
+    for job in jobs:
+        schedd_jobs[job.schedd].append(job)
+    failed = []
+    for schedd_name, action_jobs in schedd_jobs.iteritems():
+        ids = ["%s.%s" % (job.cluster_id, job.proc_id) for job in action_jobs]
+        try:
+            if reason:
+                result = schedd(schedd_name).act(action, ids, reason)
+            else:
+                result = schedd(schedd_name).act(action, ids)
+        except Exception:
+            log.exception("Problem sending %s for %d jobs to schedd '%s'", action,
+                          len(ids), schedd_name)
+            failed.extend(action_jobs)
+            continue
+        if int(result.get("TotalSuccess", len(ids))) == len(ids):
+            continue
+        for job in action_jobs:
+            if result.get("job_%s_%s" % (job.cluster_id, job.proc_id)) not in \
+                    (_ACTION_SUCCESS, _ACTION_ALREADY_DONE):
+                failed.append(job)
+    return failed
+
+
+def hold_jobs(jobs, reason=""):
+    """Hold jobs, returns the list of jobs that could not be held."""
+    return _act_on_jobs(htcondor.JobAction.Hold, jobs, reason)
+
+
+def release_jobs(jobs):
+    """Release jobs, returns the list of jobs that could not be released."""
+    return _act_on_jobs(htcondor.JobAction.Release, jobs)
+
+
+def condor_off(address, subsystem):
+    """Peacefully turn off the daemon of subsystem ('STARTD' or 'MASTER') at address.
+
+    Returns True if the command was sent.
+    """
+    try:
+        htcondor.send_command(classad.ClassAd({"MyAddress": address}),
+                              htcondor.DaemonCommands.DaemonOffPeaceful, subsystem)
+    except Exception:
+        log.exception("Problem sending condor_off %s to %s", subsystem, address)
+        return False
+    return True
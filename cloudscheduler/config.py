@@ -19,6 +19,19 @@ def setup(path=None):
        setup will look fora configuration file specified on the command line,
        or in ~/.cloudscheduler.onf or /etc/cloudscheduler.conf
     """
+    global config_options
+    parsed = parse(path)
+    # Without a config file the defaults in config_options are kept
+    if parsed is not None:
+        config_options = parsed
+
+    return parsed
+
+
+def parse(path=None):
+    """Read and check the config file like setup, without making it the
+       config_options used by the rest of cloudscheduler.
+    """
     homedir = os.path.expanduser('~')
 
     #Find the default file
@@ -109,6 +122,70 @@ def setup(path=None):
         print "Configuration file problem: job_ban_timeout must be an integer value"
         sys.exit(1)
 
+    try:
+        condor_q_workers = config_file.getint('global', 'condor_q_workers')
+        if condor_q_workers < 1:
+            config_file.set('global', 'condor_q_workers', '1')
+    except ValueError:
+        print "Configuration file problem: condor_q_workers must be an integer value"
+        sys.exit(1)
+
+    try:
+        chunk_size = config_file.getint('global', 'condor_hold_release_chunk_size')
+        if chunk_size < 1:
+            config_file.set('global', 'condor_hold_release_chunk_size', '1')
+    except ValueError:
+        print "Configuration file problem: condor_hold_release_chunk_size must be an integer value"
+        sys.exit(1)
+
+    try:
+        workers = config_file.getint('global', 'condor_hold_release_workers')
+        if workers < 1:
+            config_file.set('global', 'condor_hold_release_workers', '1')
+    except ValueError:
+        print "Configuration file problem: condor_hold_release_workers must be an integer value"
+        sys.exit(1)
+
+    try:
+        condor_off_workers = config_file.getint('global', 'condor_off_workers')
+        if condor_off_workers < 1:
+            config_file.set('global', 'condor_off_workers', '1')
+    except ValueError:
+        print "Configuration file problem: condor_off_workers must be an integer value"
+        sys.exit(1)
+
+    try:
+        config_file.getint('global', 'condor_q_timeout')
+    except ValueError:
+        print "Configuration file problem: condor_q_timeout must be an integer value"
+        sys.exit(1)
+
+    try:
+        config_file.getboolean('global', 'condor_attribute_projection')
+    except ValueError:
+        print "Configuration file problem: condor_attribute_projection must be a boolean value"
+        sys.exit(1)
+
+    condor_classad_format = config_file.get('global', 'condor_classad_format').lower()
+    if condor_classad_format not in ("text", "json"):
+        print "Configuration file problem: condor_classad_format must be text or json"
+        sys.exit(1)
+    config_file.set('global', 'condor_classad_format', condor_classad_format)
+
+    try:
+        config_file.getboolean('global', 'job_delta_polling')
+    except ValueError:
+        print "Configuration file problem: job_delta_polling must be a boolean value"
+        sys.exit(1)
+
+    try:
+        job_delta_resync_cycles = config_file.getint('global', 'job_delta_resync_cycles')
+        if job_delta_resync_cycles < 0:
+            config_file.set('global', 'job_delta_resync_cycles', '0')
+    except ValueError:
+        print "Configuration file problem: job_delta_resync_cycles must be an integer value"
+        sys.exit(1)
+
     try:
         config_file.getint('global', 'polling_error_threshold')
     except ValueError:
@@ -436,6 +513,12 @@ def setup(path=None):
         print "Configuration file problem: default_VMInjectCA must be a boolean value"
         sys.exit(1)
 
+    try:
+        config_file.getboolean('global', 'check_vm_totals')
+    except ValueError:
+        print "Configuration file problem: check_vm_totals must be a boolean value"
+        sys.exit(1)
+
     try:
         config_file.getboolean('global', 'use_pyopenssl')
     except ValueError:
@@ -445,9 +528,6 @@ def setup(path=None):
     if os.path.exists('/usr/local/share/cloud-scheduler/default.yaml'):
         config_file.set('global', 'default_yaml', '/usr/local/share/cloud-scheduler/default.yaml')
 
-    global config_options
-    config_options = config_file
-
     return config_file
 
 
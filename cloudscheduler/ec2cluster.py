@@ -1,12 +1,10 @@
 import time
-import string
 import json
-import subprocess
-from subprocess import Popen
 import datetime as dt
 from httplib import BadStatusLine
 from cloudscheduler import cluster_tools
 from cloudscheduler import cloud_init_util
+from cloudscheduler import command_runner
 import cloudscheduler.config as config
 import cloudscheduler.utilities as utilities
 from cloudscheduler.job_management import _attr_list_to_dict
@@ -509,7 +507,7 @@ class EC2Cluster(cluster_tools.ICluster):
         return hostname
 
     def vm_execwait(self, cmd, env=None):
-        """As above, a function to encapsulate command execution via Popen.
+        """As above, a function to encapsulate command execution through command_runner.
         vm_execwait executes the given cmd list, waits for the process to finish,
         and returns the return code of the process. STDOUT and STDERR are stored
         in given parameters.
@@ -521,29 +519,14 @@ class EC2Cluster(cluster_tools.ICluster):
         err - The STDERR of the executed command
         The return of this function is a 3-tuple
         """
-        out = ""
-        err = ""
         try:
-            sub_p = Popen(cmd, shell=False,
-                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
-            if not utilities.check_popen_timeout(sub_p):
-                (out, err) = sub_p.communicate(input=None)
-            else:
-                log.warning("Process %s timed out! cmd was %s", sub_p.pid, " ".join(cmd))
-            return (sub_p.returncode, out, err)
-        except OSError, e:
-            try:
-                log.error("Problem running %s, got errno %d \"%s\"", string.join(cmd, " "),
-                          e.errno, e.strerror)
-            except:
-                log.error("Problem running command, OSError.")
-            return (-1, "", "")
-        except:
-            try:
-                log.error("Problem running %s, unexpected error: %s", string.join(cmd, " "), err)
-            except:
-                log.error("Problem running command, unexpected error.")
+            result = command_runner.run_command(cmd, env=env)
+        except command_runner.CommandError, e:
+            log.error("%s", e)
             return (-1, "", "")
+        if result.timed_out:
+            log.warning("Command timed out! cmd was %s", " ".join(cmd))
+        return (result.returncode, result.stdout, result.stderr)
 
 
     """ These methods relate to inquiring on EC2 spot pricing methods """
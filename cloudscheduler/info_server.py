@@ -21,6 +21,7 @@ import web.wsgiserver
 
 import cloudscheduler.config as config
 import cloudscheduler.__version__ as version
+from cloudscheduler import command_runner
 from cloudscheduler.cluster_tools import ICluster
 from cloudscheduler.cluster_tools import VM
 from cloudscheduler.job_management import Job
@@ -77,6 +78,7 @@ class InfoServer(threading.Thread,):
             r'/clusters/([\w\%-]+)/vms', Views.Vms,
             r'/clusters/([\w\%-]+)/vms/([\w\%-]+)', Views.Vms,
             r'/clusters/([\w\%-]+)/vms/([\w\%-]+)(\.json)', Views.Vms,
+            r'/command-stats', Views.Commandstats,
             r'/developer-info', Views.Developerinfo,
             r'/diff-types', Views.Difftypes,
             r'/failures/(boot|image)', Views.Failures,
@@ -187,6 +189,13 @@ class Views(object):
             return ''.join(output)
 
 
+    class Commandstats(object):
+        """View run counts and timings of the external commands run."""
+        @staticmethod
+        def GET():
+            """Get json output of the command statistics."""
+            return json.dumps(command_runner.command_stats(), sort_keys=True)
+
     class Developerinfo(object):
         """Info methods for debugging."""
         @staticmethod
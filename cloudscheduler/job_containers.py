@@ -7,6 +7,8 @@ and improve performance.
 from abc import ABCMeta, abstractmethod
 from collections import defaultdict
 import time
+import bisect
+import itertools
 import threading
 import logging
 import cloudscheduler.config as config
@@ -33,6 +35,36 @@ class JobContainer(object):
         """
         self.lock = threading.RLock()
         self.log = logging.getLogger("cloudscheduler")
+        # Bumped by every change to the jobs in the container, see memoize()
+        self.generation = 0
+        self.memo = {}
+        self.memo_generation = 0
+
+    def changed(self):
+        """
+        Note a change to the jobs in the container, forgetting memoized values.
+        Subclasses call it from every method changing the container.
+        """
+        with self.lock:
+            self.generation += 1
+
+    def memoize(self, key, compute):
+        """
+        Returns compute(), remembered under key until the container changes.
+
+        For values derived from the jobs that are asked for repeatedly while
+        the jobs stay the same, like during one scheduling pass. The value is
+        shared by every caller, changing it changes it for all of them.
+        """
+        with self.lock:
+            if self.memo_generation != self.generation:
+                self.memo.clear()
+                self.memo_generation = self.generation
+            if key in self.memo:
+                return self.memo[key]
+            value = compute()
+            self.memo[key] = value
+            return value
 
     @abstractmethod
     def has_job(self, jobid):
@@ -115,6 +147,18 @@ class JobContainer(object):
         """
         pass
 
+    @abstractmethod
+    def remove_all_not_in_ids(self, job_ids_to_keep, schedds=None):
+        """
+        Remove all jobs in the container whose id does not appear in a given
+        set of job ids. If schedds is given only jobs that came from one of
+        those schedds are considered for removal.
+        Returns the list of removed jobs.
+        :param job_ids_to_keep:
+        :param schedds:
+        """
+        pass
+
     @abstractmethod
     def update_job_status(self, jobid, status, remote, servertime, starttime):
         """
@@ -149,6 +193,17 @@ class JobContainer(object):
         """
         pass
 
+    @abstractmethod
+    def update_job_requirements(self, jobid, **requirements):
+        """
+        Change requirements (RequirementProfile fields, e.g. cpucores) of a job
+        in the container, regrouping it and forgetting memoized values.
+        Returns True if the job was found in the container, False otherwise.
+        :param jobid:
+        :param requirements:
+        """
+        pass
+
     @abstractmethod
     def get_users(self):
         """
@@ -196,8 +251,8 @@ class JobContainer(object):
     @abstractmethod
     def get_scheduled_jobs_sorted_by_id(self):
         """
-        Get a list of all scheduled jobs in the container sorted by their job.id
-        or [] if no unscheduled jobs.
+        Get a list of all scheduled jobs in the container sorted by their condor
+        (ClusterId, ProcId) or [] if no scheduled jobs.
         """
         pass
 
@@ -236,8 +291,8 @@ class JobContainer(object):
     @abstractmethod
     def get_unscheduled_jobs_sorted_by_id(self):
         """
-        Get a list of all unscheduled jobs in the container sorted by their job.id
-        or [] if no unscheduled jobs.
+        Get a list of all unscheduled jobs in the container sorted by their condor
+        (ClusterId, ProcId) or [] if no unscheduled jobs.
         """
         pass
 
@@ -315,6 +370,170 @@ class JobContainer(object):
 
 
 
+class PrioritizedJobs(object):
+
+    """
+    A group of jobs kept in order of priority, high to low, jobs of the same
+    priority in the order they were added to the container.
+
+    """
+    __slots__ = ('ranks', 'jobs')
+
+    def __init__(self):
+        self.ranks = []
+        self.jobs = []
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def add(self, job, rank):
+        i = bisect.bisect(self.ranks, rank)
+        self.ranks.insert(i, rank)
+        self.jobs.insert(i, job)
+
+    def remove(self, rank):
+        i = bisect.bisect_left(self.ranks, rank)
+        if i < len(self.ranks) and self.ranks[i] == rank:
+            del self.ranks[i]
+            del self.jobs[i]
+
+
+class JobGroups(object):
+
+    """
+    Jobs grouped by a key computed from each job, every group a PrioritizedJobs.
+
+    """
+    __slots__ = ('key', 'groups')
+
+    def __init__(self, key):
+        self.key = key
+        self.groups = {}
+
+    def add(self, job, rank):
+        key = self.key(job)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = PrioritizedJobs()
+        group.add(job, rank)
+
+    def remove(self, job, rank):
+        key = self.key(job)
+        group = self.groups.get(key)
+        if group is not None:
+            group.remove(rank)
+            if not group:
+                del self.groups[key]
+
+    def clear(self):
+        self.groups.clear()
+
+    def get(self, key):
+        """
+        Copy of the jobs of one group, highest priority first.
+        """
+        group = self.groups.get(key)
+        return list(group.jobs) if group is not None else []
+
+    def copy(self):
+        """
+        Copy of all the groups as a defaultdict of lists.
+        """
+        return defaultdict(list, ((key, list(group.jobs))
+                                  for key, group in self.groups.iteritems()))
+
+    def copy_for(self, first):
+        """
+        Copy of the groups keyed (first, x), as a defaultdict keyed by x.
+        """
+        return defaultdict(list, ((key[1], list(group.jobs))
+                                  for key, group in self.groups.iteritems() if key[0] == first))
+
+
+class FifoJobQueue(object):
+
+    """
+    Jobs in First In First Out order of their condor ids, (ClusterId, ProcId)
+    compared as numbers, then the global job id to tell schedds apart.
+
+    The keys are kept sorted in blocks of at most 2 * BLOCK_SIZE, with the
+    largest key of every block in maxes, so adding or removing a job is a
+    bisection over maxes and one within a block, and only moves that block.
+
+    """
+    BLOCK_SIZE = 500
+
+    def __init__(self):
+        self.blocks = []
+        self.maxes = []
+        self.jobs = {}
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __iter__(self):
+        for block in self.blocks:
+            for key in block:
+                yield self.jobs[key]
+
+    @staticmethod
+    def key(job):
+        return (job.cluster_id, job.proc_id, job.id)
+
+    def add(self, job):
+        key = self.key(job)
+        if key in self.jobs:
+            self.jobs[key] = job
+            return
+        self.jobs[key] = job
+        if not self.blocks:
+            self.blocks.append([key])
+            self.maxes.append(key)
+            return
+        i = bisect.bisect_left(self.maxes, key)
+        if i == len(self.blocks):
+            i -= 1
+        block = self.blocks[i]
+        bisect.insort(block, key)
+        self.maxes[i] = block[-1]
+        if len(block) > 2 * self.BLOCK_SIZE:
+            self.blocks.insert(i + 1, block[self.BLOCK_SIZE:])
+            del block[self.BLOCK_SIZE:]
+            self.maxes.insert(i, block[-1])
+
+    def remove(self, job):
+        key = self.key(job)
+        if self.jobs.pop(key, None) is None:
+            return
+        i = bisect.bisect_left(self.maxes, key)
+        block = self.blocks[i]
+        del block[bisect.bisect_left(block, key)]
+        if block:
+            self.maxes[i] = block[-1]
+        else:
+            del self.blocks[i]
+            del self.maxes[i]
+
+    def clear(self):
+        self.blocks = []
+        self.maxes = []
+        self.jobs.clear()
+
+    def next_after(self, key):
+        """
+        The key following key, or the first one if key is None. None at the end.
+        """
+        if not self.blocks:
+            return None
+        if key is None:
+            return self.blocks[0][0]
+        i = bisect.bisect_right(self.maxes, key)
+        if i == len(self.blocks):
+            return None
+        block = self.blocks[i]
+        return block[bisect.bisect_right(block, key)]
+
+
 class HashTableJobContainer(JobContainer):
 
     """
@@ -327,6 +546,17 @@ class HashTableJobContainer(JobContainer):
     sched_jobs = None
     jobs_by_user = None
 
+    # Groupings of the unscheduled and of the scheduled jobs kept up to date
+    # as jobs are added, removed and (un)scheduled, so the get_*_by_* methods
+    # don't have to regroup and sort the jobs every time.
+    GROUPINGS = {
+        'user': lambda job: job.user,
+        'vmtype': lambda job: job.req_vmtype,
+        'usertype': lambda job: job.uservmtype,
+        'user_vmtype': lambda job: (job.user, job.req_vmtype),
+        'user_usertype': lambda job: (job.user, job.uservmtype),
+    }
+
     def __init__(self):
         """
         constructor
@@ -336,6 +566,17 @@ class HashTableJobContainer(JobContainer):
         self.new_jobs = {}
         self.sched_jobs = {}
         self.jobs_by_user = defaultdict(dict)
+        # Condor JobStatus: {job id: job}
+        self.jobs_by_status = defaultdict(dict)
+        # Job id: (-priority, order added), the position of the job in groups
+        self.job_ranks = {}
+        self.job_order = itertools.count()
+        self.prioritized_by_user = JobGroups(self.GROUPINGS['user'])
+        self.new_groups = dict((name, JobGroups(key)) for name, key in self.GROUPINGS.iteritems())
+        self.sched_groups = dict((name, JobGroups(key)) for name, key in self.GROUPINGS.iteritems())
+        self.new_high_by_user = JobGroups(self.GROUPINGS['user'])
+        self.new_fifo = FifoJobQueue()
+        self.sched_fifo = FifoJobQueue()
         self.log.verbose('HashTableJobContainer instance created.')
 
     def __str__(self):
@@ -345,16 +586,46 @@ class HashTableJobContainer(JobContainer):
     def has_job(self, jobid):
         return self.get_job_by_id(jobid) != None
 
+    def _group_job(self, job, scheduled, add):
+        """
+        Add job to, or remove it from, the groups of the scheduled or unscheduled jobs.
+        """
+        rank = self.job_ranks[job.id]
+        groups = self.sched_groups if scheduled else self.new_groups
+        fifo = self.sched_fifo if scheduled else self.new_fifo
+        if add:
+            fifo.add(job)
+        else:
+            fifo.remove(job)
+        for job_groups in groups.itervalues():
+            if add:
+                job_groups.add(job, rank)
+            else:
+                job_groups.remove(job, rank)
+        if not scheduled and job.high_priority:
+            if add:
+                self.new_high_by_user.add(job, rank)
+            else:
+                self.new_high_by_user.remove(job, rank)
+
     def add_job(self, job):
         with self.lock:
+            if job.id in self.all_jobs:
+                self.remove_job(self.all_jobs[job.id])
             self.all_jobs[job.id] = job
             self.jobs_by_user[job.user][job.id] = job
+            self.jobs_by_status[job.job_status][job.id] = job
+            self.job_ranks[job.id] = (-job.get_priority(), self.job_order.next())
+            self.prioritized_by_user.add(job, self.job_ranks[job.id])
+            self.changed()
 
             # Update scheduled/unscheduled maps too:
             if job.status == "Unscheduled":
                 self.new_jobs[job.id] = job
+                self._group_job(job, False, True)
             else:
                 self.sched_jobs[job.id] = job
+                self._group_job(job, True, True)
 
             #self.log.debug('job %s added to job container' % (job.id))
 
@@ -369,12 +640,33 @@ class HashTableJobContainer(JobContainer):
             self.jobs_by_user.clear()
             self.new_jobs.clear()
             self.sched_jobs.clear()
+            self.jobs_by_status.clear()
+            self.job_ranks.clear()
+            self.prioritized_by_user.clear()
+            for job_groups in self.new_groups.values() + self.sched_groups.values():
+                job_groups.clear()
+            self.new_high_by_user.clear()
+            self.new_fifo.clear()
+            self.sched_fifo.clear()
+            self.changed()
             self.log.verbose('job container cleared')
 
     def remove_job(self, job):
         with self.lock:
             if job.id in self.all_jobs:
-                del self.all_jobs[job.id]
+                # The groups hold the job object the container was given
+                stored_job = self.all_jobs.pop(job.id)
+                if job.id in self.new_jobs:
+                    self._group_job(stored_job, False, False)
+                if job.id in self.sched_jobs:
+                    self._group_job(stored_job, True, False)
+                self.prioritized_by_user.remove(stored_job, self.job_ranks.pop(job.id))
+                status_jobs = self.jobs_by_status.get(stored_job.job_status)
+                if status_jobs is not None:
+                    status_jobs.pop(job.id, None)
+                    if not status_jobs:
+                        del self.jobs_by_status[stored_job.job_status]
+                self.changed()
             if job.user in self.jobs_by_user and (job.id in self.jobs_by_user[job.user]):
                 del self.jobs_by_user[job.user][job.id]
                 if len(self.jobs_by_user[job.user]) == 0:
@@ -400,16 +692,17 @@ class HashTableJobContainer(JobContainer):
                 self.remove_job_by_id(jobid)
 
     def remove_all_not_in(self, jobs_to_keep):
+        return self.remove_all_not_in_ids(set(job.id for job in jobs_to_keep))
+
+    def remove_all_not_in_ids(self, job_ids_to_keep, schedds=None):
         with self.lock:
-            # create a dictionary of the given jobs to keep first (for effeciency)
-            jobs_to_keep_dict = {}
             removed_jobs = []
-            for job in jobs_to_keep:
-                jobs_to_keep_dict[job.id] = job
-
             for job in self.all_jobs.values():
+                # Jobs of schedds we didn't get a full queue from are kept
+                if schedds is not None and job.schedd not in schedds:
+                    continue
                 # If the job is not in the jobs to keep, simply remove it.
-                if job.id not in jobs_to_keep_dict:
+                if job.id not in job_ids_to_keep:
                     self.remove_job(job)
                     removed_jobs.append(job)
         return removed_jobs
@@ -426,53 +719,42 @@ class HashTableJobContainer(JobContainer):
         except KeyError:
             return None
 
+    def get_jobs_with_status(self, status):
+        """
+        get the jobs with condor JobStatus status.
+        :param status:
+        :return:
+        """
+        with self.lock:
+            return self.jobs_by_status[status].values() if status in self.jobs_by_status else []
+
     def get_held_jobs(self):
         """
         get the jobs in held state.
         :return:
         """
-        held = 5
-        held_jobs = []
-        for job in self.all_jobs.values():
-            if job.job_status == held:
-                held_jobs.append(job)
-        return held_jobs
+        return self.get_jobs_with_status(5)
 
     def get_idle_jobs(self):
         """
         get the jobs in idle state.
         :return:
         """
-        idle = 1
-        idle_jobs = []
-        for job in self.all_jobs.values():
-            if job.job_status == idle:
-                idle_jobs.append(job)
-        return idle_jobs
+        return self.get_jobs_with_status(1)
 
     def get_running_jobs(self):
         """
         Gets the jobs in running state.
         :return:
         """
-        running = 2
-        run_jobs = []
-        for job in self.all_jobs.values():
-            if job.job_status == running:
-                run_jobs.append(job)
-        return run_jobs
+        return self.get_jobs_with_status(2)
 
     def get_complete_jobs(self):
         """
         Gets all the completed jobs.
         :return:
         """
-        complete = 4
-        comp_jobs = []
-        for job in self.all_jobs.values():
-            if job.job_status == complete:
-                comp_jobs.append(job)
-        return comp_jobs
+        return self.get_jobs_with_status(4)
 
     def get_jobs_for_user(self, user, prioritized=False):
         with self.lock:
@@ -480,10 +762,8 @@ class HashTableJobContainer(JobContainer):
                 return []
 
             if prioritized:
-                jobs = self.jobs_by_user[user].values()
-                # Sort jobs in order of priority. The list runs front to back, high to low priority.
-                jobs.sort(key=lambda job: job.get_priority(), reverse=True)
-                return jobs
+                # The list runs front to back, high to low priority.
+                return self.prioritized_by_user.get(user)
             else:
                 return self.jobs_by_user[user].values()
 
@@ -499,10 +779,8 @@ class HashTableJobContainer(JobContainer):
         get scheduled jobs sorted by condor id.
         :return:
         """
-        return_value = []
-        for jobid in sorted(self.sched_jobs.iteritems()):
-            return_value.append(jobid[1])
-        return return_value
+        with self.lock:
+            return list(self.sched_fifo)
 
     def get_scheduled_jobs_by_users(self, prioritized=False):
         """
@@ -511,14 +789,7 @@ class HashTableJobContainer(JobContainer):
         :return:
         """
         with self.lock:
-            return_value = defaultdict(list)
-            for job in self.sched_jobs.values():
-                return_value[job.user].append(job)
-            # Now lets sort if needed.
-            if prioritized:
-                for job_list in return_value.values():
-                    job_list.sort(key=lambda job: job.get_priority(), reverse=True)
-            return return_value
+            return self.sched_groups['user'].copy()
 
     def get_scheduled_jobs_by_type(self, prioritized=False):
         """
@@ -527,14 +798,7 @@ class HashTableJobContainer(JobContainer):
         :return:
         """
         with self.lock:
-            return_value = defaultdict(list)
-            for job in self.sched_jobs.values():
-                return_value[job.req_vmtype].append(job)
-            # Now sort if needed.
-            if prioritized:
-                for job_list in return_value.values():
-                    job_list.sort(key=lambda job: job.get_priority(), reverse=True)
-            return return_value
+            return self.sched_groups['vmtype'].copy()
 
     def get_scheduled_jobs_by_usertype(self, prioritized=False):
         """
@@ -543,14 +807,7 @@ class HashTableJobContainer(JobContainer):
         :return:
         """
         with self.lock:
-            return_value = defaultdict(list)
-            for job in self.sched_jobs.values():
-                return_value[job.uservmtype].append(job)
-            # Now sort if needed.
-            if prioritized:
-                for job_list in return_value.values():
-                    job_list.sort(key=lambda job: job.get_priority(), reverse=True)
-            return return_value
+            return self.sched_groups['usertype'].copy()
 
     def get_unscheduled_jobs(self):
         """
@@ -564,10 +821,24 @@ class HashTableJobContainer(JobContainer):
         Get unscheduled jobs sorted by condor id.
         :return:
         """
-        return_value = []
-        for jobid in sorted(self.new_jobs.iteritems()):
-            return_value.append(jobid[1])
-        return return_value
+        with self.lock:
+            return list(self.new_fifo)
+
+    def iter_unscheduled_jobs_by_id(self):
+        """
+        Generator of the unscheduled jobs in condor id order.
+        Jobs can be (un)scheduled, added and removed while it runs, it goes on
+        from the last job it returned.
+        :return:
+        """
+        key = None
+        while True:
+            with self.lock:
+                key = self.new_fifo.next_after(key)
+                if key is None:
+                    return
+                job = self.new_fifo.jobs[key]
+            yield job
 
     def get_unscheduled_jobs_by_users(self, prioritized=False):
         """
@@ -576,14 +847,7 @@ class HashTableJobContainer(JobContainer):
         :return:
         """
         with self.lock:
-            return_value = defaultdict(list)
-            for job in self.new_jobs.values():
-                return_value[job.user].append(job)
-            # Now lets sort if needed.
-            if prioritized:
-                for job_list in return_value.values():
-                    job_list.sort(key=lambda job: job.get_priority(), reverse=True)
-            return return_value
+            return self.new_groups['user'].copy()
 
     def get_unscheduled_jobs_by_type(self, prioritized=False):
         """
@@ -592,14 +856,7 @@ class HashTableJobContainer(JobContainer):
         :return:
         """
         with self.lock:
-            return_value = defaultdict(list)
-            for job in self.new_jobs.values():
-                return_value[job.req_vmtype].append(job)
-            # Now sort if needed.
-            if prioritized:
-                for job_list in return_value.values():
-                    job_list.sort(key=lambda job: job.get_priority(), reverse=True)
-            return return_value
+            return self.new_groups['vmtype'].copy()
 
     def get_unscheduled_jobs_by_usertype(self, prioritized=False):
         """
@@ -608,14 +865,7 @@ class HashTableJobContainer(JobContainer):
         :return:
         """
         with self.lock:
-            return_value = defaultdict(list)
-            for job in self.new_jobs.values():
-                return_value[job.uservmtype].append(job)
-            # Now sort if needed.
-            if prioritized:
-                for job_list in return_value.values():
-                    job_list.sort(key=lambda job: job.get_priority(), reverse=True)
-            return return_value
+            return self.new_groups['usertype'].copy()
 
     def get_high_priority_jobs(self):
         """
@@ -663,15 +913,7 @@ class HashTableJobContainer(JobContainer):
         :return:
         """
         with self.lock:
-            return_value = defaultdict(list)
-            for job in self.get_unscheduled_high_priority_jobs():
-                return_value[job.user].append(job)
-            # Now lets sort if needed.
-            if prioritized:
-                for job_list in return_value.values():
-                    job_list.sort(key=lambda job: job.get_priority(), reverse=True)
-
-            return return_value
+            return self.new_high_by_user.copy()
 
     def is_empty(self):
         """
@@ -699,7 +941,15 @@ class HashTableJobContainer(JobContainer):
                 self.log.debug("Job %s status change: %s -> %s", job.id,
                                self.job_status_list[job.job_status],
                                self.job_status_list[status])
-            job.job_status = status
+                with self.lock:
+                    if self.all_jobs.get(jobid) is job:
+                        status_jobs = self.jobs_by_status[job.job_status]
+                        status_jobs.pop(jobid, None)
+                        if not status_jobs:
+                            del self.jobs_by_status[job.job_status]
+                        self.jobs_by_status[status][jobid] = job
+                    job.job_status = status
+                    self.changed()
             job.remote_host = remote
             job.servertime = int(servertime)
             job.jobstarttime = int(starttime)
@@ -727,9 +977,12 @@ class HashTableJobContainer(JobContainer):
         with self.lock:
             if jobid in self.new_jobs:
                 job = self.new_jobs[jobid]
+                self._group_job(job, False, False)
                 job.set_status("Scheduled")
                 self.sched_jobs[jobid] = job
                 del self.new_jobs[jobid]
+                self._group_job(job, True, True)
+                self.changed()
                 return True
             else:
                 return False
@@ -743,13 +996,34 @@ class HashTableJobContainer(JobContainer):
         with self.lock:
             if jobid in self.sched_jobs:
                 job = self.sched_jobs[jobid]
+                self._group_job(job, True, False)
                 job.set_status("Unscheduled")
                 self.new_jobs[jobid] = job
                 del self.sched_jobs[jobid]
+                self._group_job(job, False, True)
+                self.changed()
                 return True
             else:
                 return False
 
+    def update_job_requirements(self, jobid, **requirements):
+        """
+        Change the requirements of a job, moving it to the groups of its new requirements.
+        :param jobid:
+        :param requirements:
+        :return:
+        """
+        with self.lock:
+            job = self.all_jobs.get(jobid)
+            if job is None:
+                return False
+            scheduled = jobid in self.sched_jobs
+            self._group_job(job, scheduled, False)
+            job.req_profile = job.req_profile.replace(**requirements)
+            self._group_job(job, scheduled, True)
+            self.changed()
+            return True
+
     def find_unscheduled_jobs_with_matching_reqs(self, user, job, num=0):
         """
         Look for unscheduled jobs with the same requirements as job.
@@ -759,24 +1033,36 @@ class HashTableJobContainer(JobContainer):
         :return:
         """
         with self.lock:
-            counter = 0
-            unscheduled_jobs_for_user = []
-            try:
-                unscheduled_jobs_for_user = self.get_unscheduled_jobs_by_users()[user]
-            except KeyError:
-                # User has no unscheduled jobs.
-                # Simply return an empty list right away.
-                return []
-
-            matching_jobs = []
-            for j in unscheduled_jobs_for_user:
-                if j.has_same_reqs(job):
-                    matching_jobs.append(j)
-                    counter += 1
-                    if counter > 0 and counter == num:
-                        break
+            # Requirement profiles are shared by the jobs with the same
+            # requirements, so the user's jobs are grouped by profile once.
+            by_profile = self.memoize(('unscheduled_by_profile', user),
+                                      lambda: self._group_by_profile(self.new_groups['user'].get(user)))
+            matching_jobs = by_profile.get(id(job.req_profile), [])
+            if num > 0:
+                return matching_jobs[:num]
+            return list(matching_jobs)
+
+    @staticmethod
+    def _group_by_profile(jobs):
+        """
+        Group jobs by the identity of their requirement profile, keeping their order.
+        :param jobs:
+        :return:
+        """
+        by_profile = defaultdict(list)
+        for job in jobs:
+            by_profile[id(job.req_profile)].append(job)
+        return dict(by_profile)
 
-            return matching_jobs
+    def get_unscheduled_head_jobs_by_users(self):
+        """
+        Get the highest priority unscheduled job of each user.
+        The dict is memoized and shared, it must not be changed.
+        :return:
+        """
+        with self.lock:
+            return self.memoize('unscheduled_head_jobs_by_users', lambda: dict(
+                (user, group.jobs[0]) for user, group in self.new_groups['user'].groups.iteritems()))
 
     def get_unscheduled_user_jobs_by_type(self, user, prioritized=False):
         """
@@ -786,16 +1072,7 @@ class HashTableJobContainer(JobContainer):
         :return:
         """
         with self.lock:
-            unsched = self.get_unscheduled_jobs_by_users()
-            return_value = defaultdict(list)
-            if user in unsched.keys():
-                for job in unsched[user]:
-                    return_value[job.req_vmtype].append(job)
-            # Sort if needed
-            if prioritized:
-                for job_list in return_value.values():
-                    job_list.sort(key=lambda job: job.get_priority(), reverse=True)
-        return return_value
+            return self.new_groups['user_vmtype'].copy_for(user)
 
     def get_unscheduled_user_jobs_by_usertype(self, user, prioritized=False):
         """
@@ -805,16 +1082,7 @@ class HashTableJobContainer(JobContainer):
         :return:
         """
         with self.lock:
-            unsched = self.get_unscheduled_jobs_by_users()
-            return_value = defaultdict(list)
-            if user in unsched.keys():
-                for job in unsched[user]:
-                    return_value[job.uservmtype].append(job)
-            # Sort if needed
-            if prioritized:
-                for job_list in return_value.values():
-                    job_list.sort(key=lambda job: job.get_priority(), reverse=True)
-        return return_value
+            return self.new_groups['user_usertype'].copy_for(user)
 
     def get_scheduled_user_jobs_by_type(self, user, prioritized=False):
         """
@@ -825,16 +1093,7 @@ class HashTableJobContainer(JobContainer):
         :return:
         """
         with self.lock:
-            sched = self.get_scheduled_jobs_by_users()
-            return_value = defaultdict(list)
-            if user in sched.keys():
-                for job in sched[user]:
-                    return_value[job.req_vmtype].append(job)
-            # Sort if needed
-            if prioritized:
-                for job_list in return_value.values():
-                    job_list.sort(key=lambda job: job.get_priority(), reverse=True)
-        return return_value
+            return self.sched_groups['user_vmtype'].copy_for(user)
 
     def get_scheduled_user_jobs_by_usertype(self, user, prioritized=False):
         """
@@ -844,14 +1103,5 @@ class HashTableJobContainer(JobContainer):
         :return:
         """
         with self.lock:
-            sched = self.get_scheduled_jobs_by_users()
-            return_value = defaultdict(list)
-            if user in sched.keys():
-                for job in sched[user]:
-                    return_value[job.req_vmtype].append(job)
-            # Sort if needed
-            if prioritized:
-                for job_list in return_value.values():
-                    job_list.sort(key=lambda job: job.get_priority(), reverse=True)
-        return return_value
+            return self.sched_groups['user_usertype'].copy_for(user)
 
@@ -25,33 +25,188 @@ from __future__ import with_statement
 import os
 import re
 import shlex
-import string
+import Queue
+import inspect
 import logging
+import weakref
 import datetime
+import itertools
 import threading
-import subprocess
 from collections import defaultdict
+from collections import namedtuple
+from collections import OrderedDict
 from decimal import Decimal
 
 import cloudscheduler.config as config
 from cloudscheduler.utilities import get_cert_expiry_time
 from cloudscheduler.utilities import splitnstrip
+from cloudscheduler.utilities import json_classad_stream
+from cloudscheduler.utilities import threaded_map
 from cloudscheduler import job_containers
+from cloudscheduler import condor_bindings
+from cloudscheduler import command_runner
 
 config_val = config.get_config_parser()
 
 
+class CondorQueryError(Exception):
+    """Exception raised when a condor query fails after its output was read."""
+    pass
+
+
+class JobDefaults(namedtuple('JobDefaults', ['vmtype', 'network', 'name', 'ami', 'instance_type',
+                                              'memory', 'cpucores', 'storage', 'target_clouds',
+                                              'ami_config', 'maximum_price', 'job_per_core',
+                                              'inject_ca', 'proxy_non_boot', 'max_keepalive'])):
+    """
+    Snapshot of the configured job defaults, used by Job for every attribute
+    the job classad leaves out. Built by load_job_defaults when the
+    configuration is loaded. The ami and instance_type dictionaries are shared
+    by all the jobs using them and must not be modified.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_config(cls, config_parser):
+        """Build the defaults from the [job] section of a configuration."""
+        return cls(vmtype=config_parser.get('job', 'default_VMType'),
+                   network=config_parser.get('job', 'default_VMNetwork'),
+                   name=config_parser.get('job', 'default_VMName'),
+                   ami=_attr_list_to_dict(config_parser.get('job', 'default_VMAMI')),
+                   instance_type=_attr_list_to_dict(config_parser.get('job',
+                                                                      'default_VMInstanceTypeList')),
+                   memory=config_parser.getint('job', 'default_VMMem'),
+                   cpucores=config_parser.getint('job', 'default_VMCPUCores'),
+                   storage=config_parser.getint('job', 'default_VMStorage'),
+                   target_clouds=config_parser.get('job', 'default_TargetClouds'),
+                   ami_config=config_parser.get('job', 'default_VMAMIConfig'),
+                   maximum_price=config_parser.getfloat('job', 'default_VMMaximumPrice'),
+                   job_per_core=config_parser.getboolean('job', 'default_VMJobPerCore'),
+                   inject_ca=config_parser.getboolean('job', 'default_VMInjectCA'),
+                   proxy_non_boot=config_parser.getboolean('job', 'default_VMProxyNonBoot'),
+                   max_keepalive=config_parser.getint('global', 'max_keepalive'))
+
+
+class RequirementProfile(object):
+    """
+    The resource requirements of a job.
+
+    Profiles are interned: jobs with the same requirements share a single
+    instance, so profiles can be compared by identity and used as dictionary
+    keys. Profiles are immutable, use replace() to get the profile with some
+    of the requirements changed. The ami and instance_type dictionaries are
+    shared too and must not be modified.
+    """
+
+    __slots__ = ('id', 'vmtype', 'network', 'memory', 'cpucores', 'storage', 'ami',
+                 'instance_type', 'target_clouds', 'security_groups', 'user_data',
+                 '__weakref__')
+
+    _profiles = weakref.WeakValueDictionary()
+    _profiles_lock = threading.Lock()
+    _ids = itertools.count()
+
+    def __new__(cls, vmtype, network, memory, cpucores, storage, ami=None,
+                instance_type=None, target_clouds=(), security_groups=(), user_data=()):
+        target_clouds = tuple(target_clouds)
+        security_groups = tuple(security_groups)
+        user_data = tuple(user_data)
+        key = (vmtype, network, memory, cpucores, storage, _freeze(ami), _freeze(instance_type),
+               target_clouds, security_groups, user_data)
+        with cls._profiles_lock:
+            profile = cls._profiles.get(key)
+            if profile is None:
+                profile = object.__new__(cls)
+                for name, value in (('id', cls._ids.next()), ('vmtype', vmtype),
+                                    ('network', network), ('memory', memory),
+                                    ('cpucores', cpucores), ('storage', storage), ('ami', ami),
+                                    ('instance_type', instance_type),
+                                    ('target_clouds', target_clouds),
+                                    ('security_groups', security_groups),
+                                    ('user_data', user_data)):
+                    object.__setattr__(profile, name, value)
+                cls._profiles[key] = profile
+        return profile
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RequirementProfile is immutable, use replace()")
+
+    def __reduce__(self):
+        return (RequirementProfile, self._args())
+
+    def __repr__(self):
+        return "RequirementProfile(%d, %s)" % (self.id, self.vmtype)
+
+    def _args(self):
+        return (self.vmtype, self.network, self.memory, self.cpucores, self.storage, self.ami,
+                self.instance_type, self.target_clouds, self.security_groups, self.user_data)
+
+    def replace(self, **changes):
+        """Return the profile with the given requirements changed."""
+        args = dict(zip(('vmtype', 'network', 'memory', 'cpucores', 'storage', 'ami',
+                         'instance_type', 'target_clouds', 'security_groups', 'user_data'),
+                        self._args()))
+        args.update(changes)
+        return RequirementProfile(**args)
+
+
+def _freeze(value):
+    """Return a hashable version of a requirement value."""
+    if isinstance(value, dict):
+        return frozenset(value.iteritems())
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+
+def _profile_property(name):
+    """A Job attribute stored in the job's RequirementProfile."""
+    def getter(self):
+        return getattr(self.req_profile, name)
+    def setter(self, value):
+        self.req_profile = self.req_profile.replace(**{name: value})
+    return property(getter, setter)
+
+
 class Job(object):
     """
     Job Class - Represents a job as read from the Job Scheduler
 
 
     """
+    # Jobs are kept for every job in the queue, so they use __slots__
+    # instead of a per-instance __dict__
+    __slots__ = ('id', 'user', 'uservmtype', 'priority', 'job_status', 'cluster_id', 'proc_id',
+                 'req_profile', 'req_image', 'req_imageloc', 'keep_alive', 'high_priority',
+                 'maximum_price', 'myproxy_server', 'myproxy_server_port', 'myproxy_creds_name',
+                 'x509userproxysubject', 'x509userproxy', 'original_x509userproxy', 'spool_dir',
+                 'x509userproxy_expiry_time', 'proxy_renew_time', 'job_per_core', 'remote_host',
+                 'running_cloud', 'running_vm', 'servertime', 'jobstarttime', 'banned',
+                 'ban_time', 'machine_reserved', 'proxy_non_boot', 'vmimage_proxy_file',
+                 'usertype_limit', 'req_image_id', 'location', 'key_name', 'ami_config',
+                 'use_cloud_init', 'inject_ca', 'status', 'override_status', 'block_time',
+                 'failed_boot', 'failed_boot_reason', 'last_boot_attempt', 'blocked_clouds',
+                 'schedd')
+
+    log = logging.getLogger("cloudscheduler")
+
     # A list of possible statuses for internal job representation
     SCHEDULED = "Scheduled"
     UNSCHEDULED = "Unscheduled"
     statuses = (SCHEDULED, UNSCHEDULED)
 
+    # Requirements are kept in a shared RequirementProfile
+    req_vmtype = _profile_property('vmtype')
+    req_network = _profile_property('network')
+    req_memory = _profile_property('memory')
+    req_cpucores = _profile_property('cpucores')
+    req_storage = _profile_property('storage')
+    req_ami = _profile_property('ami')
+    instance_type = _profile_property('instance_type')
+    target_clouds = _profile_property('target_clouds')
+    req_security_group = _profile_property('security_groups')
+    user_data = _profile_property('user_data')
+
     def __init__(self, GlobalJobId="None", Owner="Default-User", JobPrio=1,
                  JobStatus=0, ClusterId=0, ProcId=0, VMType=None, VMNetwork=None,
                  VMCPUCores=None, VMName=None, VMLoc=None, VMAMI=None, VMMem=None,
@@ -62,7 +217,7 @@ class Job(object):
                  VMInstanceType=None,
                  VMMaximumPrice=None, VMJobPerCore=False,
                  TargetClouds=None, ServerTime=0, JobStartDate=0,
-                 VMProxyNonBoot=config_val.getboolean('job', 'default_VMProxyNonBoot'),
+                 VMProxyNonBoot=None,
                  VMImageProxyFile=None, VMTypeLimit=-1, VMImageID=None,
                  VMLocation=None, VMKeyName=None, VMSecurityGroup="", VMUserData="",
                  VMAMIConfig=None, VMInjectCA=None, **kwargs):
@@ -98,35 +253,37 @@ class Job(object):
 
      """
 
-        self.log = logging.getLogger("cloudscheduler")
+        defaults = job_defaults
         if not VMType:
-            VMType = config_val.get('job', 'default_VMType')
+            VMType = defaults.vmtype
         if not VMNetwork:
-            VMNetwork = config_val.get('job', 'default_VMNetwork')
+            VMNetwork = defaults.network
         if not VMName:
-            VMName = config_val.get('job', 'default_VMName')
+            VMName = defaults.name
         if not VMLoc:
             VMLoc = ""
         if not VMAMI:
-            VMAMI = _attr_list_to_dict(config_val.get('job', 'default_VMAMI'))
+            VMAMI = defaults.ami
         if not VMInstanceType:
-            VMInstanceType = _attr_list_to_dict(config_val.get('job', 'default_VMInstanceTypeList'))
+            VMInstanceType = defaults.instance_type
         if not VMMem:
-            VMMem = config_val.getint('job', 'default_VMMem')
+            VMMem = defaults.memory
         if not VMCPUCores:
-            VMCPUCores = config_val.getint('job', 'default_VMCPUCores')
+            VMCPUCores = defaults.cpucores
         if not VMStorage:
-            VMStorage = config_val.getint('job', 'default_VMStorage')
+            VMStorage = defaults.storage
         if not TargetClouds:
-            TargetClouds = config_val.get('job', 'default_TargetClouds')
+            TargetClouds = defaults.target_clouds
         if not VMAMIConfig:
-            VMAMIConfig = config_val.get('job', 'default_VMAMIConfig')
+            VMAMIConfig = defaults.ami_config
         if not VMMaximumPrice:
-            VMMaximumPrice = config_val.getfloat('job', 'default_VMMaximumPrice')
+            VMMaximumPrice = defaults.maximum_price
         if not VMJobPerCore:
-            VMJobPerCore = config_val.getboolean('job', 'default_VMJobPerCore')
+            VMJobPerCore = defaults.job_per_core
         if not VMInjectCA:
-            VMInjectCA = config_val.getboolean('job', 'default_VMInjectCA')
+            VMInjectCA = defaults.inject_ca
+        if VMProxyNonBoot is None:
+            VMProxyNonBoot = defaults.proxy_non_boot
 
         self.id = GlobalJobId
         self.user = Owner
@@ -135,30 +292,27 @@ class Job(object):
         self.job_status = int(JobStatus)
         self.cluster_id = int(ClusterId)
         self.proc_id = int(ProcId)
-        self.req_vmtype = VMType
-        self.req_network = VMNetwork
         self.req_image = VMName
         self.req_imageloc = ""
-        self.req_ami = VMAMI
         try:
-            self.req_memory = int(VMMem)
+            req_memory = int(VMMem)
         except:
             self.log.exception("VMMem not int: %s", VMMem)
             raise ValueError
         try:
-            self.req_cpucores = int(VMCPUCores)
+            req_cpucores = int(VMCPUCores)
         except:
             self.log.exception("VMCPUCores not int: %s", VMCPUCores)
             raise ValueError
         try:
-            self.req_storage = int(VMStorage)
+            req_storage = int(VMStorage)
         except:
             self.log.exception("VMStorage not int: %s", VMStorage)
             raise ValueError
         try:
             self.keep_alive = int(VMKeepAlive) * 60 # Convert to seconds
-            if self.keep_alive > config_val.getint('global', 'max_keepalive'):
-                self.keep_alive = config_val.getint('global', 'max_keepalive')
+            if self.keep_alive > defaults.max_keepalive:
+                self.keep_alive = defaults.max_keepalive
         except:
             self.log.exception("VMKeepAlive not int: %s", VMKeepAlive)
             raise ValueError
@@ -167,7 +321,6 @@ class Job(object):
         except:
             self.log.exception("VMHighPriority not int: %s", VMHighPriority)
             raise ValueError
-        self.instance_type = VMInstanceType
         try:
             self.maximum_price = float(VMMaximumPrice)
         except:
@@ -204,8 +357,6 @@ class Job(object):
         self.req_image_id = VMImageID
         self.location = VMLocation
         self.key_name = VMKeyName
-        self.req_security_group = splitnstrip(',', VMSecurityGroup)
-        self.user_data = splitnstrip(',', VMUserData)
         self.ami_config = VMAMIConfig
         self.use_cloud_init = True
         self.inject_ca = VMInjectCA in ['true', 'True', True, 'TRUE']
@@ -221,19 +372,39 @@ class Job(object):
         self.failed_boot_reason = set()
         self.last_boot_attempt = None
         self.blocked_clouds = []
-        self.target_clouds = []
+        # The schedd query this job came from, set by the JobPool
+        self.schedd = None
+        target_clouds = []
         try:
             if TargetClouds and len(TargetClouds) != 0:
                 for cloud in TargetClouds.split(','):
-                    self.target_clouds.append(cloud.strip().strip('"').strip("'"))
+                    target_clouds.append(cloud.strip().strip('"').strip("'"))
         except:
             self.log.error("Failed to parse TargetClouds - use a comma separated list")
+        self.req_profile = RequirementProfile(VMType, VMNetwork, req_memory, req_cpucores,
+                                              req_storage, VMAMI, VMInstanceType, target_clouds,
+                                              splitnstrip(',', VMSecurityGroup),
+                                              splitnstrip(',', VMUserData))
 
         self.log.verbose('%i extra arguments pass to JobPoller from Condor', len(kwargs))
 
     def __repr__(self):
         return "Job '%s'" % self.id
 
+    def __getstate__(self):
+        """Override to work with pickle module."""
+        state = {}
+        for name in self.__slots__:
+            if hasattr(self, name):
+                state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        """Override to work with pickle module."""
+        for name, value in state.iteritems():
+            if name in self.__slots__:
+                setattr(self, name, value)
+
     def log_info(self):
         """Log a short string representing the job."""
         self.log.info("Job ID: %s, User: %s, Priority: %d, VM Type: %s, Image location: %s, \
@@ -389,11 +560,9 @@ class Job(object):
         return expiry_time <= datetime.datetime.utcnow()
 
     def has_same_reqs(self, job):
-        """A method that will compare a job's requirements listed
-        below with another job to see if they all match."""
-        return self.req_vmtype == job.req_vmtype and self.req_cpucores == job.req_cpucores and \
-        self.req_memory == job.req_memory and self.req_storage == job.req_storage and \
-        self.req_network == job.req_network and self.user == job.user
+        """A method that will compare a job's requirements and user
+        with another job to see if they all match."""
+        return self.req_profile is job.req_profile and self.user == job.user
 
     def get_vmimage_proxy_file_path(self):
         """
@@ -442,6 +611,96 @@ class Job(object):
         """Get the instance type dictionary."""
         return self.instance_type
 
+# The job classad attributes the Job constructor reads, plus Requirements which
+# is parsed for VMType, Memory, Disk and Cpus. With condor_attribute_projection
+# enabled these are the only attributes requested from condor_q.
+JOB_QUERY_ATTRIBUTES = tuple(inspect.getargspec(Job.__init__)[0][1:]) + ("Requirements",)
+
+# The job classad attributes needed to refresh a job already in the job
+# container, used by delta polling.
+JOB_STATUS_ATTRIBUTES = ("GlobalJobId", "ClusterId", "ProcId", "JobStatus", "RemoteHost",
+                         "ServerTime", "JobStartDate")
+
+
+class RequirementsCache(object):
+    """
+    Extracts the VMType, Memory, Disk and Cpus values from job Requirements
+    expressions in a single pass, remembering the results for the most
+    recently seen expressions. Jobs from the same submission share the same
+    Requirements string so most lookups are hits.
+    """
+
+    # VMType =?= "value" or one of Memory, Disk, Cpus compared with a number
+    REQUIREMENTS_RE = re.compile(r"(?P<str_attr>VMType)\s=\?=\s\"(?P<str_value>[^\"]+)\""
+                                 r"|(?P<attr>Memory|Disk|Cpus)\s[<>=][<>=]\s(?P<value>[^\"\s]+)")
+    ATTRIBUTES = ("VMType", "Memory", "Disk", "Cpus")
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def extract(self, requirements):
+        """Return a dictionary of the VMType, Memory, Disk and Cpus values in a
+        Requirements expression, with "" for the ones not found.
+        The dictionary is shared between callers and must not be modified.
+        """
+        with self.lock:
+            try:
+                values = self.cache.pop(requirements)
+                self.hits += 1
+            except KeyError:
+                values = self._parse(requirements)
+                self.misses += 1
+                if len(self.cache) >= self.max_size:
+                    self.cache.popitem(last=False)
+            self.cache[requirements] = values
+        return values
+
+    def _parse(self, requirements):
+        values = dict.fromkeys(self.ATTRIBUTES, "")
+        for match in self.REQUIREMENTS_RE.finditer(requirements):
+            if match.group("str_attr"):
+                attribute, value = match.group("str_attr", "str_value")
+            else:
+                attribute, value = match.group("attr", "value")
+            # Only the first occurrence of each attribute counts
+            if not values[attribute]:
+                values[attribute] = value
+        return values
+
+    def clear(self):
+        """Empty the cache and reset the hit and miss counters."""
+        with self.lock:
+            self.cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+requirements_cache = RequirementsCache()
+
+
+class JobQueryResult(object):
+    """
+    Iterable over the jobs returned by one job query, merged from the queries
+    of all schedds. While it is being iterated every schedd is sorted into
+    full_schedds (returned its whole queue), delta_schedds (returned the jobs
+    changed since the previous poll) or failed_schedds. update_jobs only
+    removes the missing jobs of the schedds in full_schedds.
+    """
+
+    def __init__(self, jobs, full_schedds=(), delta_schedds=(), failed_schedds=()):
+        self.jobs = jobs
+        self.full_schedds = set(full_schedds)
+        self.delta_schedds = set(delta_schedds)
+        self.failed_schedds = set(failed_schedds)
+
+    def __iter__(self):
+        return iter(self.jobs)
+
+
 class JobPool(object):
     """ A pool of all jobs read from the job scheduler. Stores all jobs until they
  complete. Keeps scheduled and unscheduled jobs.
@@ -466,6 +725,16 @@ class JobPool(object):
     # can take a REALLY long time to return the XML list of jobs
     CONDOR_TIMEOUT = 1200 # seconds (20min)
 
+    # How many new job ids to fetch full ads for per condor_q in delta polling
+    DELTA_QUERY_CHUNK_SIZE = 500
+
+    # How many parsed jobs the schedd query workers may queue up ahead of
+    # update_jobs, and what became of each schedd query
+    MERGED_QUEUE_SIZE = 1000
+    QUERY_FULL = "full"
+    QUERY_DELTA = "delta"
+    QUERY_FAILED = "failed"
+
     ## Instance Methods
 
     def __init__(self, name, condor_query_type=""):
@@ -485,14 +754,40 @@ class JobPool(object):
         self.last_query = None
         self.write_lock = threading.RLock()
 
+        # One condor_q command per schedd, they are queried concurrently
+        self.schedd_commands = [command.strip() for command in
+                                config_val.get('global', 'condor_q_command').splitlines()
+                                if command.strip()]
+        # Schedds queried with the bindings retrieval method, "" is the local schedd
+        self.schedd_names = [schedd for schedd in
+                             splitnstrip(',', config_val.get('global', 'condor_schedd_names'))
+                             if schedd] or [""]
+        self.query_workers = config_val.getint('global', 'condor_q_workers')
+        self.query_timeout = config_val.getint('global', 'condor_q_timeout')
+
+        # Delta polling state per schedd, schedd_servertime is the newest
+        # ServerTime seen in a completed query of the schedd.
+        self.delta_polling = config_val.getboolean('global', 'job_delta_polling')
+        self.delta_resync_cycles = config_val.getint('global', 'job_delta_resync_cycles')
+        self.schedd_polls_since_resync = defaultdict(int)
+        self.schedd_servertime = {}
+
         if not condor_query_type:
             condor_query_type = config_val.get('global', 'condor_retrieval_method')
 
         if condor_query_type.lower() == "local":
             self.job_query = self.job_query_local
+            self.job_hold = self.job_hold_local
+            self.job_release = self.job_release_local
+        elif condor_query_type.lower() == "bindings" and condor_bindings.available():
+            self.job_query = self.job_query_bindings
+            self.job_hold = self.job_hold_bindings
+            self.job_release = self.job_release_bindings
         else:
             self.log.error("Can't use '%s' retrieval method. Using local method.", condor_query_type)
             self.job_query = self.job_query_local
+            self.job_hold = self.job_hold_local
+            self.job_release = self.job_release_local
 
         if config_val.get('global', 'job_distribution_type').lower() == "normal":
             #self.job_type_distribution = self.job_type_distribution_normal
@@ -517,123 +812,390 @@ class JobPool(object):
         return jobs
 
     def job_query_local(self):
-        """job_query_local -- query and parse condor_q for job information."""
-        self.log.verbose("Querying Condor scheduler daemon (schedd) with %s",
-                         config_val.get('global', 'condor_q_command'))
+        """job_query_local -- query the schedds with condor_q for job information.
+
+        Runs the condor_q_command of every schedd in a pool of at most
+        condor_q_workers threads and returns a JobQueryResult merging their
+        output as it is being parsed, one Job at a time. A schedd whose
+        condor_q fails or runs longer than condor_q_timeout seconds ends up
+        in failed_schedds and does not hold up the jobs of the others.
+
+        With job_delta_polling enabled a schedd is only asked for its full
+        queue every job_delta_resync_cycles-th poll, the other polls go
+        through _schedd_delta_query.
+        """
+        result = JobQueryResult(None)
+        result.jobs = self._merged_job_stream(result, self.schedd_commands,
+                                              self._condor_q_schedd_query)
+        return result
+
+    def job_query_bindings(self):
+        """job_query_bindings -- query the schedds through the htcondor bindings.
+
+        Queries the schedds named in condor_schedd_names the same way
+        job_query_local runs the condor_q commands. Job ads come straight
+        from Schedd.xquery, projected to the attributes a Job uses.
+        """
+        result = JobQueryResult(None)
+        result.jobs = self._merged_job_stream(result, self.schedd_names,
+                                              self._bindings_schedd_query)
+        return result
+
+    def _condor_q_schedd_query(self, schedd, delta):
+        """
+        _condor_q_schedd_query - Start the full or delta condor_q query of a
+                schedd, returns a generator of Jobs.
+        """
+        if delta:
+            return self._schedd_delta_query(schedd)
+        return self._schedd_full_query(schedd)
+
+    def _bindings_schedd_query(self, schedd, delta):
+        """
+        _bindings_schedd_query - Generator of the Jobs of a schedd queried
+                through the htcondor bindings. A delta query asks for the
+                jobs whose status changed since the last poll.
+        """
+        constraint = "true"
+        if delta:
+            constraint = "EnteredCurrentStatus >= %d" % self.schedd_servertime[schedd]
+        self.log.verbose("Querying Condor scheduler daemon (schedd) '%s' for jobs where %s",
+                         schedd, constraint)
+        for job in self._classads_to_job_stream(
+                condor_bindings.query_jobs(schedd, constraint, JOB_QUERY_ATTRIBUTES)):
+            yield job
+        self.last_query = datetime.datetime.now()
+
+    def _merged_job_stream(self, result, schedds, schedd_query):
+        """
+        _merged_job_stream - Generator yielding the jobs of all schedd queries
+                as the worker threads parse them, and sorting the schedds
+                into the sets of result as their queries finish.
+
+                schedd_query(schedd, delta) starts the query of one schedd
+                and returns an iterable of its Jobs.
+        """
+        pending = Queue.Queue()
+        for schedd in schedds:
+            pending.put(schedd)
+        merged = Queue.Queue(self.MERGED_QUEUE_SIZE)
+        stop = threading.Event()
+        for i in range(min(self.query_workers, len(schedds))):
+            worker = threading.Thread(target=self._schedd_query_worker,
+                                      args=(pending, schedd_query, merged, stop))
+            worker.daemon = True
+            worker.start()
+
         try:
-            condor_q = shlex.split(config_val.get('global', 'condor_q_command'))
-            sub_p = subprocess.Popen(condor_q, shell=False,
-                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            (condor_out, condor_err) = sub_p.communicate(input=None)
-            returncode = sub_p.returncode
+            finished = 0
+            while finished < len(schedds):
+                item = merged.get()
+                if isinstance(item, Job):
+                    yield item
+                    continue
+                schedd, outcome = item
+                if outcome == self.QUERY_FULL:
+                    result.full_schedds.add(schedd)
+                elif outcome == self.QUERY_DELTA:
+                    result.delta_schedds.add(schedd)
+                else:
+                    result.failed_schedds.add(schedd)
+                finished += 1
+        finally:
+            # Consumer stopped early, let the workers go
+            stop.set()
+
+    def _schedd_query_worker(self, pending, schedd_query, merged, stop):
+        """
+        _schedd_query_worker - Query schedds from pending until there are
+                none left, passing their jobs and a (schedd, outcome) tuple
+                for each finished query to merged.
+        """
+        while not stop.is_set():
+            try:
+                schedd = pending.get_nowait()
+            except Queue.Empty:
+                return
+            outcome = self._query_schedd(schedd, schedd_query, merged, stop)
+            self._put_until_stopped(merged, (schedd, outcome), stop)
+
+    def _query_schedd(self, schedd, schedd_query, merged, stop):
+        """
+        _query_schedd - Run the job query of one schedd, tagging its jobs with
+                the schedd and passing them to merged.
+
+                Returns QUERY_FULL, QUERY_DELTA or QUERY_FAILED.
+        """
+        delta = self.delta_polling and schedd in self.schedd_servertime and \
+                self.schedd_polls_since_resync[schedd] < self.delta_resync_cycles
+        try:
+            jobs = schedd_query(schedd, delta)
+            for job in jobs:
+                job.schedd = schedd
+                if not self._put_until_stopped(merged, job, stop):
+                    jobs.close()
+                    return self.QUERY_FAILED
+        except CondorQueryError, e:
+            self.log.error("Job query of schedd '%s' failed (%s), keeping its jobs this cycle.",
+                           schedd, e)
+            return self.QUERY_FAILED
         except:
-            self.log.exception("Problem running %s, unexpected error", string.join(condor_q, " "))
-            return None
+            self.log.exception("Problem reading job query of schedd '%s', keeping its jobs this cycle.",
+                               schedd)
+            return self.QUERY_FAILED
+        return self.QUERY_DELTA if delta else self.QUERY_FULL
+
+    @staticmethod
+    def _put_until_stopped(merged, item, stop):
+        """
+        _put_until_stopped - Put item on the merged queue, giving up once stop
+                is set. Returns True if the item was queued.
+        """
+        while not stop.is_set():
+            try:
+                merged.put(item, True, 1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _schedd_full_query(self, schedd):
+        """
+        _schedd_full_query - Start condor_q for the whole queue of a schedd.
+
+                Returns a generator of Jobs which raises CondorQueryError
+                once the output is exhausted if condor_q failed.
+        """
+        self.log.verbose("Querying Condor scheduler daemon (schedd) with %s", schedd)
+        condor_q = self._condor_q_command(schedd)
+        if config_val.getboolean('global', 'condor_attribute_projection'):
+            condor_q.extend(['-attributes', ','.join(JOB_QUERY_ATTRIBUTES)])
+        condor_q_lines = self._start_condor_q(condor_q)
+        if condor_q_lines is None:
+            raise CondorQueryError("Could not start %s" % condor_q[0])
+        return self._classads_to_job_stream(self._condor_q_classads(condor_q_lines))
+
+    def _schedd_delta_query(self, schedd):
+        """
+        _schedd_delta_query - Start condor_q for the jobs of a schedd changed
+                since its last poll.
+
+                Asks condor_q for the status attributes of jobs whose
+                EnteredCurrentStatus is not older than the last ServerTime
+                seen from the schedd, then fetches full job ads for the ones
+                not yet in the job container.
+        """
+        self.log.verbose("Querying Condor scheduler daemon (schedd) with %s for jobs changed since %s",
+                         schedd, self.schedd_servertime[schedd])
+        condor_q = self._condor_q_command(schedd)
+        condor_q.extend(['-constraint', 'EnteredCurrentStatus >= %d' % self.schedd_servertime[schedd],
+                         '-attributes', ','.join(JOB_STATUS_ATTRIBUTES)])
+        condor_q_lines = self._start_condor_q(condor_q)
+        if condor_q_lines is None:
+            raise CondorQueryError("Could not start %s" % condor_q[0])
+        return self._condor_q_delta_job_stream(schedd, condor_q_lines)
+
+    def _condor_q_delta_job_stream(self, schedd, condor_q_lines):
+        """
+        _condor_q_delta_job_stream - Generator yielding status-only Jobs for
+                the known jobs in a _schedd_delta_query result, followed by
+                fully populated Jobs for the new ones.
+        """
+        new_job_ids = []
+        for classad in self._condor_q_classads(condor_q_lines):
+            if self.job_container.has_job(classad.get("GlobalJobId")):
+                try:
+                    yield Job(**classad)
+                except:
+                    self.log.exception("Failed to read status of job: %s",
+                                       classad.get("GlobalJobId"))
+            else:
+                new_job_ids.append("%s.%s" % (classad.get("ClusterId"), classad.get("ProcId")))
+
+        if new_job_ids:
+            self.log.verbose("Fetching job ads for %d new jobs", len(new_job_ids))
+        for i in range(0, len(new_job_ids), self.DELTA_QUERY_CHUNK_SIZE):
+            condor_q = self._condor_q_command(schedd)
+            condor_q.extend(new_job_ids[i:i + self.DELTA_QUERY_CHUNK_SIZE])
+            if config_val.getboolean('global', 'condor_attribute_projection'):
+                condor_q.extend(['-attributes', ','.join(JOB_QUERY_ATTRIBUTES)])
+            condor_q_lines = self._start_condor_q(condor_q)
+            if condor_q_lines is None:
+                raise CondorQueryError("Could not start %s" % condor_q[0])
+            for job in self._classads_to_job_stream(self._condor_q_classads(condor_q_lines)):
+                yield job
+
+    @staticmethod
+    def _condor_q_command(schedd):
+        """
+        _condor_q_command - Split the condor_q command of a schedd, asking for
+                JSON output if condor_classad_format is json.
+        """
+        condor_q = shlex.split(schedd)
+        if config_val.get('global', 'condor_classad_format') == "json":
+            condor_q.append('-json')
+        return condor_q
+
+    @staticmethod
+    def _condor_q_classads(condor_q_lines):
+        """
+        _condor_q_classads - Parse condor_q output in the configured
+                condor_classad_format into a stream of classad dictionaries.
+        """
+        if config_val.get('global', 'condor_classad_format') == "json":
+            return json_classad_stream(condor_q_lines)
+        return JobPool._condor_q_to_classad_stream(condor_q_lines)
+
+    def _start_condor_q(self, condor_q):
+        """
+        _start_condor_q - Start a condor_q command.
 
-        if returncode != 0:
-            self.log.error("Got non-zero return code '%s' from '%s'. stderr was: %s",
-                           returncode, string.join(condor_q, " "), condor_err)
+                Returns a generator over its output lines, or None if the
+                command could not be started. condor_q is stopped if it is
+                still running after condor_q_timeout, its output then ends
+                and the query fails.
+        """
+        try:
+            lines = command_runner.stream_command(condor_q, self.query_timeout)
+        except command_runner.CommandError, e:
+            self.log.error("Problem running condor_q: %s", e)
             return None
+        return self._condor_q_lines(lines)
+
+    def _condor_q_lines(self, lines):
+        """
+        _condor_q_lines - Generator yielding the stdout lines of a running
+                condor_q process.
 
-        job_ads = self._condor_q_to_job_list(condor_out)
+                Raises CondorQueryError after the last line if condor_q
+                failed or timed out.
+        """
+        try:
+            for line in lines:
+                yield line
+        except command_runner.CommandError, e:
+            self.log.error("%s", e)
+            raise CondorQueryError(str(e))
+        finally:
+            lines.close()
         self.last_query = datetime.datetime.now()
-        return job_ads
 
-    def _condor_q_to_job_list(self, condor_q_output):
+    @staticmethod
+    def _condor_q_to_job_list(condor_q_output):
         """
         _condor_q_to_job_list - Converts the output of condor_q
                 to a list of Job Objects
 
                 returns [] if there are no jobs
         """
+        return list(JobPool._condor_q_to_job_stream(condor_q_output.splitlines()))
 
-        def _attribute_from_requirements(requirements, attribute):
-            regex = r"%s\s=\?=\s\"(?P<value>[^\"].+?)\"" % attribute
-            match = re.search(regex, requirements)
-            if match:
-                return match.group("value")
-            else:
-                return ""
+    @staticmethod
+    def _condor_q_to_job_stream(condor_q_lines):
+        """
+        _condor_q_to_job_stream - Converts lines of condor_q -l output to a
+                stream of Job Objects, one classad at a time.
+        """
+        return JobPool._classads_to_job_stream(JobPool._condor_q_to_classad_stream(condor_q_lines))
 
-        def _attribute_from_requirements_alt(requirements, attribute):
-            regex = r"%s\s[<>=][<>=]\s(?P<value>[^\"].+?)\s" % attribute
-            match = re.search(regex, requirements)
-            if match:
-                return match.group("value")
-            else:
-                return ""
+    @staticmethod
+    def _classads_to_job_stream(classads):
+        """
+        _classads_to_job_stream - Generator converting classad dictionaries
+                to Job Objects.
+        """
+        for classad in classads:
+            job = JobPool._classad_to_job(classad)
+            if job:
+                yield job
 
-        def _attribute_from_list(self, classad, attribute):
+    @staticmethod
+    def _condor_q_to_classad_stream(condor_q_lines):
+        """
+        _condor_q_to_classad_stream - Generator converting lines of condor_q
+                output to dictionaries of classad attributes.
+        """
+        log = logging.getLogger("cloudscheduler")
+        classad = {}
+        for classad_line in condor_q_lines:
+            classad_line = classad_line.strip()
+            # Each classad is seperated by a blank line
+            if not classad_line:
+                if classad:
+                    yield classad
+                    classad = {}
+                continue
+            # Skip the header lines that look like:
+            # -- Submitter: hostname : <ip> : hostname
+            try:
+                (classad_key, classad_value) = classad_line.split(" = ", 1)
+            except ValueError:
+                if "Submitter:" not in classad_line:
+                    log.verbose("Skipping unexpected condor_q line: %s", classad_line)
+                continue
+            classad[classad_key] = classad_value.strip('"')
+
+        if classad:
+            yield classad
+
+    @staticmethod
+    def _classad_to_job(classad):
+        """
+        _classad_to_job - Build a Job from a parsed job classad dictionary.
+
+                returns None if the Job could not be created
+        """
+        log = logging.getLogger("cloudscheduler")
+
+        def _attribute_from_list(classad, attribute):
             try:
                 attr_list = classad[attribute]
                 try:
                     attr_dict = _attr_list_to_dict(attr_list)
                     classad[attribute] = attr_dict
                 except ValueError:
-                    self.log.exception("Problem extracting %s attribute '%s'" % (attribute, attr_list))
+                    log.exception("Problem extracting %s attribute '%s'" % (attribute, attr_list))
             except:
                 pass
 
-        jobs = []
-
-        # The first three lines look like:
-        # \n\n\t-- Submitter: hostname : <ip> : hostname
-        # we can just strip these.
-        condor_q_output = re.sub('\n\n.*?Submitter:.*?\n', "", condor_q_output, re.MULTILINE)
-
-        # Each classad is seperated by '\n\n'
-        raw_job_classads = condor_q_output.split("\n\n")
-        # Empty condor pools give us an empty string in our list
-        raw_job_classads = filter(lambda x: x != "", raw_job_classads)
-
-        for raw_classad in raw_job_classads:
-            classad = {}
-            classad_lines = raw_classad.splitlines()
-            for classad_line in classad_lines:
-                classad_line = classad_line.strip()
-                (classad_key, classad_value) = classad_line.split(" = ", 1)
-                classad_value = classad_value.strip('"')
-                classad[classad_key] = classad_value
+        requirements = None
+        try:
+            requirements = requirements_cache.extract(classad["Requirements"])
+            classad["VMType"] = requirements["VMType"]
+        except:
+            log.exception("Problem extracting VMType from Requirements")
 
-            try:
-                classad["VMType"] = _attribute_from_requirements(classad["Requirements"], "VMType")
-            except:
-                self.log.exception("Problem extracting VMType from Requirements")
-
-            if config_val.getboolean('global', 'vm_reqs_from_condor_reqs'):
-                if not classad.has_key("VMMem"):
-                    try:
-                        classad["VMMem"] = \
-                            int(_attribute_from_requirements_alt(classad["Requirements"], "Memory"))
-                    except:
-                        self.log.exception("Problem extracting Memory from Requirements")
-                if not classad.has_key("VMStorage"):
-                    try:
-                        classad["VMStorage"] = \
-                            int(_attribute_from_requirements_alt(classad["Requirements"], "Disk")) / 1000000
-                        if classad["VMStorage"] < 1:
-                            classad["VMStorage"] = 1
-                    except:
-                        self.log.exception("Problem extracting Disk from Requirements")
-                if not classad.has_key("VMCPUCores"):
-                    try:
-                        classad["VMCPUCores"] = \
-                            int(_attribute_from_requirements_alt(classad["Requirements"], "Cpus"))
-                    except:
-                        self.log.exception("Problem extracting Cpus from Requirements")
-            # VMAMI requires special fiddling
-            _attribute_from_list(classad, "VMAMI")
-            _attribute_from_list(classad, "VMInstanceType")
+        if config_val.getboolean('global', 'vm_reqs_from_condor_reqs'):
+            if not classad.has_key("VMMem"):
+                try:
+                    classad["VMMem"] = int(requirements["Memory"])
+                except:
+                    log.exception("Problem extracting Memory from Requirements")
+            if not classad.has_key("VMStorage"):
+                try:
+                    classad["VMStorage"] = int(requirements["Disk"]) / 1000000
+                    if classad["VMStorage"] < 1:
+                        classad["VMStorage"] = 1
+                except:
+                    log.exception("Problem extracting Disk from Requirements")
+            if not classad.has_key("VMCPUCores"):
+                try:
+                    classad["VMCPUCores"] = int(requirements["Cpus"])
+                except:
+                    log.exception("Problem extracting Cpus from Requirements")
+        # VMAMI requires special fiddling
+        _attribute_from_list(classad, "VMAMI")
+        _attribute_from_list(classad, "VMInstanceType")
 
-            try:
-                jobs.append(Job(**classad))
-            except ValueError:
-                self.log.exception("Failed to add job: %s due to Value Errors in jdl.",
-                                   classad["GlobalJobId"])
-            except:
-                self.log.exception("Failed to add job: %s due to unspecified exception.",
-                                   classad["GlobalJobId"])
-        return jobs
+        try:
+            return Job(**classad)
+        except ValueError:
+            log.exception("Failed to add job: %s due to Value Errors in jdl.",
+                          classad.get("GlobalJobId"))
+        except:
+            log.exception("Failed to add job: %s due to unspecified exception.",
+                          classad.get("GlobalJobId"))
+        return None
 
     def update_jobs(self, query_jobs):
         """Updates the system jobs:
@@ -641,83 +1203,97 @@ class JobPool(object):
             - Ignores jobs already in the system and still in Condor
             - Adds all new jobs to the system
            Keywords:
-            - query_jobs - (list of Job objects) The jobs received from a condor query
+            - query_jobs - (iterable of Job objects) The jobs received from a condor
+                           query. May be a generator, jobs are consumed one at a time
+                           so only their ids are held for the whole update. If it
+                           is a JobQueryResult, only the missing jobs of schedds in
+                           its full_schedds are removed.
         """
-        # If no jobs recvd, remove all jobs from the system (all have finished or have been removed)
-        if query_jobs == []:
-            self.log.debug("No jobs received from job query. Removing all jobs from the system.")
-            self.job_container.clear()
+        merged = isinstance(query_jobs, JobQueryResult)
+        high_priority_job_support = config_val.getboolean('global', 'high_priority_job_support')
+        # Ids of the jobs condor still knows about (and that we keep)
+        jobs_to_keep = set()
+        # Ids of the jobs condor reports as finished, only needed for merged queries
+        jobs_finished = []
+        jobs_removed_due_status = 0
+        jobs_added = 0
+        jobs_updated = 0
+        # Newest ServerTime seen from each schedd
+        servertimes = {}
+        try:
+            for job in query_jobs:
+                try:
+                    servertimes[job.schedd] = max(servertimes.get(job.schedd), int(job.servertime))
+                except ValueError:
+                    pass
+                # Filter out any jobs in an error status, they get removed below
+                if job.job_status >= self.REMOVED:
+                    jobs_removed_due_status += 1
+                    if merged:
+                        jobs_finished.append(job.id)
+                    continue
+                jobs_to_keep.add(job.id)
+
+                # If the container already knows about the job it is not new
+                # and we simply need to update it.
+                if self.job_container.has_job(job.id):
+                    self.update_job_status(job)
+                    jobs_updated += 1
+                elif job.high_priority == 0 or not high_priority_job_support:
+                    self.add_new_job(job)
+                    jobs_added += 1
+                else:
+                    self.add_high_job(job)
+                    jobs_added += 1
+        except CondorQueryError, e:
+            self.log.error("Job query failed (%s), not removing any jobs this cycle.", e)
+            return
+        except:
+            self.log.exception("Problem reading job query, not removing any jobs this cycle.")
             return
 
-        # Filter out any jobs in an error status (from the given job list)
-        jobs_removed_due_status = 0
-        for job in reversed(query_jobs):
-            if job.job_status >= self.REMOVED:
-                jobs_removed_due_status += 1
-                query_jobs.remove(job)
         self.log.verbose("Jobs removed due to status held, removed, error, complete: %i",
                          jobs_removed_due_status)
-        # Update all system jobs:
-        #   - remove jobs already in the system from the jobs list
-        #   - remove finished jobs (job in system, not in jobs list)
-
-        # DBG: print both jobs dicts before updating system.
-        #self.log.verbose("System jobs prior to system update:")
-        #self.log.verbose("Unscheduled Jobs (new_jobs):")
-        #self.log_unsched_jobs()
-        #self.log.verbose("Scheduled Jobs (sched_jobs):")
-        #self.log_sched_jobs()
-        #self.log.verbose("High Priority Jobs (high_jobs):")
-        #self.log_high_jobs()
+        self.log.verbose("Added %d new jobs, updated job status of %d jobs",
+                         jobs_added, jobs_updated)
+        self.log.verbose("Requirements cache hits: %d, misses: %d",
+                         requirements_cache.hits, requirements_cache.misses)
+
+        if merged:
+            for schedd in query_jobs.full_schedds | query_jobs.delta_schedds:
+                if servertimes.get(schedd):
+                    self.schedd_servertime[schedd] = servertimes[schedd]
+                if schedd in query_jobs.full_schedds:
+                    self.schedd_polls_since_resync[schedd] = 0
+                else:
+                    self.schedd_polls_since_resync[schedd] += 1
+            if query_jobs.failed_schedds:
+                self.log.warning("Keeping the jobs of failed schedd queries: %s",
+                                 ", ".join(sorted(query_jobs.failed_schedds)))
+            removed = []
+            for job_id in jobs_finished:
+                job = self.job_container.get_job_by_id(job_id)
+                if job:
+                    self.remove_system_job(job)
+                    removed.append(job)
+            if query_jobs.full_schedds:
+                removed.extend(self.job_container.remove_all_not_in_ids(
+                    jobs_to_keep, query_jobs.full_schedds))
+            self.track_run_time(removed)
+            return
+
+        # If no jobs recvd, remove all jobs from the system (all have finished or have been removed)
+        if not jobs_to_keep and not jobs_removed_due_status:
+            self.log.debug("No jobs received from job query. Removing all jobs from the system.")
+            self.job_container.clear()
+            return
 
         # Lets remove all jobs in the container that do not appear in the
         # given condor job list.
         # Keep a list of the removed jobs
-        removed = self.job_container.remove_all_not_in(query_jobs)
+        removed = self.job_container.remove_all_not_in_ids(jobs_to_keep)
         self.track_run_time(removed)
 
-        # Now lets loop through the remaining jobs given by condor and
-        # check if each job is in the job container.
-        # If yes, then it means the job is not new (the container already
-        # knows about it) and we simply need to update it.
-        # In that case, we also remove it from the query_jobs, so that
-        # only new jobs will remain in query_jobs after this step.
-        jobs_to_update = []
-        new_jobs = []
-        for job in query_jobs:
-            if self.job_container.has_job(job.id):
-                jobs_to_update.append(job)
-            else:
-                new_jobs.append(job)
-        query_jobs = new_jobs
-
-        # Add all jobs remaining in jobs list to the Unscheduled job set (new_jobs)
-        for job in query_jobs:
-            if job.high_priority == 0 or not \
-           config_val.getboolean('global', 'high_priority_job_support'):
-                self.add_new_job(job)
-            else:
-                self.add_high_job(job)
-        del query_jobs
-
-
-        # Update job status of all the non-new jobs
-        self.log.verbose("Updating job status of %d jobs", len(jobs_to_update))
-        for job in jobs_to_update:
-            self.update_job_status(job)
-            #print job.get_ami_dict()
-            #print job.get_type_dict()
-        del jobs_to_update
-
-        # DBG: print both jobs dicts before updating system.
-        #self.log.verbose("System jobs after system update:")
-        #self.log.verbose("Unscheduled Jobs (new_jobs):")
-        #self.log_unsched_jobs()
-        #self.log.verbose("Scheduled Jobs (sched_jobs):")
-        #self.log_sched_jobs()
-        #self.log.verbose("High Priority Jobs (high_jobs):")
-        #self.log_high_jobs()
-
     def add_new_job(self, job):
         """Add New Job
             Add a new job to the system (in the new_jobs set)
@@ -777,6 +1353,17 @@ class JobPool(object):
         """
         self.job_container.unschedule_job(job.id)
 
+    def update_job_requirements(self, job, **requirements):
+        """Change requirements of a job, e.g. cpucores=4, through the job container
+        so its groupings follow the change.
+
+            Keywords:
+                job - (Job object) The job to change
+                requirements - the RequirementProfile fields to change
+        """
+        if not self.job_container.update_job_requirements(job.id, **requirements):
+            job.req_profile = job.req_profile.replace(**requirements)
+
     def get_required_vmtypes(self):
         """Get a list of required VM types.
 
@@ -1094,67 +1681,97 @@ class JobPool(object):
         return limits
 
     def job_hold_local(self, jobs, reason=""):
-        """job_query_local -- query and parse condor_q for job information."""
-        self.log.verbose("Holding Condor jobs with %s", config_val.get('global', 'condor_hold_command'))
-        try:
-            condor_out = ""
-            condor_err = ""
-            self.log.verbose("Holding jobs via condor_hold.")
-            condor_hold = shlex.split(config_val.get('global', 'condor_hold_command'))
-            if reason:
-                try:
-                    reason_i = condor_hold.index('-reason')
-                    condor_hold[reason_i+1] = reason
-                except ValueError:
-                    condor_hold.append('-reason')
-                    reason = reason.strip('\n')
-                    reason = ' '.join(reason.split('\n'))
-                    condor_hold.append(reason)
-
-            job_ids = [str(job.cluster_id)+"."+str(job.proc_id) for job in jobs]
-            condor_hold.extend(job_ids)
-            self.log.verbose("Popen condor_hold command")
-            self.log.verbose(' '.join(condor_hold))
-            sub_p = subprocess.Popen(condor_hold, shell=False,
-                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            self.log.verbose("Popen communicate condor_hold.")
-            (condor_out, condor_err) = sub_p.communicate(input=None)
-            returncode = sub_p.returncode
-        except:
-            if condor_err:
-                self.log.exception("Problem running %s, unexpected error", string.join(condor_err, " "))
-            else:
-                self.log.exception("Problem running condor_hold, unexpected error.")
-            return None
+        """job_hold_local -- hold jobs with condor_hold.
 
-        if returncode != 0:
-            self.log.error("Got non-zero return code '%s' from '%s'. stderr was: %s", returncode,
-                           string.join(condor_out, " "), condor_err)
-            return None
-        self.log.debug("Out: %s, Err: %s", condor_out, condor_err)
-        return returncode
+        Returns the list of jobs that could not be held.
+        """
+        self.log.verbose("Holding %d Condor jobs with %s", len(jobs),
+                         config_val.get('global', 'condor_hold_command'))
+        condor_hold = shlex.split(config_val.get('global', 'condor_hold_command'))
+        if reason:
+            try:
+                reason_i = condor_hold.index('-reason')
+                condor_hold[reason_i+1] = reason
+            except ValueError:
+                condor_hold.append('-reason')
+                reason = reason.strip('\n')
+                reason = ' '.join(reason.split('\n'))
+                condor_hold.append(reason)
+        return self._condor_job_action(condor_hold, jobs, "held")
 
     def job_release_local(self, jobs):
-        """job_query_local -- query and parse condor_q for job information."""
-        self.log.verbose("Releasing Condor jobs with %s", \
-                    config_val.get('global', 'condor_release_command'))
+        """job_release_local -- release jobs with condor_release.
+
+        Returns the list of jobs that could not be released.
+        """
+        self.log.verbose("Releasing %d Condor jobs with %s", len(jobs),
+                         config_val.get('global', 'condor_release_command'))
+        condor_release = shlex.split(config_val.get('global', 'condor_release_command'))
+        return self._condor_job_action(condor_release, jobs, "released")
+
+    def _condor_job_action(self, command, jobs, done):
+        """
+        _condor_job_action - Run condor_hold or condor_release on jobs.
+
+                The job ids are passed condor_hold_release_chunk_size at a
+                time, and condor_hold_release_workers commands are run at
+                once. Returns the list of jobs the command failed for.
+        """
+        jobs = list(jobs)
+        chunk_size = config_val.getint('global', 'condor_hold_release_chunk_size')
+        chunks = [jobs[i:i + chunk_size] for i in range(0, len(jobs), chunk_size)]
+        results = threaded_map(lambda chunk: self._condor_job_action_chunk(command, chunk, done),
+                               chunks, config_val.getint('global', 'condor_hold_release_workers'),
+                               name="CondorJobAction")
+        failed = []
+        for chunk, chunk_failed in zip(chunks, results):
+            failed.extend(chunk if chunk_failed is None else chunk_failed)
+        if failed:
+            self.log.error("%s failed for %d of %d jobs", command[0], len(failed), len(jobs))
+        return failed
+
+    def _condor_job_action_chunk(self, command, jobs, done):
+        """
+        _condor_job_action_chunk - Run command on one chunk of jobs, returns
+                the jobs it failed for.
+
+                When the command fails, the jobs it reported as done in its
+                "Job 12.0 held" lines still count as successes.
+        """
+        job_ids = ["%s.%s" % (job.cluster_id, job.proc_id) for job in jobs]
         try:
-            condor_release = shlex.split(config_val.get('global', 'condor_release_command'))
-            job_ids = [str(job.cluster_id)+"."+str(job.proc_id) for job in jobs]
-            condor_release.extend(job_ids)
-            sub_p = subprocess.Popen(condor_release, shell=False,
-                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            (_, condor_err) = sub_p.communicate(input=None)
-            returncode = sub_p.returncode
-        except:
-            self.log.exception("Problem running %s, unexpected error", string.join(condor_release, " "))
-            return None
+            result = command_runner.run_command(command + job_ids)
+        except command_runner.CommandError, e:
+            self.log.error("%s", e)
+            return jobs
+        if result.ok:
+            return []
+        self.log.error("Got non-zero return code '%s' from '%s' for %d jobs. stderr was: %s",
+                       result.returncode, command[0], len(jobs), result.stderr)
+        succeeded = set(re.findall(r"Job (\d+\.\d+) %s" % done, result.stdout))
+        return [job for job, job_id in zip(jobs, job_ids) if job_id not in succeeded]
+
+    def job_hold_bindings(self, jobs, reason=""):
+        """job_hold_bindings -- hold jobs through the htcondor bindings.
+
+        Returns the list of jobs that could not be held.
+        """
+        self.log.verbose("Holding %d Condor jobs through the htcondor bindings", len(jobs))
+        failed = condor_bindings.hold_jobs(jobs, reason)
+        if failed:
+            self.log.error("Failed to hold %d of %d jobs", len(failed), len(jobs))
+        return failed
 
-        if returncode != 0:
-            self.log.error("Got non-zero return code '%s' from '%s'. stderr was: %s",
-                           returncode, string.join(condor_release, " "), condor_err)
-            return None
-        return returncode
+    def job_release_bindings(self, jobs):
+        """job_release_bindings -- release jobs through the htcondor bindings.
+
+        Returns the list of jobs that could not be released.
+        """
+        self.log.verbose("Releasing %d Condor jobs through the htcondor bindings", len(jobs))
+        failed = condor_bindings.release_jobs(jobs)
+        if failed:
+            self.log.error("Failed to release %d of %d jobs", len(failed), len(jobs))
+        return failed
 
     def track_run_time(self, removed):
         """Keeps track of the approximate run time of jobs on each VM."""
@@ -1268,3 +1885,16 @@ def _attr_list_to_dict(attr_list):
             raise ValueError("Can't split '%s' into suitable host attribute pair" % host_attr)
 
     return attr_dict
+
+
+def load_job_defaults(config_parser):
+    """
+    load_job_defaults -- rebuild the job defaults snapshot used for new Jobs
+    from config_parser. Called when the configuration is (re)loaded.
+    """
+    global job_defaults
+    job_defaults = JobDefaults.from_config(config_parser)
+    return job_defaults
+
+
+job_defaults = JobDefaults.from_config(config_val)
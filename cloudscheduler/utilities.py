@@ -8,13 +8,15 @@ import sys
 import socket
 import logging
 import subprocess
-import time
 import gzip
-import errno
+import json
+import Queue
+import threading
 from urlparse import urlparse
 from datetime import datetime
 from cStringIO import StringIO
 from collections import deque
+from cloudscheduler import command_runner
 try:
     from OpenSSL import crypto
 except ImportError:
@@ -133,7 +135,10 @@ def get_cert_DN(cert_file_path):
         openssl_cmd = [config_val.get('global', 'openssl_path'), 'x509', '-in',
                        cert_file_path, '-subject', '-noout']
         try:
-            sub_dn = subprocess.Popen(openssl_cmd, stdout=subprocess.PIPE).communicate()[0].strip()[9:]
+            result = command_runner.run_command(openssl_cmd)
+            if not result.ok:
+                raise command_runner.CommandError(result.stderr)
+            sub_dn = result.stdout.strip()[9:]
             return sub_dn
         except:
             log = get_cloudscheduler_logger()
@@ -172,8 +177,10 @@ def get_cert_expiry_time(cert_file_path):
         openssl_cmd = [config_val.get('global', 'openssl_path'), 'x509', '-in',
                        cert_file_path, '-enddate', '-noout']
         try:
-            stdout_stderr = subprocess.Popen(openssl_cmd, stdout=subprocess.PIPE).communicate()
-            datetime_string = stdout_stderr[0].strip().split('=')[1]
+            result = command_runner.run_command(openssl_cmd)
+            if not result.ok:
+                raise command_runner.CommandError(result.stderr)
+            datetime_string = result.stdout.strip().split('=')[1]
             expiry_time = datetime.strptime(datetime_string, '%b %d %H:%M:%S %Y %Z')
             return expiry_time
         except:
@@ -298,6 +305,8 @@ class ErrTrackQueue(object):
 
 class JobRunTrackQueue(object):
     """Job Run-[time] Tracking Queue. Keeps a list of job runtimes for  stats purposes."""
+    __slots__ = ('data', 'name', 'avg')
+
     def __init__(self, name):
         """Initizlizes new queue, of length 10."""
         self.data = deque(maxlen=10)
@@ -311,38 +320,15 @@ class JobRunTrackQueue(object):
             self.avg = total / len(self.data)
         return self.avg
 
+    def __getstate__(self):
+        """Override to work with pickle module."""
+        return {'data': self.data, 'name': self.name, 'avg': self.avg}
 
-def check_popen_timeout(process, timeout=180):
-    """ Timeout feature for subprocess.Popen -
-        polls the process for timeout seconds waiting for it to complete
-        If the process has exited return False (process did not timeout)
-        Else if the process times out attempt to terminate the process
-        or kill if terminate fails and return True (process timed out)
-    """
-    log = get_cloudscheduler_logger()
-    ret = True
-    while timeout > 0:
-        if process.poll() != None:
-            ret = False
-            break
-        time.sleep(1)
-        timeout -= 1
-    if timeout == 0:
-        log.debug("subprocess timed out - attempting to terminate pid %s", process.pid)
-        try:
-            process.terminate()
-        except OSError, e:
-            if e.errno != errno.ESRCH:
-                raise
-        time.sleep(2) # give OS a chance to terminate
-        if process.poll() is None: # Did not terminate
-            log.debug("terminate() on pid %s failed using kill()", process.pid)
-            try:
-                process.kill()
-            except OSError, e:
-                if e.errno != errno.ESRCH:
-                    raise
-    return ret
+    def __setstate__(self, state):
+        """Override to work with pickle module."""
+        self.data = state['data']
+        self.name = state['name']
+        self.avg = state.get('avg', 0)
 
 
 def gzip_userdata(user_data):
@@ -357,3 +343,91 @@ def gzip_userdata(user_data):
         udf.close()
     return udbuf.getvalue()
 
+
+def threaded_map(function, items, workers, name="Worker"):
+    """Call function on each of items from up to workers threads.
+
+    Returns the results in the order of items. A call that raises is logged
+    and gives None.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    pending = Queue.Queue()
+    for item in enumerate(items):
+        pending.put(item)
+
+    def worker():
+        while True:
+            try:
+                i, item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = function(item)
+            except:
+                get_cloudscheduler_logger().exception("Problem in %s thread", name)
+
+    threads = []
+    for _ in range(min(workers, len(items))):
+        thread = threading.Thread(target=worker, name=name)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results
+
+
+# Attribute names of decoded JSON classads, the same few hundred names repeat
+# in every ad so they are converted to str only once.
+_json_classad_keys = {}
+
+
+def _json_classad(pairs):
+    """object_pairs_hook building a classad dict with str keys and values.
+    Expressions come as "/Expr(...)/" strings and are unwrapped."""
+    classad = {}
+    for key, value in pairs:
+        try:
+            key = _json_classad_keys[key]
+        except KeyError:
+            key = _json_classad_keys.setdefault(key, intern(key.encode('utf-8')))
+        if value.__class__ is unicode:
+            value = value.encode('utf-8')
+            if value[:6] == "/Expr(" and value[-2:] == ")/":
+                value = value[6:-2]
+        classad[key] = value
+    return classad
+
+
+def json_classad_stream(lines):
+    """Generator converting lines of condor_q/condor_status -json output to
+    dictionaries of typed classad attributes, decoding one ad at a time.
+
+    condor prints a JSON list with one attribute per line, so an ad is only
+    decoded once a line holding a closing brace has been read. Raises
+    ValueError if the output ends in the middle of an ad.
+    """
+    decoder = json.JSONDecoder(object_pairs_hook=_json_classad)
+    buf = []
+    for line in lines:
+        if not buf and "{" not in line:
+            # List brackets and the separators between ads
+            continue
+        buf.append(line)
+        if "}" not in line:
+            continue
+        text = "".join(buf)
+        start = text.find("{")
+        while start >= 0:
+            try:
+                classad, end = decoder.raw_decode(text, start)
+            except ValueError:
+                # Only a nested ad or a string value closed, read on
+                break
+            yield classad
+            text = text[end:]
+            start = text.find("{")
+        buf = [text] if start >= 0 else []
+    if buf:
+        raise ValueError("JSON classad output ended in the middle of an ad")
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+benchmark_classad_parsing.py - compare the -l text and -json classad parsers
+
+Generates a fixture of job and machine ads in both the condor_q/condor_status
+-l text format and the -json format, and reports how long each parser takes
+to turn them into Job and VMMachine objects. Run it from the top of the
+source tree:
+
+    python scripts/develop/benchmark_classad_parsing.py [count]
+"""
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+import cloudscheduler.utilities as utilities
+utilities.get_cloudscheduler_logger()
+from cloudscheduler.utilities import json_classad_stream
+from cloudscheduler.job_management import JobPool
+from cloudscheduler.cloud_management import ResourcePool
+
+
+def job_ad(i):
+    return [("ClusterId", i / 100), ("ProcId", i % 100),
+            ("GlobalJobId", "bench.example.org#%d.%d#1400000000" % (i / 100, i % 100)),
+            ("Owner", "user%d" % (i % 10)), ("JobPrio", 0), ("JobStatus", 1 + i % 2),
+            ("ServerTime", 1400000100), ("JobStartDate", 1400000000),
+            ("RemoteHost", "slot1@vm-%d.example.org" % i),
+            ("Requirements", ("( VMType =?= \"vmtype%d\" ) && ( TARGET.Arch == \"X86_64\" ) && "
+                              "( TARGET.Memory >= 2048 ) && ( TARGET.Cpus >= 1 )") % (i % 5)),
+            ("VMMem", 2048), ("VMCPUCores", 1), ("VMStorage", 20), ("VMJobPerCore", False)]
+
+
+def machine_ad(i):
+    return [("Name", "slot1@vm-%d.example.org" % i), ("Machine", "vm-%d.example.org" % i),
+            ("MyAddress", "<10.0.%d.%d:40000>" % (i / 250 % 250, i % 250)),
+            ("State", "Claimed"), ("Activity", "Busy"), ("VMType", "vmtype%d" % (i % 5)),
+            ("MyCurrentTime", 1400000100), ("EnteredCurrentState", 1400000000),
+            ("Start", "( Owner == \"user%d\" )" % (i % 10)), ("RemoteOwner", "user%d@example.org" % (i % 10)),
+            ("SlotType", "Static"), ("TotalSlots", 1)]
+
+
+def text_value(value):
+    if isinstance(value, bool):
+        return str(value).lower()
+    if isinstance(value, (int, long)):
+        return str(value)
+    if value.startswith("("):
+        return value
+    return '"%s"' % value
+
+
+def json_value(value):
+    if isinstance(value, basestring) and value.startswith("("):
+        return "/Expr(%s)/" % value
+    return value
+
+
+def to_text(ads):
+    """Format ads like condor_q -l."""
+    for ad in ads:
+        for key, value in ad:
+            yield "%s = %s\n" % (key, text_value(value))
+        yield "\n"
+
+
+def to_json(ads):
+    """Format ads like condor_q -json."""
+    yield "[\n"
+    for i, ad in enumerate(ads):
+        if i:
+            yield ",\n"
+        yield "{\n"
+        yield ",\n".join('  %s: %s' % (json.dumps(key), json.dumps(json_value(value)).replace("/", "\\/"))
+                         for key, value in ad)
+        yield "\n}\n"
+    yield "]\n"
+
+
+def timed(name, count, function):
+    start = time.time()
+    result = function()
+    elapsed = time.time() - start
+    print "%-22s %8d ads %8.2f s %10.1f us/ad" % (name, len(result), elapsed, elapsed * 1e6 / count)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    jobs = [job_ad(i) for i in xrange(count)]
+    machines = [machine_ad(i) for i in xrange(count)]
+    job_text, job_json = list(to_text(jobs)), "".join(to_json(jobs)).splitlines(True)
+    machine_text, machine_json = "".join(to_text(machines)), "".join(to_json(machines))
+    del jobs, machines
+
+    timed("condor_q -l", count,
+          lambda: list(JobPool._condor_q_to_job_stream(job_text)))
+    timed("condor_q -json", count,
+          lambda: list(JobPool._classads_to_job_stream(json_classad_stream(job_json))))
+    timed("condor_status -l", count,
+          lambda: ResourcePool._condor_status_to_vmmachine_list(machine_text))
+    timed("condor_status -json", count,
+          lambda: ResourcePool._condor_status_json_to_vmmachine_list(machine_json))
+
+
+if __name__ == "__main__":
+    main()
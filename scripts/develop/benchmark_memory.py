@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+benchmark_memory.py - measure the resident memory used per Job and per VM object
+
+Creates a number of Job and VM objects the way the job poller and the clusters
+do, and reports the growth of the process RSS divided by the number of objects.
+Run it from the top of the source tree:
+
+    python scripts/develop/benchmark_memory.py [count]
+"""
+import os
+import sys
+import gc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+import cloudscheduler.utilities as utilities
+utilities.get_cloudscheduler_logger()
+from cloudscheduler.job_management import Job
+from cloudscheduler.cluster_tools import VM
+
+
+def rss_bytes():
+    """Return the resident set size of this process in bytes."""
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def measure(name, count, factory):
+    """Create count objects with factory and print the bytes used per object."""
+    gc.collect()
+    before = rss_bytes()
+    objects = [factory(i) for i in xrange(count)]
+    gc.collect()
+    after = rss_bytes()
+    print "%-4s %8d objects %10.1f bytes each" % (name, len(objects), float(after - before) / count)
+    del objects
+
+
+def make_job(i):
+    return Job(GlobalJobId="bench.example.org#%d.%d#1400000000" % (i / 100, i % 100),
+               Owner="user%d" % (i % 10), JobPrio=1, JobStatus=1, ClusterId=i / 100,
+               ProcId=i % 100, VMType="vmtype%d" % (i % 5), VMMem="2048", VMCPUCores="1",
+               VMStorage="20", ServerTime="1400000100", JobStartDate="0")
+
+
+def make_vm(i):
+    return VM(name="vm-%d" % i, id="%08d" % i, vmtype="vmtype%d" % (i % 5),
+              user="user%d" % (i % 10), hostname="vm-%d.example.org" % i,
+              clusteraddr="cloud.example.org", cloudtype="OpenStack", memory=2048,
+              cpucores=1, storage=20)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    measure("Job", count, make_job)
+    measure("VM", count / 10, make_vm)
+
+
+if __name__ == "__main__":
+    main()
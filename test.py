@@ -13,11 +13,78 @@ import cloudscheduler.config
 import cloudscheduler.cloud_management
 import cloudscheduler.job_management
 import cloudscheduler.utilities as utilities
+from cloudscheduler import command_runner
 
 log = utilities.get_cloudscheduler_logger()
 
 held, sys.stderr = sys.stderr, StringIO() # Hide stderr
 
+
+def fake_htcondor_bindings(job_ads=(), startd_ads=(), master_ads=()):
+    """Build fake htcondor and classad modules serving the given ads.
+
+    Holds, releases and condor_offs are recorded in htcondor.actions and
+    htcondor.commands.
+    """
+    import types
+    htcondor = types.ModuleType("htcondor")
+    classad = types.ModuleType("classad")
+
+    class ExprTree(object):
+        def __init__(self, expr):
+            self.expr = expr
+
+        def __str__(self):
+            return self.expr
+
+    class ClassAd(dict):
+        pass
+
+    class Enum(object):
+        def __init__(self, *names):
+            for name in names:
+                setattr(self, name, name)
+
+    class Schedd(object):
+        def __init__(self, location=None):
+            self.location = location
+
+        def xquery(self, requirements="true", projection=()):
+            return [ClassAd(ad) for ad in job_ads]
+
+        def act(self, action, job_ids, reason=None):
+            htcondor.actions.append((action, self.location, list(job_ids), reason))
+            result = ClassAd(("job_%s" % job_id.replace(".", "_"), 1) for job_id in job_ids)
+            result["TotalSuccess"] = len(job_ids)
+            return result
+
+    class Collector(object):
+        def __init__(self, pool=None):
+            self.pool = pool
+
+        def locate(self, daemon_type, name):
+            return name
+
+        def query(self, ad_type, constraint="true", projection=()):
+            ads = startd_ads if ad_type == htcondor.AdTypes.Startd else master_ads
+            return [ClassAd(ad) for ad in ads]
+
+    def send_command(ad, command, target=None):
+        htcondor.commands.append((ad["MyAddress"], command, target))
+
+    classad.ExprTree = ExprTree
+    classad.ClassAd = ClassAd
+    htcondor.Schedd = Schedd
+    htcondor.Collector = Collector
+    htcondor.send_command = send_command
+    htcondor.AdTypes = Enum("Startd", "Master")
+    htcondor.DaemonTypes = Enum("Schedd")
+    htcondor.JobAction = Enum("Hold", "Release")
+    htcondor.DaemonCommands = Enum("DaemonOffPeaceful")
+    htcondor.actions = []
+    htcondor.commands = []
+    return htcondor, classad
+
 class ConfigParserSetsCorrectValues(unittest.TestCase):
 
     def setUp(self):
@@ -188,6 +255,21 @@ class ConfigParserSetsCorrectValues(unittest.TestCase):
     def tearDown(self):
         os.remove(self.configfilename)
 
+class ConfigSetupTests(unittest.TestCase):
+
+    def test_setup_without_config_file(self):
+
+        original = cloudscheduler.config.config_options
+        exists = cloudscheduler.config.os.path.exists
+        cloudscheduler.config.os.path.exists = \
+            lambda path: not path.endswith("cloud_scheduler.conf") and exists(path)
+        try:
+            self.assertEqual(None, cloudscheduler.config.setup())
+            self.assertTrue(cloudscheduler.config.config_options is original)
+        finally:
+            cloudscheduler.config.os.path.exists = exists
+            cloudscheduler.config.config_options = original
+
 class Utilities(unittest.TestCase):
 
     def test_condor_host_match(self):
@@ -683,14 +765,390 @@ MyType = "Machine"
 CanHibernate = true
 
 """
-        condor2native = ResourcePool._condor_status_to_machine_list
+        condor2native = ResourcePool._condor_status_to_vmmachine_list
         no_machines = condor2native(condor_no_machines)
         one_machine = condor2native(condor_one_machine)
         two_machines = condor2native(condor_two_machines)
         self.assertEqual([], no_machines)
-        self.assertEqual("hermes-xen199", one_machine[0]["Name"])
-        self.assertEqual("hermes-xen188", two_machines[0]["Name"])
-        self.assertEqual("hermes-xen199", two_machines[1]["Name"])
+        self.assertEqual("hermes-xen199", one_machine[0].name)
+        self.assertEqual("hermes-xen188", two_machines[0].name)
+        self.assertEqual("hermes-xen199", two_machines[1].name)
+
+    def test_vm_persistence_state(self):
+        import pickle
+        from cloudscheduler.cluster_tools import VM
+
+        vm = VM(name="vm1", id="1234", vmtype="vmtype", user="user", memory=2048)
+        vm.job_run_times.data.append(60)
+        for protocol in (0, 2):
+            loaded = pickle.loads(pickle.dumps(vm, protocol))
+            self.assertEqual(loaded.id, "1234")
+            self.assertEqual(loaded.memory, 2048)
+            self.assertEqual(list(loaded.job_run_times.data), [60])
+
+        # State pickled before VM used __slots__ may miss or have extra attributes
+        state = vm.__getstate__()
+        del state["ssh_port"]
+        state["removed_attribute"] = True
+        loaded = VM.__new__(VM)
+        loaded.__setstate__(state)
+        self.assertEqual(loaded.name, "vm1")
+        self.assertEqual(set(VM().__getstate__()) - set(loaded.__getstate__()),
+                         set(["ssh_port"]))
+
+    def test_condor_status_projected_to_machine_list(self):
+        from cloudscheduler.cloud_management import ResourcePool, VMMachine
+        from cloudscheduler.cloud_management import MACHINE_QUERY_ATTRIBUTES
+        condor_projected = """
+Name = "slot1@hermes-xen199"
+Machine = "hermes-xen199"
+State = "Claimed"
+
+
+Name = "slot2@hermes-xen199"
+Machine = "hermes-xen199"
+State = "Unclaimed"
+
+"""
+        machines = ResourcePool._condor_status_to_vmmachine_list(condor_projected)
+        self.assertEqual(2, len(machines))
+        self.assertEqual("slot2@hermes-xen199", machines[1].name)
+        self.assertEqual("Unclaimed", machines[1].state)
+        self.assertTrue(machines[0].state is intern("Claimed"))
+        self.assertEqual(set(MACHINE_QUERY_ATTRIBUTES), set(VMMachine.CLASSAD_ATTRIBUTES))
+
+        master_addresses = ResourcePool._condor_status_to_master_addresses(
+            'Machine = "hermes-xen199"\nMasterIpAddr = "<10.0.0.1:9618>"\n\n')
+        ResourcePool.set_master_addresses(machines, master_addresses)
+        self.assertEqual("<10.0.0.1:9618>", machines[1].address_master)
+
+    def test_machine_query_snapshot(self):
+        import time
+        from cloudscheduler.cloud_management import ResourcePool, VMMachine
+
+        def slow_startd_query():
+            time.sleep(0.5)
+            return [VMMachine(name="slot1@vm1", machine_name="vm1")]
+
+        def slow_master_query():
+            time.sleep(0.5)
+            return {"vm1": "<10.0.0.1:9618>"}
+
+        resource_pool = ResourcePool.__new__(ResourcePool)
+        resource_pool.resource_query = slow_startd_query
+        resource_pool.master_resource_query = slow_master_query
+        start = time.time()
+        machines = resource_pool.machine_query()
+        # Both queries ran at the same time
+        self.assertTrue(time.time() - start < 0.9)
+        self.assertEqual("<10.0.0.1:9618>", machines[0].address_master)
+
+        resource_pool.publish_machines(machines)
+        resource_pool.publish_machines([])
+        snapshot = resource_pool.machine_snapshot
+        self.assertEqual([], snapshot.vm_machines)
+        self.assertEqual(machines, snapshot.prev_vm_machines)
+        self.assertTrue(resource_pool.prev_vm_machine_list is machines)
+
+    def test_bindings_machine_query(self):
+        from cloudscheduler import condor_bindings
+        from cloudscheduler.cloud_management import ResourcePool
+
+        saved = condor_bindings.htcondor, condor_bindings.classad
+        htcondor, classad = fake_htcondor_bindings(
+            startd_ads=[{"Name": "slot1@vm1", "Machine": "vm1", "State": "Claimed",
+                         "TotalSlots": 1, "MyAddress": "<10.0.0.1:40000>"}],
+            master_ads=[{"Machine": "vm1", "MasterIpAddr": "<10.0.0.1:9618>"}])
+        condor_bindings.htcondor, condor_bindings.classad = htcondor, classad
+        try:
+            resource_pool = ResourcePool.__new__(ResourcePool)
+            machines = resource_pool.resource_query_bindings()
+            resource_pool.set_master_addresses(machines, resource_pool.master_resource_query_bindings())
+            self.assertEqual(1, machines[0].total_slots)
+            self.assertEqual("<10.0.0.1:9618>", machines[0].address_master)
+            self.assertEqual((0, 0, 0, 0), resource_pool.do_condor_off_bindings(
+                "vm1", machines[0].address_startd, machines[0].address_master))
+            self.assertEqual([("<10.0.0.1:40000>", "DaemonOffPeaceful", "STARTD"),
+                              ("<10.0.0.1:9618>", "DaemonOffPeaceful", "MASTER")],
+                             htcondor.commands)
+        finally:
+            condor_bindings.htcondor, condor_bindings.classad = saved
+
+    def test_retire_machines(self):
+        from cloudscheduler.cloud_management import ResourcePool
+
+        resource_pool = ResourcePool.__new__(ResourcePool)
+        sent = []
+        def do_condor_off(machine_name, machine_addr, master_addr):
+            sent.append((machine_name, machine_addr, master_addr))
+            if machine_addr == "<10.0.0.2:40000>":
+                return (1, -1, 0, 0)
+            return (0, 0, 0, 0)
+        resource_pool.do_condor_off = do_condor_off
+        addresses = [("vm%d" % i, "<10.0.0.%d:40000>" % i, "<10.0.0.%d:9618>" % i)
+                     for i in range(1, 21)]
+        results = resource_pool.retire_machines(addresses)
+        self.assertEqual([True] + [False] + [True] * 18, results)
+        self.assertEqual(sorted(addresses), sorted(sent))
+        self.assertEqual([], resource_pool.retire_machines([]))
+
+    def test_condor_off_local_command_error(self):
+        import logging
+        from cloudscheduler.cloud_management import ResourcePool
+
+        class ListHandler(logging.Handler):
+            def __init__(self):
+                logging.Handler.__init__(self)
+                self.messages = []
+            def emit(self, record):
+                self.messages.append(record.getMessage())
+
+        config_val = cloudscheduler.cloud_management.config_val
+        saved = [config_val.get('global', name) for name in
+                 ('condor_off_command', 'cloudscheduler_ssh_key')]
+        config_val.set('global', 'condor_off_command', '/nonexistent/condor_off')
+        config_val.set('global', 'cloudscheduler_ssh_key', '')
+        handler = ListHandler()
+        logger = logging.getLogger("cloudscheduler")
+        logger.addHandler(handler)
+        try:
+            resource_pool = ResourcePool.__new__(ResourcePool)
+            self.assertEqual((-1, -1, -1, -1), resource_pool.do_condor_off_local(
+                "vm1", "<10.0.0.1:40000>", "<10.0.0.1:9618>"))
+            self.assertTrue([message for message in handler.messages
+                             if message.startswith("Could not run /nonexistent/condor_off")])
+        finally:
+            logger.removeHandler(handler)
+            config_val.set('global', 'condor_off_command', saved[0])
+            config_val.set('global', 'cloudscheduler_ssh_key', saved[1])
+
+    def test_machine_slots_grouping(self):
+        from cloudscheduler.cloud_management import ResourcePool, VMMachine
+
+        resource_pool = ResourcePool.__new__(ResourcePool)
+        names = ["vm-1.example.org", "slot1@vm-1.example.org", "slot2@vm-1.example.org",
+                 "vm-1.other.org", "vm-2.example.org", "10.0.0.1", "slot1@10.0.0.1", "vm-10"]
+        machines = [VMMachine(name=name, machine_name=name) for name in names]
+        resource_pool.publish_machines(machines)
+        for hostname in ["vm-1", "vm-1.example.org", "vm-2.other.org", "10.0.0.1", "10",
+                         "vm-3", None]:
+            criteria = {'machine_name': hostname}
+            # A copy of the list is checked slot by slot
+            self.assertEqual(resource_pool.find_in_where_fuzzy_hosts(list(machines), criteria),
+                             resource_pool.find_in_where_fuzzy_hosts(machines, criteria))
+        self.assertEqual(4, len(resource_pool.find_in_where_fuzzy_hosts(
+            machines, {'machine_name': "vm-1.example.org"})))
+
+    def test_machine_index_queries(self):
+        from cloudscheduler.cloud_management import ResourcePool, VMMachine
+
+        resource_pool = ResourcePool.__new__(ResourcePool)
+        machines = []
+        for i, (vmtype, state, activity) in enumerate([
+                ("a", "Unclaimed", "Idle"), ("a", "Claimed", "Busy"), ("b", "Unclaimed", "Idle"),
+                ("a", "Unclaimed", "Idle"), ("b", "Claimed", "Idle"), (None, "Owner", "Idle")]):
+            machines.append(VMMachine(name="slot%d@vm" % i, vmtype=vmtype, state=state,
+                                      activity=activity))
+        resource_pool.publish_machines(machines)
+        for criteria in [{'vmtype': "a", 'state': "Unclaimed", 'activity': "Idle"},
+                         {'vmtype': "b"}, {'vmtype': "a", 'activity': "Busy"},
+                         {'state': "Unclaimed", 'activity': "Idle"}, {'vmtype': "c"},
+                         {'name': "slot4@vm", 'state': "Claimed"}]:
+            # A copy of the list is checked machine by machine
+            self.assertEqual(resource_pool.find_in_where(list(machines), criteria),
+                             resource_pool.find_in_where(machines, criteria))
+        found = resource_pool.find_in_where(machines, {'vmtype': "a"})
+        self.assertEqual([machines[0], machines[1], machines[3]], found)
+        # Callers get their own list to change
+        found.pop()
+        self.assertEqual(3, len(resource_pool.find_in_where(machines, {'vmtype': "a"})))
+
+    def test_cluster_back_references(self):
+        import copy
+        import pickle
+        from cloudscheduler.cloud_management import ResourcePool
+        from cloudscheduler.cluster_tools import ICluster, VM, VMList
+
+        resource_pool = ResourcePool.__new__(ResourcePool)
+        resource_pool.resources = [ICluster(name="cloud0"), ICluster(name="cloud1")]
+        resource_pool.retired_resources = []
+        resource_pool.target_cloud_aliases = {}
+        resource_pool._index_clusters()
+        cloud0, cloud1 = resource_pool.resources
+        self.assertTrue(resource_pool.get_cluster("cloud1") is cloud1)
+        self.assertEqual(None, resource_pool.get_cluster("cloud2"))
+        self.assertEqual([cloud1], resource_pool.filter_resources_by_names(["Cloud1", "cloud2"]))
+
+        vm0, vm1 = VM(id="0"), VM(id="1")
+        cloud0.vms.extend([vm0, vm1])
+        self.assertTrue(resource_pool.get_cluster_with_vm(vm0) is cloud0)
+        cloud1.vms.append(cloud0.vms.pop())
+        self.assertTrue(resource_pool.get_cluster_with_vm(vm1) is cloud1)
+        cloud1.vms = VMList(sorted(cloud1.vms, key=lambda vm: vm.id))
+        self.assertTrue(vm1.cluster is cloud1)
+        cloud1.vms.remove(vm1)
+        self.assertEqual(None, resource_pool.get_cluster_with_vm(vm1))
+
+        # Retiring copy of a cluster
+        cloud0_copy = copy.deepcopy(cloud0)
+        self.assertTrue(cloud0_copy.vms[0].cluster is cloud0_copy)
+        cloud0_copy.vms = VMList()
+        cloud0_copy.vms.append(cloud0.vms.pop())
+        resource_pool.retired_resources.append(cloud0_copy)
+        self.assertTrue(vm0.cluster is cloud0_copy)
+        self.assertEqual(None, resource_pool.get_cluster_with_vm(vm0))
+
+        # Reloaded from persistence
+        cloud1.vms.append(vm1)
+        reloaded = pickle.loads(pickle.dumps(cloud1))
+        self.assertTrue(reloaded.vms[0].cluster is reloaded)
+        self.assertTrue(vm1.cluster is cloud1)
+
+    def test_vm_totals(self):
+        import pickle
+        from cloudscheduler.cloud_management import ResourcePool
+        from cloudscheduler.cluster_tools import ICluster, VM
+
+        resource_pool = ResourcePool.__new__(ResourcePool)
+        resource_pool.resources = [ICluster(name="cloud0"), ICluster(name="cloud1")]
+        resource_pool.retired_resources = []
+        cloud0, cloud1 = resource_pool.resources
+        vms = [VM(id=str(i), user="user%d" % (i % 2), vmtype="type%d" % (i % 3), memory=1024,
+                  cpucores=2, storage=10, job_per_core=bool(i % 2)) for i in range(6)]
+        cloud0.vms.extend(vms[:4])
+        cloud1.vms.extend(vms[4:])
+        vms[0].status = "Error"
+        vms[1].status = "Running"
+        vms[3].override_status = "Retiring"
+        vms[4].memory = 2048
+        cloud1.vms.remove(vms[5])
+        cloud1.vms = pickle.loads(pickle.dumps(cloud1)).vms
+
+        self.assertTrue(resource_pool.check_vm_totals())
+        self.assertEqual({"user0:type0": 1, "user1:type1": 1, "user0:type2": 1,
+                          "user1:type0": 1, "user0:type1": 1},
+                         dict(resource_pool.get_vmtypes_count_internal()))
+        self.assertEqual(2, resource_pool.get_vmtypes_count_cpu_slots()["user1:type0"])
+        self.assertEqual(1, resource_pool.get_vmtypes_count_cpu_slots()["user0:type2"])
+        self.assertEqual(3, resource_pool.get_vm_count_user("user0"))
+        self.assertEqual([2048, 2, 10], resource_pool.vmtype_resource_usage()["user0:type1"])
+        self.assertEqual([vms[3]], resource_pool.retiring_vms_of_usertype("user1:type0"))
+        self.assertEqual([vms[0]], resource_pool.get_error_of_usertype("user0:type0"))
+        self.assertEqual([vms[2]], resource_pool.get_starting_of_usertype("user0:type2"))
+        self.assertEqual([], resource_pool.get_starting_of_usertype("user1:type1"))
+
+        # Totals changed behind their back are caught and fixed
+        cloud0.vm_totals.remove(vms[2])
+        self.assertFalse(resource_pool.check_vm_totals())
+        self.assertTrue(resource_pool.check_vm_totals())
+
+    def test_cluster_fitting(self):
+        from cloudscheduler import cloud_management
+        from cloudscheduler.cloud_management import ResourcePool, ClusterFitter
+        from cloudscheduler.cluster_tools import ICluster, VM
+
+        resource_pool = ResourcePool.__new__(ResourcePool)
+        resource_pool.resources = [
+            ICluster(name="small", memory=2048, vm_slots=2, cpu_cores=2, storage=20, priority=1),
+            ICluster(name="big", memory=8192, max_vm_mem=4096, vm_slots=4, cpu_cores=8,
+                     storage=100),
+            ICluster(name="off", memory=8192, vm_slots=4, cpu_cores=8, storage=100,
+                     enabled=False),
+            ICluster(name="other", memory=8192, vm_slots=4, cpu_cores=8, storage=100)]
+        for cluster in resource_pool.resources:
+            cluster.max_slots = 4
+        resource_pool.banned_job_resource = {}
+        resource_pool.target_cloud_aliases = {"both": ["small", "big"]}
+        resource_pool.cluster_fitter = ClusterFitter()
+        resource_pool._index_clusters()
+        small, big, off, other = resource_pool.resources
+
+        numpy = cloud_management.numpy
+        for numpy_module in set([numpy, None]):
+            cloud_management.numpy = numpy_module
+            resource_pool.cluster_fitter = ClusterFitter()
+            try:
+                self.assertEqual([small, big, other], resource_pool.get_fitting_resources(
+                    "", 1024, 1, 10, "", "", [], []))
+                self.assertEqual([other], resource_pool.get_fitting_resources(
+                    "", 6000, 1, 10, "", "", [], []))
+                self.assertEqual([big], resource_pool.get_fitting_resources(
+                    "", 1024, 4, 10, "", "", [], ["other"]))
+                self.assertEqual(set([small, big]), set(resource_pool.get_fitting_resources(
+                    "", 1024, 1, 10, "", "", ["both"], [])))
+                self.assertEqual([big, other, small], resource_pool.get_resourceBF(
+                    "", 1024, 1, 10, "", "", [], []))
+            finally:
+                cloud_management.numpy = numpy
+
+        # Callers get their own lists
+        resource_pool.get_fitting_resources("", 1024, 1, 10, "", "", [], []).pop()
+        self.assertEqual(3, len(resource_pool.get_fitting_resources("", 1024, 1, 10, "", "", [],
+                                                                    [])))
+
+        # Checking out the last slot of a cluster drops it from the fits
+        small.vm_slots = 1
+        small.resource_checkout(VM(memory=1024, storage=10))
+        self.assertEqual([big, other], resource_pool.get_fitting_resources(
+            "", 1024, 1, 10, "", "", [], []))
+        big.enabled = False
+        self.assertEqual([other], resource_pool.get_resourceBF("", 1024, 1, 10, "", "", [], []))
+
+    def test_vm_index_lookups(self):
+        from cloudscheduler.cloud_management import ResourcePool, VMIndex
+        from cloudscheduler.cluster_tools import ICluster, VM
+
+        resource_pool = ResourcePool.__new__(ResourcePool)
+        resource_pool.vm_index = VMIndex()
+        resource_pool.resources = [ICluster(name="cloud0"), ICluster(name="cloud1")]
+        resource_pool.retired_resources = [ICluster(name="retired")]
+        vm0 = VM(id="0", hostname="vm-0.cloud0.example.org")
+        vm1 = VM(id="1", hostname="10.1.0.1")
+        vm2 = VM(id="2", hostname="vm-2.retired.example.org")
+        resource_pool.resources[0].vms.append(vm0)
+        resource_pool.resources[1].vms.append(vm1)
+        resource_pool.retired_resources[0].vms.append(vm2)
+
+        self.assertTrue(resource_pool.find_vm_with_name("slot1@vm-0.other.domain") is vm0)
+        self.assertTrue(resource_pool.find_vm_with_name("10.1.0.1") is vm1)
+        self.assertEqual(None, resource_pool.find_vm_with_name("10.1.0.2"))
+        self.assertTrue(resource_pool.find_vm_with_name("vm-2") is vm2)
+        self.assertEqual(None, resource_pool.find_vm_with_addr("<10.1.0.1:40000>"))
+
+        # Names learnt from condor and new VMs are picked up
+        vm1.condorname = "worker-1.example.org"
+        vm1.condoraddr = "<10.1.0.1:40000>"
+        self.assertTrue(resource_pool.find_vm_with_name("worker-1") is vm1)
+        self.assertTrue(resource_pool.find_vm_with_addr("<10.1.0.1:40000>") is vm1)
+        self.assertEqual((resource_pool.resources[1], vm1),
+                         resource_pool.find_cluster_with_vm("worker-1.example.org"))
+        vm3 = VM(id="3", hostname="vm-3")
+        resource_pool.resources[1].vms.append(vm3)
+        self.assertTrue(resource_pool.find_vm_with_name("vm-3.example.org") is vm3)
+        resource_pool.resources[0].vms.remove(vm0)
+        self.assertEqual(None, resource_pool.find_vm_with_name("vm-0"))
+
+    def test_invalidate_machine_ads(self):
+        from cloudscheduler.cloud_management import ResourcePool, VMMachine
+
+        resource_pool = ResourcePool.__new__(ResourcePool)
+        resource_pool.invalidated_ads = {}
+        sent = []
+        def advertise(subsystem):
+            def do_condor_advertise(target_file):
+                sent.append((subsystem, open(target_file).read().count("Requirements")))
+                return (0, 0)
+            return do_condor_advertise
+        resource_pool.do_condor_advertise_master = advertise("master")
+        resource_pool.do_condor_advertise_startd = advertise("startd")
+        machines = [VMMachine(name="slot%d@vm%d" % (slot, vm), machine_name="vm%d" % vm)
+                    for vm in range(3) for slot in range(1, 3)]
+        resource_pool.invalidate_machine_ads(machines)
+        self.assertEqual([("master", 3), ("startd", 6)], sent)
+        # Already invalidated ads aren't sent again
+        del sent[:]
+        resource_pool.invalidate_machine_ads(machines + [VMMachine(name="slot1@vm9", machine_name="vm9")])
+        self.assertEqual([("master", 1), ("startd", 1)], sent)
 
     def test_condorxml_to_native_empty_list(self):
 
@@ -1527,6 +1985,340 @@ class JobPoolTests(unittest.TestCase):
         self.assertEqual(two_jobs[1].id, "canfarpool.phys.uvic.ca#245.699#1282577354")
         self.assertEqual(two_jobs[0].req_vmtype, "canfarbase_seb")
 
+    def test_update_jobs_from_failed_stream(self):
+        from cloudscheduler.job_management import JobPool, Job, CondorQueryError
+
+        job_pool = JobPool("Test Pool")
+        job_pool.update_jobs([Job(GlobalJobId="sched#1.0#1", JobStatus=1),
+                              Job(GlobalJobId="sched#1.1#1", JobStatus=1)])
+        self.assertEqual(len(job_pool.job_container.get_all_jobs()), 2)
+
+        def failed_stream():
+            yield Job(GlobalJobId="sched#1.0#1", JobStatus=2)
+            yield Job(GlobalJobId="sched#2.0#1", JobStatus=1)
+            raise CondorQueryError("condor_q returned 1")
+
+        # Nothing is removed when the query fails part way
+        job_pool.update_jobs(failed_stream())
+        self.assertEqual(len(job_pool.job_container.get_all_jobs()), 3)
+
+        job_pool.update_jobs(iter([Job(GlobalJobId="sched#2.0#1", JobStatus=1)]))
+        self.assertEqual([job.id for job in job_pool.job_container.get_all_jobs()],
+                         ["sched#2.0#1"])
+
+    def test_job_container_indexes(self):
+        from collections import defaultdict
+        from cloudscheduler.job_containers import HashTableJobContainer
+        from cloudscheduler.job_management import Job
+
+        container = HashTableJobContainer()
+        jobs = [Job(GlobalJobId="sched#%d.0#1" % i, Owner="user%d" % (i % 2),
+                    VMType="type%d" % (i % 3), JobPrio=i % 4, JobStatus=1 + i % 2,
+                    VMHighPriority=int(i % 5 == 0)) for i in range(20)]
+        for job in jobs:
+            container.add_job(job)
+        for job in jobs[:6]:
+            container.schedule_job(job.id)
+        container.unschedule_job(jobs[0].id)
+        container.remove_job(jobs[7])
+        container.update_job_status(jobs[8].id, 5, "", 0, 0)
+        container.add_job(Job(GlobalJobId=jobs[9].id, Owner="user1", JobPrio=10))
+
+        def grouped(jobs, key):
+            groups = defaultdict(list)
+            for job in sorted(jobs, key=lambda job: -job.get_priority()):
+                groups[key(job)].append(job)
+            return dict(groups)
+
+        def priorities(groups):
+            return dict((key, [job.get_priority() for job in group])
+                        for key, group in groups.iteritems())
+
+        new_jobs = container.get_unscheduled_jobs()
+        self.assertEqual(9, len(new_jobs))
+        self.assertEqual(priorities(grouped(new_jobs, lambda job: job.user)),
+                         priorities(container.get_unscheduled_jobs_by_users(prioritized=True)))
+        self.assertEqual(priorities(grouped(container.get_scheduled_jobs(),
+                                            lambda job: job.uservmtype)),
+                         priorities(container.get_scheduled_jobs_by_usertype(prioritized=True)))
+        self.assertEqual(priorities(grouped([job for job in new_jobs if job.user == "user1"],
+                                            lambda job: job.req_vmtype)),
+                         priorities(container.get_unscheduled_user_jobs_by_type("user1")))
+        self.assertEqual(sorted(job.id for job in new_jobs if job.high_priority),
+                         sorted(job.id for group in
+                                container.get_unscheduled_high_priority_jobs_by_users().values()
+                                for job in group))
+        self.assertEqual([jobs[8]], container.get_held_jobs())
+        self.assertEqual(sorted(job.id for job in container.get_all_jobs() if job.job_status == 2),
+                         sorted(job.id for job in container.get_running_jobs()))
+        self.assertEqual(10, container.get_jobs_for_user("user1", prioritized=True)[0].get_priority())
+        # Callers get copies they can change
+        container.get_unscheduled_jobs_by_users()["user0"].pop()
+        self.assertEqual(len([job for job in new_jobs if job.user == "user0"]),
+                         len(container.get_unscheduled_jobs_by_users()["user0"]))
+
+        # Derived values are kept until the container changes
+        head_jobs = container.get_unscheduled_head_jobs_by_users()
+        self.assertTrue(container.get_unscheduled_head_jobs_by_users() is head_jobs)
+        self.assertEqual(10, head_jobs["user1"].get_priority())
+        matching = container.find_unscheduled_jobs_with_matching_reqs("user0", jobs[2])
+        self.assertEqual(sorted(job.id for job in new_jobs if job.user == "user0" and
+                                job.req_profile is jobs[2].req_profile),
+                         sorted(job.id for job in matching))
+        self.assertEqual(matching[:1],
+                         container.find_unscheduled_jobs_with_matching_reqs("user0", jobs[2], 1))
+        container.schedule_job(head_jobs["user1"].id)
+        self.assertFalse(container.get_unscheduled_head_jobs_by_users() is head_jobs)
+        self.assertFalse("user1" in container.get_unscheduled_head_jobs_by_users())
+
+        container.clear()
+        self.assertEqual({}, dict(container.get_unscheduled_jobs_by_type()))
+        self.assertEqual([], container.get_idle_jobs())
+
+    def test_job_requirements_update(self):
+        from cloudscheduler.job_management import JobPool, Job
+
+        job_pool = JobPool("Test Pool")
+        container = job_pool.job_container
+        jobs = [Job(GlobalJobId="sched#%d.0#1" % i, Owner="user0", VMType="a", VMCPUCores=1)
+                for i in range(3)]
+        for job in jobs:
+            container.add_job(job)
+        self.assertEqual(3, len(container.find_unscheduled_jobs_with_matching_reqs("user0",
+                                                                                   jobs[0])))
+
+        job_pool.update_job_requirements(jobs[0], cpucores=4)
+        self.assertEqual(4, jobs[0].req_cpucores)
+        self.assertEqual([jobs[0]],
+                         container.find_unscheduled_jobs_with_matching_reqs("user0", jobs[0]))
+        self.assertEqual(jobs[1:],
+                         container.find_unscheduled_jobs_with_matching_reqs("user0", jobs[1]))
+
+        job_pool.update_job_requirements(jobs[1], vmtype="b")
+        self.assertEqual([jobs[1]], container.get_unscheduled_user_jobs_by_type("user0")["b"])
+        self.assertEqual(sorted([jobs[0].id, jobs[2].id]),
+                         sorted(job.id for job in
+                                container.get_unscheduled_user_jobs_by_type("user0")["a"]))
+
+    def test_job_container_fifo(self):
+        import random
+        from cloudscheduler.job_containers import HashTableJobContainer, FifoJobQueue
+        from cloudscheduler.job_management import Job
+
+        container = HashTableJobContainer()
+        container.new_fifo.BLOCK_SIZE = container.sched_fifo.BLOCK_SIZE = 2
+        jobs = [Job(GlobalJobId="sched#%d.%d#1" % (cluster, proc), ClusterId=cluster, ProcId=proc)
+                for cluster in (9, 10, 100) for proc in range(4)]
+        shuffled = list(jobs)
+        random.Random(1).shuffle(shuffled)
+        for job in shuffled:
+            container.add_job(job)
+        # Condor ids are compared as numbers, 9.x comes before 10.x
+        self.assertEqual(jobs, container.get_unscheduled_jobs_sorted_by_id())
+
+        seen = []
+        for job in container.iter_unscheduled_jobs_by_id():
+            seen.append(job)
+            if job is jobs[2]:
+                container.schedule_job(job.id)
+                container.remove_job(jobs[3])
+                container.schedule_job(jobs[6].id)
+        self.assertEqual(jobs[:3] + jobs[4:6] + jobs[7:], seen)
+        self.assertEqual([jobs[2], jobs[6]], container.get_scheduled_jobs_sorted_by_id())
+        container.unschedule_job(jobs[2].id)
+        self.assertEqual(jobs[:3] + jobs[4:6] + jobs[7:],
+                         container.get_unscheduled_jobs_sorted_by_id())
+
+        queue = FifoJobQueue()
+        queue.BLOCK_SIZE = 2
+        for job in shuffled:
+            queue.add(job)
+        for job in shuffled[::2]:
+            queue.remove(job)
+        self.assertEqual([job for job in jobs if job not in shuffled[::2]], list(queue))
+        self.assertTrue(all(block for block in queue.blocks))
+        self.assertEqual([block[-1] for block in queue.blocks], queue.maxes)
+
+    def test_requirements_cache(self):
+        from cloudscheduler.job_management import RequirementsCache
+
+        requirements = '( VMType =?= "canfarbase_seb" && Memory >= 2048 && Cpus >= 1 ) ' \
+                       '&& ( TARGET.Disk >= DiskUsage )'
+        cache = RequirementsCache(max_size=2)
+        values = cache.extract(requirements)
+        self.assertEqual(values, {"VMType": "canfarbase_seb", "Memory": "2048",
+                                  "Disk": "DiskUsage", "Cpus": "1"})
+        self.assertTrue(cache.extract(requirements) is values)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        cache.extract('VMType =?= "other"')
+        cache.extract('VMType =?= "another"')
+        self.assertEqual(len(cache.cache), 2)
+        self.assertFalse(requirements in cache.cache)
+
+    def test_requirement_profiles_are_shared(self):
+        from cloudscheduler.job_management import Job
+
+        job1 = Job(GlobalJobId="sched#1.0#1", VMType="vmtype", VMMem=1024, TargetClouds="a, b")
+        job2 = Job(GlobalJobId="sched#1.1#1", VMType="vmtype", VMMem=1024, TargetClouds="a, b")
+        job3 = Job(GlobalJobId="sched#1.2#1", VMType="vmtype", VMMem=2048, TargetClouds="a, b")
+        self.assertTrue(job1.req_profile is job2.req_profile)
+        self.assertTrue(job1.has_same_reqs(job2))
+        self.assertFalse(job1.has_same_reqs(job3))
+        self.assertEqual(job1.target_clouds, ("a", "b"))
+
+        job3.req_memory = 1024
+        self.assertTrue(job3.req_profile is job1.req_profile)
+        self.assertRaises(AttributeError, setattr, job1.req_profile, "memory", 512)
+
+    def test_job_defaults_reload(self):
+        import cloudscheduler.job_management as job_management
+        from cloudscheduler.job_management import Job
+
+        original = job_management.job_defaults
+        try:
+            job1 = Job(GlobalJobId="sched#1.0#1")
+            job2 = Job(GlobalJobId="sched#1.1#1")
+            self.assertTrue(job1.req_ami is job2.req_ami)
+
+            new_config = cloudscheduler.config.parse()
+            self.assertFalse(new_config is cloudscheduler.config.config_options)
+            new_config.set('job', 'default_VMType', 'reloaded')
+            new_config.set('job', 'default_VMProxyNonBoot', 'True')
+            job_management.load_job_defaults(new_config)
+            job3 = Job(GlobalJobId="sched#1.2#1")
+            self.assertEqual(job3.req_vmtype, "reloaded")
+            self.assertTrue(job3.proxy_non_boot)
+            self.assertNotEqual(job1.req_vmtype, "reloaded")
+        finally:
+            job_management.job_defaults = original
+
+    def test_update_jobs_from_partial_query(self):
+        from cloudscheduler.job_management import JobPool, Job, JobQueryResult
+
+        def schedd_job(job_id, status, servertime):
+            job = Job(GlobalJobId=job_id, JobStatus=status, ServerTime=servertime)
+            job.schedd = "sched"
+            return job
+
+        job_pool = JobPool("Test Pool")
+        job_pool.update_jobs(JobQueryResult([schedd_job("sched#1.0#1", 1, 100),
+                                             schedd_job("sched#1.1#1", 1, 100)],
+                                            full_schedds=["sched"]))
+        self.assertEqual(job_pool.schedd_servertime["sched"], 100)
+
+        # Jobs missing from a delta are kept, finished ones are removed
+        job_pool.update_jobs(JobQueryResult([schedd_job("sched#1.0#1", 4, 160),
+                                             schedd_job("sched#2.0#1", 1, 160)],
+                                            delta_schedds=["sched"]))
+        self.assertEqual(sorted(job.id for job in job_pool.job_container.get_all_jobs()),
+                         ["sched#1.1#1", "sched#2.0#1"])
+        self.assertEqual(job_pool.schedd_servertime["sched"], 160)
+        self.assertEqual(job_pool.schedd_polls_since_resync["sched"], 1)
+
+    def test_multi_schedd_query(self):
+        from cloudscheduler.job_management import JobPool, Job
+
+        job_pool = JobPool("Test Pool")
+        job_pool.schedd_commands = ["printf 'GlobalJobId = \"ok#2.0#1\"\\nJobStatus = 1\\n'",
+                                    "false"]
+        for job_id, schedd in (("ok#1.0#1", job_pool.schedd_commands[0]),
+                               ("failed#1.0#1", "false")):
+            job = Job(GlobalJobId=job_id, JobStatus=1)
+            job.schedd = schedd
+            job_pool.add_new_job(job)
+
+        query = job_pool.job_query()
+        job_pool.update_jobs(query)
+        self.assertEqual(query.full_schedds, set([job_pool.schedd_commands[0]]))
+        self.assertEqual(query.failed_schedds, set(["false"]))
+        # The failed schedd's job is kept, the other schedd's queue is replaced
+        self.assertEqual(sorted(job.id for job in job_pool.job_container.get_all_jobs()),
+                         ["failed#1.0#1", "ok#2.0#1"])
+
+    def test_condor_q_json_to_jobs(self):
+        from cloudscheduler.job_management import JobPool
+        from cloudscheduler.utilities import json_classad_stream
+        condor_json = """[
+  {
+    "ClusterId": 12,
+    "GlobalJobId": "canfarpool.phys.uvic.ca#12.0#1298049702",
+    "JobPrio": 0,
+    "JobStatus": 1,
+    "Owner": "patricka",
+    "ProcId": 0,
+    "Requirements": "\\/Expr(( VMType =?= \\"Vanilla\\" ) && ( Memory >= 512 ))\\/",
+    "VMJobPerCore": true
+  }
+  ,
+  {
+    "ClusterId": 12,
+    "GlobalJobId": "canfarpool.phys.uvic.ca#12.1#1298049702",
+    "JobStatus": 2,
+    "Owner": "patricka",
+    "ProcId": 1,
+    "Requirements": "\\/Expr(( VMType =?= \\"Vanilla\\" ) && ( Memory >= 512 ))\\/"
+  }
+]
+"""
+        jobs = list(JobPool._classads_to_job_stream(json_classad_stream(condor_json.splitlines(True))))
+        self.assertEqual(2, len(jobs))
+        self.assertEqual("canfarpool.phys.uvic.ca#12.1#1298049702", jobs[1].id)
+        self.assertEqual("Vanilla", jobs[0].req_vmtype)
+        self.assertEqual(2, jobs[1].job_status)
+        self.assertTrue(jobs[0].job_per_core)
+
+    def test_bindings_job_query(self):
+        from cloudscheduler import condor_bindings
+        from cloudscheduler.job_management import JobPool
+
+        saved = condor_bindings.htcondor, condor_bindings.classad
+        job_ads = []
+        htcondor, classad = fake_htcondor_bindings(job_ads=job_ads)
+        job_ads.append({"GlobalJobId": "sched1#3.0#1", "ClusterId": 3, "ProcId": 0,
+                        "JobStatus": 1, "Owner": "user",
+                        "Requirements": classad.ExprTree('VMType =?= "bindings"')})
+        condor_bindings.htcondor, condor_bindings.classad = htcondor, classad
+        try:
+            job_pool = JobPool("Test Pool")
+            job_pool.schedd_names = ["sched1"]
+            query = job_pool.job_query_bindings()
+            job_pool.update_jobs(query)
+            self.assertEqual(set(["sched1"]), query.full_schedds)
+            job = job_pool.job_container.get_job_by_id("sched1#3.0#1")
+            self.assertEqual("bindings", job.req_vmtype)
+            self.assertEqual("sched1", job.schedd)
+
+            self.assertEqual([], job_pool.job_hold_bindings([job], "Testing"))
+            self.assertEqual([], job_pool.job_release_bindings([job]))
+            self.assertEqual([("Hold", "sched1", ["3.0"], "Testing"),
+                              ("Release", "sched1", ["3.0"], None)], htcondor.actions)
+        finally:
+            condor_bindings.htcondor, condor_bindings.classad = saved
+
+    def test_condor_hold_chunks(self):
+        from cloudscheduler.job_management import JobPool, Job
+
+        config_val = cloudscheduler.config.config_options
+        saved = config_val.get('global', 'condor_hold_release_chunk_size')
+        config_val.set('global', 'condor_hold_release_chunk_size', '2')
+        try:
+            job_pool = JobPool("Test Pool")
+            jobs = [Job(GlobalJobId="sched#1.%d#1" % i, ClusterId=1, ProcId=i) for i in range(5)]
+            # Holds every job but 1.3 and fails
+            condor_hold = ["sh", "-c", 'for id; do [ "$id" = 1.3 ] || echo "Job $id held"; '
+                                       'echo "$id" >> "$0"; done; exit 1']
+            (fd, calls) = tempfile.mkstemp()
+            os.close(fd)
+            failed = job_pool._condor_job_action(condor_hold + [calls], jobs, "held")
+            self.assertEqual([jobs[3]], failed)
+            self.assertEqual(["1.%d" % i for i in range(5)], sorted(open(calls).read().split()))
+            os.remove(calls)
+            self.assertEqual([], job_pool._condor_job_action(["true"], jobs, "held"))
+            self.assertEqual(jobs, job_pool._condor_job_action(["false"], jobs, "held"))
+        finally:
+            config_val.set('global', 'condor_hold_release_chunk_size', saved)
+
     def test_condorxml_to_native_empty_list(self):
 
         from cloudscheduler.job_management import JobPool
@@ -2194,5 +2986,39 @@ class GetOrNoneTests(unittest.TestCase):
         value = utilities.get_or_none(config, self.section_name, "fakeitem")
         self.assertEqual(None, value)
 
+class CommandRunnerTests(unittest.TestCase):
+
+    def test_run_command(self):
+        # Big enough to fill a pipe on both stdout and stderr
+        result = command_runner.run_command(
+            [sys.executable, "-c", "import sys; sys.stdout.write('o' * 200000); "
+                                   "sys.stderr.write('e' * 200000); sys.exit(3)"])
+        self.assertEqual(3, result.returncode)
+        self.assertEqual(200000, len(result.stdout))
+        self.assertEqual(200000, len(result.stderr))
+        self.assertFalse(result.timed_out)
+        self.assertFalse(result.ok)
+
+    def test_run_command_timeout(self):
+        command_runner.reset_command_stats()
+        result = command_runner.run_command(["sleep", "30"], timeout=0.2)
+        self.assertTrue(result.timed_out)
+        self.assertTrue(result.elapsed < 5)
+        self.assertNotEqual(0, result.returncode)
+        stats = command_runner.command_stats()["sleep"]
+        self.assertEqual(1, stats["runs"])
+        self.assertEqual(1, stats["timeouts"])
+
+    def test_run_command_missing(self):
+        self.assertRaises(command_runner.CommandError, command_runner.run_command,
+                          ["/nonexistent/condor_q"])
+
+    def test_stream_command(self):
+        lines = command_runner.stream_command(["printf", "a\\nb\\n"])
+        self.assertEqual(["a\n", "b\n"], list(lines))
+        lines = command_runner.stream_command(["sh", "-c", "echo a; exit 1"])
+        self.assertEqual("a\n", lines.next())
+        self.assertRaises(command_runner.CommandError, lines.next)
+
 if __name__ == '__main__':
     unittest.main()